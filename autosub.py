@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# file: autosub.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+subscribe to new users as soon as their account is created.
+
+the Account plugin event of a CREATE queues the new user, and a thread
+subscribes the bot to them (the P2P topic is named by the user id) ahead
+of their first message, instead of waiting for their presence. a signup
+burst is smoothed out by a token bucket, `rate` subscriptions per second
+in batches of up to `burst`, with at most `window` of them waiting for
+the server at once:
+
+    autosub = AutoSubscriber(bot.subscribe, is_subscribed=bot.subscriptions.__contains__, ready=bot.ready)
+    autosub.install(bot.plugin)
+    autosub.start()
+
+nothing is sent while `ready` is clear, i.e. while the session is down or
+still restoring its subscriptions; requests lost with a connection are
+queued again.
+"""
+import threading
+import time
+from collections import deque
+
+import pbx.model_pb2 as pb
+from log import get_logger
+from pending import Disconnected
+
+logger = get_logger('autosub')
+
+
+class AutoSubscriber(object):
+    def __init__(self, subscribe, is_subscribed=None, ready=None, rate=20.0, burst=50, window=64,
+                 max_queue=10000):
+        """subscribe(topic) posts a {sub} and returns the future of its ctrl"""
+        self.subscribe = subscribe
+        self.is_subscribed = is_subscribed
+        self.ready = ready
+        self.rate = float(rate)
+        self.burst = burst
+        self.window = window
+        self.max_queue = max_queue
+
+        self._cond = threading.Condition(threading.Lock())
+        self._queue = deque()
+        self._queued = set()
+        self._inflight = 0
+        self._stopped = False
+
+        self.subscribed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def install(self, plugin):
+        plugin.register('Account', self.on_account)
+
+    def on_account(self, event):
+        if event.action == pb.CREATE and event.user_id:
+            self.add(event.user_id)
+
+    def add(self, user_id):
+        with self._cond:
+            if user_id in self._queued:
+                return
+            if len(self._queue) >= self.max_queue:
+                self.dropped += 1
+                return
+            self._queue.append(user_id)
+            self._queued.add(user_id)
+            self._cond.notify()
+
+    def start(self):
+        t = threading.Thread(target=self.run, name='autosub', daemon=True)
+        t.start()
+        return t
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def run(self):
+        tokens = float(self.burst)
+        last = time.monotonic()
+        while True:
+            with self._cond:
+                while not self._stopped and (not self._queue or self._inflight >= self.window):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+            if self.ready is not None and not self.ready.wait(1.0):
+                continue
+
+            now = time.monotonic()
+            tokens = min(float(self.burst), tokens + (now - last) * self.rate)
+            last = now
+            if tokens < 1:
+                time.sleep((1 - tokens) / self.rate)
+                continue
+
+            with self._cond:
+                n = min(int(tokens), len(self._queue), self.window - self._inflight)
+                batch = [self._queue.popleft() for _ in range(n)]
+                self._inflight += n
+            tokens -= n
+            for user_id in batch:
+                self._send(user_id)
+
+    def _send(self, user_id):
+        if self.is_subscribed is not None and self.is_subscribed(user_id):
+            self.skipped += 1
+            self._done(user_id)
+            return
+        try:
+            fut = self.subscribe(user_id)
+        except Exception as err:
+            logger.warning("Failed to subscribe to new user %s: %s", user_id, err)
+            self.failed += 1
+            self._done(user_id)
+            return
+        if fut is None:
+            self._done(user_id)
+            return
+        fut.add_done_callback(lambda f: self._answered(user_id, f))
+
+    def _answered(self, user_id, fut):
+        err = fut.exception() if not fut.cancelled() else None
+        if err is None:
+            self.subscribed += 1
+            self._done(user_id)
+        elif isinstance(err, Disconnected):
+            # send it again on the next session
+            self._done(user_id, retry=True)
+        else:
+            logger.info("Subscribing to new user %s failed: %s", user_id, err)
+            self.failed += 1
+            self._done(user_id)
+
+    def _done(self, user_id, retry=False):
+        with self._cond:
+            self._inflight -= 1
+            if retry:
+                self._queue.appendleft(user_id)
+            else:
+                self._queued.discard(user_id)
+            self._cond.notify()
+
+    def stats(self):
+        return {
+            'queued': len(self._queue),
+            'inflight': self._inflight,
+            'subscribed': self.subscribed,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# file: bench_loop.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+end-to-end benchmark of the bot message loop over loopback gRPC.
+
+a MockNode in this process pushes {data} at the bot running in a child
+process (ElvesChatter, AsyncElvesChatter or chatbot.py) and times every
+reply from the moment the {data} is queued on the server to the moment the
+bot's {pub} answering it arrives. reports throughput, p50/p99/p999 reply
+latency, bot CPU time per message and bot RSS growth, and writes them as
+JSON so runs can be compared:
+
+    python bench_loop.py --bot elves --rate 2000 --count 20000 --topics 50 --out before.json
+    python bench_loop.py --bot elves --rate 2000 --count 20000 --topics 50 --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import threading
+import time
+from collections import deque
+
+import grpc
+
+import log
+from mock_server import MockNode, serve
+
+BOTS = ('elves', 'aio', 'chatbot')
+
+
+def rss_kb():
+    """current resident set size of this process in KB"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_bot(kind, address, topics, workers, verbose, conn):
+    """child process: run the bot until told to stop, then report cpu time and rss"""
+    if verbose:
+        log.setup('DEBUG')
+    started_rss = rss_kb()
+    if kind == 'chatbot':
+        import chatbot
+        chatbot.load_quotes(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'quotes.txt'))
+        for topic in topics:
+            chatbot.add_subscription(topic)
+        if workers:
+            chatbot.workers = chatbot.TopicExecutor(max_workers=workers)
+        stream = chatbot.init_client(address, 'basic', b'bench:bench', None)
+        threading.Thread(target=chatbot.client_message_loop, args=(stream,), daemon=True).start()
+    elif kind == 'aio':
+        from elves_aio import AsyncElvesChatter
+
+        async def main():
+            bot = AsyncElvesChatter(address)
+            await bot.connect()
+            await bot.login('bench', 'bench')
+            for topic in topics:
+                await bot.subscribe(topic)
+            await bot.on_message()
+
+        threading.Thread(target=asyncio.run, args=(main(),), daemon=True).start()
+    else:
+        from elves import ElvesChatter
+        bot = ElvesChatter(address, workers=workers)
+        bot.subscriptions = set(topics)
+        bot.init_client()
+        bot.login('bench', 'bench')
+        threading.Thread(target=bot.on_message, daemon=True).start()
+
+    conn.send('started')
+    conn.recv()
+    cpu_start = time.process_time()
+    conn.send('measuring')
+    conn.recv()
+    conn.send({'cpu': time.process_time() - cpu_start, 'rss_start_kb': started_rss, 'rss_end_kb': rss_kb(),
+               'rss_peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+    conn.close()
+    os._exit(0)
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+
+class Timing(object):
+    """pairs each {pub} from the bot with the oldest unanswered {data} of its topic"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = {}
+        self.latencies = []
+        self.first_sent = None
+        self.last_reply = None
+
+    def on_data(self, topic):
+        now = time.perf_counter()
+        with self.lock:
+            self.sent.setdefault(topic, deque()).append(now)
+            if self.first_sent is None:
+                self.first_sent = now
+
+    def on_message(self, sess, msg):
+        if not msg.HasField('pub'):
+            return
+        now = time.perf_counter()
+        with self.lock:
+            waiting = self.sent.get(msg.pub.topic)
+            if waiting:
+                self.latencies.append(now - waiting.popleft())
+                self.last_reply = now
+
+
+def inject(node, timing, topics, count, rate, payload):
+    content = json.dumps('x' * payload).encode('utf-8')
+    started = time.monotonic()
+    for i in range(count):
+        if rate:
+            delay = started + float(i) / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        topic = topics[i % len(topics)]
+        timing.on_data(topic)
+        node.publish(topic, content, topic)
+
+
+def bench(args):
+    timing = Timing()
+    node = MockNode(on_message=timing.on_message)
+    server, port = serve(node, '127.0.0.1:0')
+    topics = ['usrBench{:05d}'.format(i) for i in range(args.topics)]
+
+    # spawn, not fork: the grpc server of this process is already running
+    ctx = multiprocessing.get_context('spawn')
+    parent, child = ctx.Pipe()
+    proc = ctx.Process(target=run_bot,
+                       args=(args.bot, '127.0.0.1:{}'.format(port), topics, args.workers, args.verbose, child))
+    proc.start()
+    parent.recv()
+
+    # wait for login and every subscription
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        with node.lock:
+            subscribed = sum(1 for t in topics if node.subscribers.get(t))
+        if subscribed == len(topics):
+            break
+        time.sleep(0.05)
+    else:
+        print("bot did not subscribe in time ({} of {} topics)".format(subscribed, len(topics)))
+
+    parent.send('go')
+    parent.recv()
+    inject(node, timing, topics, args.count, args.rate, args.payload)
+
+    deadline = time.monotonic() + args.timeout
+    while len(timing.latencies) < args.count and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    parent.send('stop')
+    usage = parent.recv()
+    proc.join(5)
+    server.stop(None)
+
+    answered = len(timing.latencies)
+    ordered = sorted(timing.latencies)
+    elapsed = (timing.last_reply - timing.first_sent) if answered else 0.0
+    return {
+        'config': vars(args),
+        'env': {
+            'python': platform.python_version(),
+            'grpc': grpc.__version__,
+            'protobuf_backend': protobuf_backend(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'sent': args.count,
+        'answered': answered,
+        'msgs_per_sec': answered / elapsed if elapsed else 0.0,
+        'latency_ms': {
+            'p50': percentile(ordered, 50) * 1000,
+            'p99': percentile(ordered, 99) * 1000,
+            'p999': percentile(ordered, 99.9) * 1000,
+            'max': (ordered[-1] if ordered else 0.0) * 1000,
+        },
+        'cpu_us_per_msg': usage['cpu'] / answered * 1e6 if answered else 0.0,
+        'rss_growth_kb': usage['rss_end_kb'] - usage['rss_start_kb'],
+        'rss_peak_kb': usage['rss_peak_kb'],
+    }
+
+
+def protobuf_backend():
+    try:
+        from google.protobuf.internal import api_implementation
+        return api_implementation.Type()
+    except ImportError:
+        return 'unknown'
+
+
+def compare(result, base):
+    """print how `result` moved relative to `base`"""
+    rows = [('msgs_per_sec', result['msgs_per_sec'], base['msgs_per_sec']),
+            ('cpu_us_per_msg', result['cpu_us_per_msg'], base['cpu_us_per_msg']),
+            ('rss_growth_kb', result['rss_growth_kb'], base['rss_growth_kb'])]
+    rows += [('latency_ms.' + k, result['latency_ms'][k], base['latency_ms'][k]) for k in ('p50', 'p99', 'p999')]
+    for name, new, old in rows:
+        change = (new - old) / old * 100 if old else 0.0
+        print("{:<18} {:>12.2f} {:>12.2f} {:>+8.1f}%".format(name, old, new, change))
+
+
+if __name__ == '__main__':
+    purpose = "Throughput and latency benchmark of the bot message loop."
+    parser = argparse.ArgumentParser(description=purpose)
+    parser.add_argument('--bot', default='elves', choices=BOTS, help='bot implementation to drive')
+    parser.add_argument('--rate', type=int, default=1000, help='inbound messages per second, 0 = unthrottled')
+    parser.add_argument('--count', type=int, default=10000, help='number of inbound messages')
+    parser.add_argument('--payload', type=int, default=64, help='size of each inbound message in characters')
+    parser.add_argument('--topics', type=int, default=10, help='number of topics the messages are spread over')
+    parser.add_argument('--workers', type=int, default=0, help='size of the bot reply pool, 0 = inline')
+    parser.add_argument('--verbose', action='store_true', help='let the bot log what it receives')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for the last reply')
+    parser.add_argument('--out', default=None, help='write the result to this JSON file')
+    parser.add_argument('--compare', default=None, help='JSON result of an earlier run to compare with')
+    args = parser.parse_args()
+
+    result = bench(args)
+    print(json.dumps(result, indent=2))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# file: bench_messages.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+microbenchmarks of the per-message work: the gen_messages builders, the
+JSON encoding done by publish(), and protobuf serialization of {pub} and
+parsing of {data} at several payload sizes.
+
+every case runs once per protobuf backend, each in its own interpreter
+since the backend is picked at import time:
+
+    python bench_messages.py                          # python, cpp and upb side by side
+    python bench_messages.py --backends python --filter serialize --out msgs.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import timeit
+
+BACKENDS = ('python', 'cpp', 'upb')
+SIZES = (16, 256, 4096, 65536)
+
+
+def protobuf_backend():
+    try:
+        from google.protobuf.internal import api_implementation
+        return api_implementation.Type()
+    except ImportError:
+        return 'unknown'
+
+
+def cases():
+    """(name, callable) of everything to time"""
+    import pbx.model_pb2 as pb
+    import gen_messages as gm
+    import chatbot
+
+    result = [
+        ('msg_hi', lambda: gm.msg_hi(101)),
+        ('msg_login', lambda: gm.msg_login(102, 'basic', '', uname='alice', password='alice123')),
+        ('msg_account', lambda: gm.msg_account(103, 'new', 'basic', b'alice:alice123', None, None, True,
+                                               'alice,test', None, None, None, 'JRWPA', 'N')),
+        ('msg_get', lambda: gm.msg_get(104, 'grpAbc', True, True, True)),
+        ('msg_set', lambda: gm.msg_set(105, 'grpAbc', 'usrAlice', None, None, None, 'JRWPA', 'N', 'JRWP')),
+        ('msg_delete', lambda: gm.msg_delete(106, 'grpAbc', 'sub', 'usrAlice', False)),
+        ('msg_note', lambda: gm.msg_note(107, 'grpAbc', 'read', 42)),
+        ('chatbot.publish', lambda: chatbot.publish('grpAbc', 'what a lovely day')),
+    ]
+    for size in SIZES:
+        text = 'x' * size
+        content = json.dumps(text).encode('utf-8')
+        pub = pb.ClientMsg(pub=pb.ClientPub(id='108', topic='grpAbc', no_echo=True, content=content))
+        data = pb.ServerMsg(data=pb.ServerData(topic='grpAbc', from_user_id='usrAlice', seq_id=1234,
+                                               content=content)).SerializeToString()
+        result += [
+            ('json.dumps/{}'.format(size), lambda text=text: json.dumps(text, ensure_ascii=False).encode('utf-8')),
+            ('ClientMsg.SerializeToString/{}'.format(size), pub.SerializeToString),
+            ('ServerMsg.FromString/{}'.format(size), lambda data=data: pb.ServerMsg.FromString(data)),
+        ]
+    return result
+
+
+def measure(func, repeat=5):
+    """best time of one call in seconds"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run_cases(name_filter=None, repeat=5):
+    results = {}
+    for name, func in cases():
+        if name_filter and name_filter not in name:
+            continue
+        results[name] = measure(func, repeat)
+    return results
+
+
+def run_backend(backend, name_filter=None, repeat=5):
+    """time every case in a child interpreter using `backend`, None when it is not available"""
+    env = dict(os.environ, PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=backend)
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', '--repeat', str(repeat)]
+    if name_filter:
+        cmd += ['--filter', name_filter]
+    proc = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+    if proc.returncode != 0:
+        err = proc.stderr.decode('utf-8').strip().splitlines()
+        print("backend {} failed: {}".format(backend, err[-1] if err else proc.returncode))
+        return None
+    result = json.loads(proc.stdout.decode('utf-8').splitlines()[-1])
+    if result['backend'] != backend:
+        print("backend {} not available, protobuf used {}".format(backend, result['backend']))
+        return None
+    return result['cases']
+
+
+def report(results):
+    backends = [b for b in results if results[b]]
+    if not backends:
+        return
+    names = list(results[backends[0]])
+    print("{:<34}".format('usec per call') + ''.join('{:>12}'.format(b) for b in backends))
+    for name in names:
+        print("{:<34}".format(name) +
+              ''.join('{:>12.3f}'.format(results[b].get(name, 0.0) * 1e6) for b in backends))
+
+
+if __name__ == '__main__':
+    purpose = "Microbenchmarks of message building and protobuf serialization."
+    parser = argparse.ArgumentParser(description=purpose)
+    parser.add_argument('--backends', default=','.join(BACKENDS), help='comma separated protobuf backends')
+    parser.add_argument('--filter', default=None, help='only run cases whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5, help='timing repeats, the best one is kept')
+    parser.add_argument('--out', default=None, help='write the results to this JSON file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps({'backend': protobuf_backend(), 'cases': run_cases(args.filter, args.repeat)}))
+        sys.exit(0)
+
+    results = {}
+    for backend in args.backends.split(','):
+        results[backend] = run_backend(backend.strip(), args.filter, args.repeat)
+    report(results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
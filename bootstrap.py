@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# file: bootstrap.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+session bootstrap: restore the subscriptions of the previous session.
+
+as soon as {login} succeeds every topic of the saved subscription set is
+subscribed to in one pipelined burst, with at most `window` {sub} requests
+waiting for their {ctrl} at any time. `ready` is set once every one of them
+has been answered (or failed), so the application can wait for the bot to
+be fully responsive:
+
+    boot = Bootstrap(subscribe, ['me'] + load_topics('subs.json'))
+    boot.start(login_future)
+    boot.ready.wait()
+"""
+import json
+import os
+import threading
+
+from log import get_logger
+from pending import RequestError
+
+logger = get_logger('bootstrap')
+
+
+def load_topics(file_name):
+    """read the subscription set saved by save_topics()"""
+    if not file_name or not os.path.exists(file_name):
+        return []
+    try:
+        with open(file_name, 'r') as f:
+            return json.load(f)
+    except Exception as err:
+        logger.error("Failed to read subscriptions from %s: %s", file_name, err)
+        return []
+
+
+def save_topics(file_name, topics):
+    if not file_name:
+        return
+    tmp = file_name + '.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(sorted(topics), f)
+        os.replace(tmp, file_name)
+    except Exception as err:
+        logger.error("Failed to save subscriptions to %s: %s", file_name, err)
+
+
+class Bootstrap(object):
+    def __init__(self, subscribe, topics, window=64, ready=None, on_ready=None):
+        """subscribe(topic) must post a {sub} and return the future of its {ctrl},
+        on_ready(topics subscribed to) is called once they are all answered"""
+        self.subscribe = subscribe
+        self.on_ready = on_ready
+        self.topics = list(topics)
+        self.window = window
+
+        self.ready = ready if ready is not None else threading.Event()
+        self.subscribed = []
+        self.failed = []
+        # the part of failed the server answered with an error, the rest timed out or was lost
+        self.refused = []
+        self.error = None
+
+        self._lock = threading.Lock()
+        self._all_done = threading.Condition(self._lock)
+        self._remaining = 0
+
+    def start(self, login_future):
+        login_future.add_done_callback(self._on_login)
+
+    def _on_login(self, fut):
+        # called on the stream reading thread, which must keep reading to resolve our subs
+        if fut.cancelled() or fut.exception() is not None:
+            self.error = fut.exception() if not fut.cancelled() else 'cancelled'
+            logger.warning("Login failed, subscriptions not restored: %s", self.error)
+            return
+        threading.Thread(target=self.run, name='bootstrap', daemon=True).start()
+
+    def run(self):
+        slots = threading.BoundedSemaphore(self.window)
+        self._remaining = len(self.topics)
+        for topic in self.topics:
+            slots.acquire()
+            try:
+                fut = self.subscribe(topic)
+            except Exception as err:
+                fut = None
+                logger.warning("Failed to subscribe to %s: %s", topic, err)
+            if fut is None:
+                slots.release()
+                self._done(topic, False)
+                continue
+            fut.add_done_callback(self._sub_callback(topic, slots))
+
+        with self._all_done:
+            while self._remaining:
+                self._all_done.wait()
+        self.ready.set()
+        if self.on_ready is not None:
+            self.on_ready(list(self.subscribed))
+
+    def _sub_callback(self, topic, slots):
+        def done(f):
+            slots.release()
+            err = f.exception() if not f.cancelled() else None
+            if isinstance(err, RequestError):
+                with self._lock:
+                    self.refused.append(topic)
+            self._done(topic, not f.cancelled() and err is None)
+
+        return done
+
+    def _done(self, topic, ok):
+        with self._lock:
+            (self.subscribed if ok else self.failed).append(topic)
+            self._remaining -= 1
+            if not self._remaining:
+                self._all_done.notify_all()
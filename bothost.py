@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+# file: bothost.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+many bot identities in one process.
+
+every bot is an AsyncElvesChatter with its own MessageLoop stream, session
+and handlers, but the streams are multiplexed over a few shared HTTP/2
+channels (bot i uses channel i % channels) and a single plugin server
+serves them all, so a bot costs a stream and a task instead of a process,
+a channel and a listening port:
+
+    host = BotHost('localhost:6061', channels=4, listen='0.0.0.0:40051')
+    await host.start()
+    bot = await host.add('alice', 'alice123')
+    bot.plugin.register('FireHose', spam_filter)
+    await host.wait()
+
+plugin calls go to the bots' own Plugin objects: events to every bot,
+FireHose and Find to each bot in turn until one answers. a bot whose
+stream fails, whose login is refused or whose handler raises is logged in
+again after a backoff, the others are not affected.
+
+    python bothost.py --host localhost:6061 --accounts accounts.txt --channels 4
+"""
+import argparse
+import asyncio
+import json
+
+import grpc.aio
+
+import pbx.model_pb2 as pb
+import log
+from elves_aio import AsyncElvesChatter
+from gen_messages import msg_login
+from log import get_logger
+from metrics import BotMetrics, serve as serve_metrics
+from pending import on_success
+from plugin import EVENTS, Plugin, log_account, serve as serve_plugin
+from reconnect import Backoff
+
+logger = get_logger('host')
+
+
+class BotHost(object):
+    def __init__(self, server_address, channels=4, listen=None, plugin_workers=16, maximum_concurrent_rpcs=None,
+                 metrics=None):
+        self.server_address = server_address
+        self.channel_count = channels
+        self.channels = []
+        # round robin over the channels, whatever bots were removed since
+        self._next_channel = 0
+        self.listen = listen
+        self.plugin_workers = plugin_workers
+        self.maximum_concurrent_rpcs = maximum_concurrent_rpcs
+
+        # the one servicer the Tinode server calls, it forwards to the plugins of the bots
+        self.plugin = Plugin()
+        self.plugin.register('Account', log_account)
+        for method in EVENTS:
+            self.plugin.register(method, self._broadcast(method))
+        self.plugin.register('FireHose', self._first('FireHose', lambda req: req.sess.user_id))
+        self.plugin.register('Find', self._first('Find', lambda query: query.user_id))
+        self.server = None
+
+        # user name -> bot, user name -> task running it, user id -> bot
+        self.bots = {}
+        self.tasks = {}
+        self.users = {}
+        self.stopped = False
+
+        # one BotMetrics counting the messages of every bot
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.registry.gauge('tinode_bot_host_sessions', 'bots logged in').set_function(
+                lambda: sum(1 for bot in self.bots.values() if bot.ready.is_set()))
+            self.watch_metrics()
+
+    def watch_metrics(self):
+        # totals over the bots, every new bot points the gauges at itself
+        self.metrics.watch(queue_depth=lambda: sum(bot.queue_out.qsize() for bot in self.bots.values()
+                                                   if bot.queue_out is not None),
+                           pending=lambda: sum(len(bot.pending) for bot in self.bots.values()))
+
+    # ---------------- plugin calls -------------------
+    def _broadcast(self, method):
+        def handler(event):
+            # every bot plugin catches and counts the errors of its own handlers
+            for bot in list(self.bots.values()):
+                getattr(bot.plugin, method)(event, None)
+        return handler
+
+    def _first(self, method, user_of):
+        def handler(req):
+            # the bot the request comes from is asked first
+            owner = self.users.get(user_of(req))
+            bots = list(self.bots.values())
+            if owner is not None:
+                bots.remove(owner)
+                bots.insert(0, owner)
+            for bot in bots:
+                resp = getattr(bot.plugin, method)(req, None)
+                if resp.status != pb.CONTINUE:
+                    return resp
+            return None
+        return handler
+
+    # ---------------- bots -------------------
+    async def start(self):
+        """open the channels and the plugin server, from the running event loop"""
+        self.channels = [grpc.aio.insecure_channel(self.server_address) for _ in range(self.channel_count)]
+        if self.listen:
+            self.server, port = serve_plugin(self.plugin, self.listen, workers=self.plugin_workers,
+                                             maximum_concurrent_rpcs=self.maximum_concurrent_rpcs)
+            logger.info('=> plugin server on port %d', port)
+
+    async def add(self, user_name, password):
+        """start a bot logged in as user_name, returns the AsyncElvesChatter"""
+        if user_name in self.bots:
+            raise ValueError('bot {} is already running'.format(user_name))
+        if not self.channels:
+            raise RuntimeError('no channels, call start() first.')
+        channel = self.channels[self._next_channel % len(self.channels)]
+        self._next_channel += 1
+        bot = AsyncElvesChatter(self.server_address, metrics=self.metrics, channel=channel)
+        # logged once by the host, not once per bot
+        bot.plugin.unregister('Account', log_account)
+        if self.metrics is not None:
+            self.watch_metrics()
+        bot.user_name = user_name
+        bot.password = password
+        bot.user_id = None
+        self.bots[user_name] = bot
+        self.tasks[user_name] = asyncio.ensure_future(self._run(bot))
+        return bot
+
+    async def remove(self, user_name):
+        bot = self.bots.pop(user_name, None)
+        task = self.tasks.pop(user_name, None)
+        if task is not None:
+            task.cancel()
+        if bot is not None:
+            self.users.pop(bot.user_id, None)
+            await bot.close()
+
+    async def _login(self, bot):
+        fut = await bot.client_post(msg_login(mid=bot.next_id(), scheme='basic', secret='', uname=bot.user_name,
+                                              password=bot.password))
+
+        def logged_in(params):
+            user = params.get('user')
+            bot.user_id = json.loads(user) if user else None
+            if bot.user_id:
+                self.users[bot.user_id] = bot
+            bot.ready.set()
+
+        on_success(fut, logged_in)
+        return fut
+
+    async def _session(self, bot):
+        """log in and read messages until the stream ends, raises when the login is refused"""
+        login = await self._login(bot)
+        reader = asyncio.ensure_future(bot.on_message())
+        answered = asyncio.wrap_future(login) if login is not None else None
+        try:
+            if answered is not None:
+                await asyncio.wait([answered, reader], return_when=asyncio.FIRST_COMPLETED)
+                if answered.done() and not answered.cancelled() and answered.exception() is not None:
+                    # connected but never ready: start over like for a broken stream
+                    raise answered.exception()
+            await reader
+        finally:
+            reader.cancel()
+            if answered is not None and not answered.cancel() and not answered.cancelled():
+                # answered after all, the failure of a dead stream is of no interest
+                answered.exception()
+
+    async def _run(self, bot, stable_after=60.0):
+        """keep one bot connected until it is removed, its failures stay in this task"""
+        backoff = Backoff()
+        bot.user_id = None
+        loop = asyncio.get_event_loop()
+        while not self.stopped:
+            bot.ready.clear()
+            started = loop.time()
+            try:
+                await bot.init_client()
+                await self._session(bot)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Bot %s failed', bot.user_name)
+            if bot.stream is not None:
+                bot.stream.cancel()
+            bot.pending.fail_all()
+            if self.stopped:
+                break
+            if loop.time() - started > stable_after:
+                backoff.reset()
+            delay = backoff.next()
+            logger.info('Bot %s disconnected, reconnecting in %.1fs', bot.user_name, delay)
+            await asyncio.sleep(delay)
+
+    async def wait(self):
+        """until every bot is removed or close() is called"""
+        while self.tasks and not self.stopped:
+            await asyncio.wait(list(self.tasks.values()))
+
+    async def close(self):
+        self.stopped = True
+        for user_name in list(self.bots):
+            await self.remove(user_name)
+        for channel in self.channels:
+            await channel.close()
+        self.channels = []
+        if self.server is not None:
+            self.server.stop(None)
+            self.server = None
+
+    def stats(self):
+        return {
+            'bots': len(self.bots),
+            'ready': sum(1 for bot in self.bots.values() if bot.ready.is_set()),
+            'channels': len(self.channels),
+            'plugin': self.plugin.stats(),
+        }
+
+
+def load_accounts(file_name):
+    """'user:password' per line"""
+    accounts = []
+    with open(file_name, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                user_name, _, password = line.partition(':')
+                accounts.append((user_name, password))
+    return accounts
+
+
+async def main(args):
+    metrics = None
+    if args.metrics_listen:
+        metrics = BotMetrics()
+        serve_metrics(metrics.registry, args.metrics_listen)
+    host = BotHost(args.host, channels=args.channels, listen=args.listen, plugin_workers=args.plugin_workers,
+                   metrics=metrics)
+    await host.start()
+    for user_name, password in load_accounts(args.accounts):
+        await host.add(user_name, password)
+    logger.info('=> %d bots over %d channels', len(host.bots), len(host.channels))
+    try:
+        await host.wait()
+    finally:
+        await host.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run many bot sessions in one process.")
+    parser.add_argument('--host', default='localhost:6061', help='address of Tinode server gRPC endpoint')
+    parser.add_argument('--accounts', required=True, help="file with one 'user:password' per line")
+    parser.add_argument('--channels', type=int, default=4, help='number of gRPC channels shared by the bots')
+    parser.add_argument('--listen', default=None, help='address to serve the Plugin API of every bot on')
+    parser.add_argument('--plugin-workers', type=int, default=16, help='threads serving plugin calls')
+    parser.add_argument('--metrics-listen', default=None, help='address to serve Prometheus /metrics on')
+    parser.add_argument('--log-level', default='INFO', help='logging level')
+    args = parser.parse_args()
+    log.setup(args.log_level)
+    asyncio.run(main(args))
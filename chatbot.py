@@ -2,56 +2,106 @@
 
 import argparse
 import base64
-from concurrent import futures
 import json
 import os
-
-try:
-    import Queue as queue
-except ImportError:
-    import queue
 import random
 import signal
 import sys
+import threading
 import time
 
 import grpc
 
 import pbx.model_pb2 as pb
 import pbx.model_pb2_grpc as pbx
+from bootstrap import Bootstrap, load_topics, save_topics
+from gen_messages import msg_get
+from reconnect import Backoff, retained, reissue
+from dispatch import Dispatcher
+from executor import TopicExecutor
+from outbox import Outbox, OutboxFull, POLICIES, DROP_NOTES
+from delivery import AckWindow, Deduplicator, IDEMPOTENCY_KEY, WindowFull
+from metrics import BotMetrics, serve as serve_metrics
+from log import get_logger, OneLine, IN, OUT
+import log
+from plugin import Plugin, log_account, parse_limits, serve as serve_plugin
+from firehose import RuleEngine, load_rules
+from find_index import FindIndex
+from mirror import Mirror
+from autosub import AutoSubscriber
+from submanager import SubscriptionManager
+from cluster import ClusterNode, FileMembership
+from msgstore import MessageStore
+from sync import HistorySync
+from pending import PendingRequests, RequestError, RequestTimeout, message_id, on_success
+
+logger = get_logger('chatbot')
+log_in = get_logger(IN)
+log_out = get_logger(OUT)
 
 APP_NAME = "Tino-chatbot"
 VERSION = "0.14"
 
-# Dictionary wich contains lambdas to be executed when server response is received
-onCompletion = {}
+# Futures of requests waiting for the server response, reset on every connection
+pending = PendingRequests()
+
 
+# Active subscriptions: subscribed on presence, left on idle, OFF or over the cap
+subscriptions = SubscriptionManager(lambda topic: post_subscribe(topic), lambda topic: post_leave(topic))
 
-# Add bundle for future execution
-def add_future(tid, bundle):
-    onCompletion[tid] = bundle
+# ClusterNode when several nodes run this bot account, only the owner of a topic subscribes and replies
+cluster = None
 
 
-# Resolve or reject the future
-def exec_future(tid, code, params):
-    bundle = onCompletion.get(tid)
-    if bundle != None:
-        del onCompletion[tid]
-        if code >= 200 and code < 400:
-            arg = bundle.get('arg')
-            bundle.get('action')(arg, params)
+# Set once the session is logged in and subscriptions are restored
+ready = threading.Event()
 
+# Topics of the subs file or of earlier sessions not restored yet, saved along with the live subscriptions
+restoring = set()
 
-# List of active subscriptions
-subscriptions = {}
+# Number of the current session, bumped when its stream ends so late callbacks of the old one are ignored
+session = 0
+session_lock = threading.Lock()
+
+# Max number of subscription requests in flight while restoring, file to persist subscriptions in
+sub_window = 64
+subs_file = None
 
 
 def add_subscription(topic):
-    subscriptions[topic] = True
+    subscriptions.add(topic)
 
 
 def del_subscription(topic):
-    subscriptions.pop(topic, None)
+    subscriptions.discard(topic)
+
+
+def saved_topics():
+    """Topics to persist, those not restored yet included so a half restored session loses none"""
+    with session_lock:
+        return set(subscriptions) | restoring
+
+
+def end_session():
+    """The stream is gone, whatever its bootstrap does from now on concerns no session"""
+    global session
+    with session_lock:
+        session += 1
+        ready.clear()
+
+
+def session_ready(generation, boot):
+    """Bootstrap of session `generation` is over"""
+    with session_lock:
+        if generation != session:
+            # Disconnected meanwhile, the next session restores these topics again
+            return
+        # Subscribed or refused by the server; topics which timed out are tried again next session
+        restoring.difference_update(boot.subscribed)
+        restoring.difference_update(boot.refused)
+        ready.set()
+    if history is not None:
+        history.sync(boot.subscribed)
 
 
 # Quotes from the fortune cookie file
@@ -78,51 +128,113 @@ def next_quote():
 next_quote.idx = 0
 
 
-# This is the class for the server-side gRPC endpoints
-class Plugin(pbx.PluginServicer):
-    def Account(self, acc_event, context):
-        action = None
-        if acc_event.action == pb.CREATE:
-            action = "created"
-        elif acc_event.action == pb.UPDATE:
-            action = "updated"
-        elif acc_event.action == pb.DELETE:
-            action = "deleted"
-        else:
-            action = "unknown"
+def set_quotes(lines):
+    """worker processes start without the quotes loaded by run(), the pool hands them over"""
+    quotes[:] = lines
 
-        print("Account", action, ":", acc_event.user_id, acc_event.public)
 
-        # TODO: subscribe to the new user.
+def make_reply(content):
+    # Respond with a witty quote
+    return next_quote() + content.decode('utf-8')
 
-        return pb.Unused()
 
+# Pool generating replies off the stream reading thread, None to reply inline
+workers = None
 
-queue_out = queue.Queue()
 
+# Handlers of the Plugin API calls made by the Tinode server
+plugin = Plugin()
+plugin.register('Account', log_account)
 
-def client_generate():
-    while True:
-        msg = queue_out.get()
-        print('-- get one msg out from queue: ', msg)
 
-        if msg == None:
-            return
-        # print("out:", msg)
+queue_out = Outbox()
+
+# Message counters and timings served with --metrics-listen, None when off
+metrics = None
+
+
+def client_generate():
+    for msg in queue_out:
+        if log_out.isEnabledFor(log.DEBUG):
+            log_out.debug('out: %s', OneLine(msg))
         yield msg
 
 
 def client_post(msg):
-    queue_out.put(msg)
+    mid = message_id(msg)
+    fut = pending.add(mid) if mid is not None else None
+    try:
+        queue_out.put(msg)
+    except OutboxFull as err:
+        # Server is stalled and the overflow policy refused the message
+        logger.warning("Dropped outbound message: %s", err)
+        if mid is not None:
+            pending.fail(mid, err)
+        return fut
+    if metrics is not None:
+        metrics.sent(msg)
+    return fut
 
 
 def client_reset():
-    # Drain the queue
+    global queue_out
+    # Hand the queue over to the next stream, this ends the request iterator of the old one
+    queue_out, leftovers = queue_out.renew()
+    # Nothing sent on the old connection will be answered
+    pending.fail_all()
+    # Unsent publishes are replayed once the next session is ready
+    return retained(leftovers)
+
+
+def replay_when_ready(messages, timeout=60.0):
+    if not ready.wait(timeout):
+        logger.error("Session not ready, dropped %d unsent messages", len(messages))
+        return
+    for msg in messages:
+        reissue(msg, next_id())
+        if acks is not None:
+            post_tracked(msg, msg.pub.head[IDEMPOTENCY_KEY])
+        else:
+            client_post(msg)
+
+
+# Window of publishes waiting for their ack with --at-least-once, None otherwise
+acks = None
+# Idempotency keys of recently received messages, to skip replays
+dedup = Deduplicator()
+# MessageStore of the inbound {data} with --store, skips seq_ids seen before a restart
+store = None
+# HistorySync fetching what was missed while disconnected, None when off
+history = None
+
+
+def post_publish(topic, text):
+    msg = publish(topic, text)
+    if acks is None:
+        return client_post(msg)
     try:
-        while queue_out.get(False) != None:
-            pass
-    except queue.Empty:
-        pass
+        # Sent now, or once an ack frees a slot: this may run on the thread reading the acks
+        return acks.track(msg, post_tracked)
+    except WindowFull as err:
+        logger.warning("Dropped reply to %s: %s", topic, err)
+        return None
+
+
+def post_tracked(msg, key):
+    fut = client_post(msg)
+
+    def done(f):
+        err = f.exception()
+        if err is None:
+            acks.ack(key)
+        elif isinstance(err, RequestError):
+            acks.ack(key, ok=False)
+        elif isinstance(err, RequestTimeout):
+            post_tracked(reissue(msg, next_id()), key)
+        # Lost with the connection: replayed from the window after reconnect
+
+    fut.add_done_callback(done)
+    return fut
 
 
 def hello():
@@ -131,103 +243,159 @@ def hello():
                                        ver=VERSION, lang="EN"))
 
 
-def login(cookie_file_name, scheme, secret):
+def login(scheme, secret):
     tid = next_id()
-    onCompletion[tid] = {
-        'arg': cookie_file_name,
-        'action': lambda fname, params: save_auth_cookie(fname, params),
-    }
     return pb.ClientMsg(login=pb.ClientLogin(id=tid, scheme=scheme, secret=secret))
 
 
 def subscribe(topic):
     tid = next_id()
-    onCompletion[tid] = {
-        'arg': topic,
-        'action': lambda topicName, unused: add_subscription(topicName),
-    }
     return pb.ClientMsg(sub=pb.ClientSub(id=tid, topic=topic))
 
 
 def leave(topic):
     tid = next_id()
-    onCompletion[tid] = {
-        'arg': topic,
-        'action': lambda topicName, unused: del_subscription(topicName)
-    }
     return pb.ClientMsg(leave=pb.ClientLeave(id=tid, topic=topic))
 
 
+def post_subscribe(topic):
+    fut = client_post(subscribe(topic))
+    on_success(fut, lambda unused: add_subscription(topic))
+    return fut
+
+
+def post_leave(topic):
+    fut = client_post(leave(topic))
+    on_success(fut, lambda unused: del_subscription(topic))
+    return fut
+
+
 def publish(topic, text):
     tid = next_id()
     return pb.ClientMsg(pub=pb.ClientPub(id=tid, topic=topic, no_echo=True,
                                          content=json.dumps(text, ensure_ascii=False).encode('utf-8')))
 
 
+def post_get_data(topic, since_id, before_id, limit):
+    return client_post(msg_get(next_id(), topic, False, False, True, since_id, before_id, limit))
+
+
 def note_read(topic, seq):
     return pb.ClientMsg(note=pb.ClientNote(topic=topic, what=pb.READ, seq_id=seq))
 
 
-def init_server(listen):
+def init_server(listen, workers=16, maximum_concurrent_rpcs=None):
     # Launch plugin server: acception connection(s) from the Tinode server.
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=16))
-    pbx.add_PluginServicer_to_server(Plugin(), server)
-    server.add_insecure_port(listen)
-    server.start()
-
+    server, _ = serve_plugin(plugin, listen, workers=workers, maximum_concurrent_rpcs=maximum_concurrent_rpcs)
     return server
 
 
-def init_client(addr, schema, secret, cookie_file_name):
-    channel = grpc.insecure_channel(addr)
+# gRPC channel, reconnects by itself and is reused by every stream
+channel = None
+
+
+def init_client(addr, schema, secret, cookie_file_name, fallback=None):
+    """Open a stream and log in, `fallback` is the (schema, secret) to use if the token login fails"""
+    global channel
+    if channel is None:
+        channel = grpc.insecure_channel(addr)
     stub = pbx.NodeStub(channel)
     # Call the server
-    print('schema: {}, secret: {}'.format(schema, secret))
-    print('=> init client will send an iterator to MessageLoop')
+    logger.info('=> logging in with %s', schema)
     stream = stub.MessageLoop(client_generate())
     # Session initialization sequence: {hi}, {login}, {sub topic='me'}
     client_post(hello())
-    client_post(login(cookie_file_name, schema, secret))
-    client_post(subscribe('me'))
+    # Leaves on OFF grace and idle timeouts need the timer, also when run() is not the caller
+    subscriptions.start()
+    # Pipeline {sub} for 'me' and every topic of the previous session as soon as {login} succeeds
+    with session_lock:
+        # The previous session may not have restored everything, keep that too
+        restoring.update(subscriptions)
+        subscriptions.clear()
+        ready.clear()
+        generation = session
+        topics = ['me'] + sorted(topic for topic in restoring
+                                 if topic != 'me' and (cluster is None or cluster.owns(topic)))
+    if history is not None:
+        history.reset()
+    post_login(schema, secret, cookie_file_name, topics, fallback, generation)
 
     return stream
 
 
+def post_login(schema, secret, cookie_file_name, topics, fallback=None, generation=None):
+    login_future = client_post(login(schema, secret))
+    on_success(login_future, lambda params: save_auth_cookie(cookie_file_name, params))
+    # Its own Event: `ready` is only set for the session still current when it is done
+    boot = Bootstrap(post_subscribe, topics, window=sub_window,
+                     on_ready=lambda subscribed: session_ready(generation, boot))
+    boot.start(login_future)
+
+    def retry(fut):
+        if fallback is not None and not fut.cancelled() and fut.exception() is not None:
+            logger.warning("Token login failed, using %s", fallback[0])
+            post_login(fallback[0], fallback[1], cookie_file_name, topics, generation=generation)
+
+    login_future.add_done_callback(retry)
+
+
+# Handlers of inbound messages, by message type and topic
+dispatcher = Dispatcher()
+
+
+@dispatcher.on('ctrl')
+def on_ctrl(ctrl):
+    # Run code on command completion
+    pending.resolve(ctrl)
+    # print(str(ctrl.code) + " " + ctrl.text)
+
+
+@dispatcher.on('data')
+def on_data(data):
+    # Respond to message.
+    # print("message from:", data.from_user_id)
+    # Mark received message as read
+    client_post(note_read(data.topic, data.seq_id))
+    duplicate = dedup.is_duplicate(data) or (store is not None and not store.append(data))
+    if history is not None:
+        history.observe(data, fresh=not duplicate)
+    if duplicate:
+        return
+    log_in.debug('收到消息：%s', data.content)
+    topic = data.topic
+    if cluster is not None and not cluster.owns(topic):
+        # handed over to another node, which replies
+        return
+    subscriptions.touch(topic)
+    if workers is None:
+        post_publish(topic, make_reply(data.content))
+    else:
+        workers.submit(topic, make_reply, data.content, callback=lambda text: post_publish(topic, text))
+
+
+@dispatcher.on('pres', topic='me')
+def on_pres_me(pres):
+    # print("presence:", pres.topic, pres.what)
+    # Wait for peers to appear online and subscribe to their topics, leave some time after they go offline
+    target = subscriptions if cluster is None else cluster
+    if pres.what == pb.ServerPres.ON or pres.what == pb.ServerPres.MSG:
+        target.want(pres.src)
+    elif pres.what == pb.ServerPres.OFF:
+        target.release(pres.src)
+
+
 def client_message_loop(stream):
     try:
-        # Read server responses
+        # Read server responses, ignore everything without a handler
         for msg in stream:
-            # print("in:", msg)
-            if msg.HasField("ctrl"):
-                # Run code on command completion
-                exec_future(msg.ctrl.id, msg.ctrl.code, msg.ctrl.params)
-                # print(str(msg.ctrl.code) + " " + msg.ctrl.text)
-
-            elif msg.HasField("data"):
-                # Respond to message.
-                # print("message from:", msg.data.from_user_id)
-                # Mark received message as read
-                client_post(note_read(msg.data.topic, msg.data.seq_id))
-                # Respond with a witty quote
-                print('收到消息：', msg.data.content)
-                client_post(publish(msg.data.topic, next_quote() + msg.data.content.decode('utf-8')))
-
-            elif msg.HasField("pres"):
-                # print("presence:", msg.pres.topic, msg.pres.what)
-                # Wait for peers to appear online and subscribe to their topics
-                if msg.pres.topic == 'me':
-                    if (msg.pres.what == pb.ServerPres.ON or msg.pres.what == pb.ServerPres.MSG) \
-                            and subscriptions.get(msg.pres.src) == None:
-                        client_post(subscribe(msg.pres.src))
-                    elif msg.pres.what == pb.ServerPres.OFF and subscriptions.get(msg.pres.src) != None:
-                        client_post(leave(msg.pres.src))
-
-            else:
-                # Ignore everything else
-                pass
+            if log_in.isEnabledFor(log.DEBUG):
+                log_in.debug('in: %s', OneLine(msg))
+            dispatcher.dispatch(msg)
 
     except grpc._channel._Rendezvous as err:
-        print("Disconnected:", err)
+        logger.warning("Disconnected: %s", err)
+    end_session()
+    save_topics(subs_file, saved_topics())
 
 
 def read_auth_cookie(cookie_file_name):
@@ -247,7 +415,7 @@ def read_auth_cookie(cookie_file_name):
         return schema, secret
 
     except Exception as err:
-        print("Failed to read authentication cookie", err)
+        logger.error("Failed to read authentication cookie: %s", err)
         return None, None
 
 
@@ -270,7 +438,7 @@ def save_auth_cookie(cookie_file_name, params):
         json.dump(nice, cookie)
         cookie.close()
     except Exception as err:
-        print("Failed to save authentication cookie", err)
+        logger.error("Failed to save authentication cookie: %s", err)
 
 
 def load_quotes(file_name):
@@ -282,26 +450,108 @@ def load_quotes(file_name):
 
 
 def run(args):
-    print("In run()")
+    logger.debug("In run()")
     schema = 'basic'
     secret = 'jintian:123456'.encode('utf-8')
     if schema:
         # Load random quotes from file
-        print("Loaded {} quotes".format(load_quotes(args.quotes)))
+        logger.info("Loaded %d quotes", load_quotes(args.quotes))
+
+        global queue_out, workers, sub_window, subs_file, acks, metrics, subscriptions, cluster, store, history
+        sub_window = args.sub_window
+        subs_file = args.subs_file
+        if args.workers:
+            workers = TopicExecutor(max_workers=args.workers, max_inflight=args.max_inflight,
+                                    processes=args.processes, initializer=set_quotes, initargs=(list(quotes),))
+
+        if args.metrics_listen:
+            metrics = BotMetrics()
+            # queue_out is replaced on every reconnect, look it up at scrape time
+            metrics.watch(queue_depth=lambda: len(queue_out), pending=lambda: len(pending))
+            dispatcher.metrics = metrics
+            serve_metrics(metrics.registry, args.metrics_listen)
+            logger.info('=> metrics on http://%s/metrics', args.metrics_listen)
+        queue_out = Outbox(max_batch=args.max_batch, max_linger=args.max_linger, capacity=args.queue_size,
+                           policy=args.overflow, registry=metrics.registry if metrics is not None else None)
+
+        if args.at_least_once:
+            acks = AckWindow(max_unacked=args.max_unacked, registry=metrics.registry if metrics is not None else None)
+
+        subscriptions = SubscriptionManager(post_subscribe, post_leave, max_active=args.max_subscriptions,
+                                            idle_timeout=args.sub_idle_timeout, off_grace=args.sub_off_grace,
+                                            registry=metrics.registry if metrics is not None else None)
+        # Subscribed again once logged in, until then they only count as saved
+        restoring.update(load_topics(subs_file))
+        subscriptions.start()
+
+        if args.store:
+            store = MessageStore(args.store, keep=args.store_keep)
+        if args.sync_page:
+            # Catch up on the messages missed while disconnected, from where --store or the last session left off
+            history = HistorySync(post_get_data, store=store, page=args.sync_page, concurrency=args.sync_concurrency)
+
+        if args.cluster_node:
+            cluster = ClusterNode(args.cluster_node, FileMembership(args.cluster_dir, ttl=args.cluster_ttl),
+                                  subscriptions, interval=args.cluster_ttl / 4)
+            # Restored topics this node does not own yet may become its own
+            cluster.seed(restoring)
+            cluster.start()
+            logger.info('=> cluster node %s of %s', args.cluster_node, sorted(cluster.ring.nodes))
+
+        if args.firehose_rules:
+            engine = RuleEngine(load_rules(args.firehose_rules))
+            engine.install(plugin)
+            logger.info("Loaded %d FireHose rules", len(engine.rules))
+
+        find_index = None
+        if args.find_index:
+            find_index = FindIndex(limit=args.find_limit, snapshot_file=args.find_index)
+            find_index.install(plugin)
+            find_index.start_snapshots(args.find_snapshot_interval)
+
+        mirror = None
+        if args.mirror:
+            mirror = Mirror(snapshot_file=args.mirror, journal_file=args.mirror + '.journal')
+            mirror.install(plugin)
+            mirror.start_snapshots(args.mirror_snapshot_interval)
+
+        if args.autosub_rate > 0:
+            # Subscribe to new users when their account is created, not when they first come online
+            # A new user may never come online to release its topic, the cluster does not keep it
+            subscribe = post_subscribe if cluster is None else lambda topic: cluster.want(topic, remember=False)
+            autosub = AutoSubscriber(subscribe, is_subscribed=subscriptions.__contains__, ready=ready,
+                                     rate=args.autosub_rate, burst=args.autosub_burst)
+            autosub.install(plugin)
+            autosub.start()
 
         # Start Plugin server
-        server = init_server(args.listen)
-        print('=> server initialised.')
+        for method, limit in parse_limits(args.plugin_limits).items():
+            plugin.set_limit(method, limit)
+        server = init_server(args.listen, workers=args.plugin_workers,
+                             maximum_concurrent_rpcs=args.plugin_max_rpcs)
+        logger.info('=> server initialised.')
 
         # Initialize and launch client
         client = init_client(args.host, schema, secret, args.login_cookie)
-        print('=> client initialised.')
+        logger.info('=> client initialised.')
 
         # Setup closure for graceful termination
         def exit_gracefully(signo, stack_frame):
-            print("Terminated with signal", signo)
+            logger.info("Terminated with signal %s", signo)
+            save_topics(subs_file, saved_topics())
+            subscriptions.stop()
+            if cluster is not None:
+                cluster.stop()
+            if store is not None:
+                store.close()
+            if find_index is not None:
+                find_index.stop()
+            if mirror is not None:
+                mirror.stop()
             server.stop(None)
             client.cancel()
+            # Last, so the writer thread still gets what was logged while stopping
+            log.shutdown()
             sys.exit(0)
 
         # Add signal handlers
@@ -310,18 +560,37 @@ def run(args):
 
         # Run blocking message loop in a cycle to handle
         # server being down.
+        backoff = Backoff()
         while True:
+            started = time.monotonic()
             client_message_loop(client)
-            time.sleep(3)
-            client_reset()
-            client = init_client(args.host, schema, secret, args.login_cookie)
+            if time.monotonic() - started > 60:
+                backoff.reset()
+            # Randomized exponential delay, keeps a fleet of bots from reconnecting in lockstep
+            delay = backoff.next()
+            logger.warning("Reconnecting in %.1fs", delay)
+            time.sleep(delay)
+            replay = client_reset()
+            if metrics is not None:
+                metrics.reconnects.inc()
+            if acks is not None:
+                # The window holds every unacknowledged publish, sent or not
+                replay = acks.unacked()
+            # Resume with the token saved by the last login, fall back to the original credentials
+            token_schema, token = read_auth_cookie(args.login_cookie)
+            if token_schema == 'token':
+                client = init_client(args.host, token_schema, token, args.login_cookie, fallback=(schema, secret))
+            else:
+                client = init_client(args.host, schema, secret, args.login_cookie)
+            if replay:
+                threading.Thread(target=replay_when_ready, args=(replay,), daemon=True).start()
 
         # Close connections gracefully before exiting
         server.stop(None)
         client.cancel()
 
     else:
-        print("Error: unknown authentication scheme")
+        logger.error("Error: unknown authentication scheme")
 
 
 if __name__ == '__main__':
@@ -338,6 +607,72 @@ if __name__ == '__main__':
     parser.add_argument('--login-cookie', default='.tn-cookie', help='read credentials from the provided cookie file')
     parser.add_argument('--quotes', default='quotes.txt',
                         help='file with messages for the chatbot to use, one message per line')
+    parser.add_argument('--max-batch', type=int, default=64,
+                        help='max number of outbound messages handed to gRPC per writer wakeup')
+    parser.add_argument('--max-linger', type=float, default=0.0,
+                        help='seconds the writer waits for an outbound batch to fill')
+    parser.add_argument('--queue-size', type=int, default=10000, help='max number of queued outbound messages')
+    parser.add_argument('--overflow', default=DROP_NOTES, choices=POLICIES,
+                        help='what to do when the outbound queue is full, notes are shed first')
+    parser.add_argument('--subs-file', default=None,
+                        help='file to save subscriptions in and restore them from on start')
+    parser.add_argument('--sub-window', type=int, default=64,
+                        help='max number of subscription requests in flight while restoring a session')
+    parser.add_argument('--max-subscriptions', type=int, default=0,
+                        help='max number of topics subscribed to, the least recently used is left, 0 for no cap')
+    parser.add_argument('--sub-idle-timeout', type=float, default=0,
+                        help='seconds without messages after which a topic is left, 0 to never leave on idle')
+    parser.add_argument('--sub-off-grace', type=float, default=30,
+                        help='seconds to wait after a peer goes offline before leaving its topic')
+    parser.add_argument('--store', default=None,
+                        help='directory to keep received messages in, seq_ids stored there are not handled again')
+    parser.add_argument('--store-keep', type=int, default=200, help='messages kept per topic in --store')
+    parser.add_argument('--sync-page', type=int, default=0,
+                        help='messages per {get} when fetching those missed while disconnected, 0 to not fetch them')
+    parser.add_argument('--sync-concurrency', type=int, default=4,
+                        help='max number of topics whose missed messages are fetched at once')
+    parser.add_argument('--cluster-node', default=None,
+                        help='name of this node when several nodes run the same bot account')
+    parser.add_argument('--cluster-dir', default='cluster',
+                        help='directory shared by the cluster nodes for their membership files')
+    parser.add_argument('--cluster-ttl', type=float, default=10,
+                        help='seconds without a heartbeat after which a node is out of the cluster')
+    parser.add_argument('--at-least-once', action='store_true',
+                        help='keep publishes until acknowledged and replay them after reconnect')
+    parser.add_argument('--max-unacked', type=int, default=256,
+                        help='max number of publishes waiting for ack with --at-least-once')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='size of the pool generating replies, 0 to reply on the stream thread')
+    parser.add_argument('--processes', action='store_true', help='use a process pool instead of threads')
+    parser.add_argument('--max-inflight', type=int, default=1024,
+                        help='max number of inbound messages queued or running on the pool')
+    parser.add_argument('--metrics-listen', default=None,
+                        help='address to serve Prometheus metrics on, e.g. 127.0.0.1:9464')
+    parser.add_argument('--plugin-workers', type=int, default=16,
+                        help='threads serving Plugin API calls from the Tinode server')
+    parser.add_argument('--plugin-max-rpcs', type=int, default=None,
+                        help='max number of Plugin API calls in progress, more are refused')
+    parser.add_argument('--plugin-limits', default=None,
+                        help='max calls running at once per Plugin API method, e.g. FireHose=64,Find=8')
+    parser.add_argument('--firehose-rules', default=None,
+                        help='JSON file of FireHose filtering rules, see firehose.Rule')
+    parser.add_argument('--find-index', default=None,
+                        help='answer fnd searches from a tag index kept in memory and snapshotted to this file')
+    parser.add_argument('--find-limit', type=int, default=20, help='max number of fnd search results')
+    parser.add_argument('--find-snapshot-interval', type=float, default=60.0,
+                        help='seconds between snapshots of the find index')
+    parser.add_argument('--mirror', default=None,
+                        help='mirror users, topics and subscriptions from plugin events, snapshotted to this file')
+    parser.add_argument('--mirror-snapshot-interval', type=float, default=300.0,
+                        help='seconds between snapshots of the mirror')
+    parser.add_argument('--autosub-rate', type=float, default=0,
+                        help='subscriptions per second to newly created users, 0 to wait for their presence')
+    parser.add_argument('--autosub-burst', type=int, default=50,
+                        help='max number of subscriptions to new users sent at once')
+    parser.add_argument('--log-level', default='INFO', help='DEBUG logs every message in and out')
+    parser.add_argument('--log-sample', default=None,
+                        help='keep one record in N per category, e.g. in=100,out=100')
     args = parser.parse_args()
+    log.setup(level=args.log_level, sample=log.parse_sample(args.log_sample))
 
     run(args)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# file: cluster.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+several bot nodes logged in as the same account, each answering its own topics.
+
+the nodes see the same presence on 'me'; a consistent hash ring of the
+live nodes decides which one owns a topic, and only the owner subscribes
+to it and replies in it. membership goes through a backend shared by the
+nodes, a directory of heartbeat files (FileMembership) or an in-process
+stand-in (LocalMembership):
+
+    cluster = ClusterNode('node-a', FileMembership('/var/run/tinode-bots'), subscriptions)
+    cluster.seed(saved_topics)     # restored from the previous run
+    cluster.start()
+    cluster.want('usrAlice')       # pres ON: subscribes only if node-a owns it
+    cluster.owns('usrAlice')       # check before replying to {data}
+
+when a node joins or goes silent the ring changes, and only the topics
+whose owner changed are left by the old owner and subscribed to by the
+new one. for the few seconds the nodes disagree on membership a topic
+may have two owners or none.
+"""
+import os
+import socket
+import threading
+import time
+
+from hashring import HashRing
+from log import get_logger
+
+logger = get_logger('cluster')
+
+
+class LocalMembership(object):
+    """in-process membership, for tests and several nodes in one process"""
+
+    def __init__(self, ttl=10.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # node id -> last heartbeat
+        self._members = {}
+
+    def join(self, node_id):
+        with self._lock:
+            self._members[node_id] = time.monotonic()
+
+    heartbeat = join
+
+    def leave(self, node_id):
+        with self._lock:
+            self._members.pop(node_id, None)
+
+    def members(self):
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            return set(node for node, seen in self._members.items() if seen >= cutoff)
+
+
+class FileMembership(object):
+    """one file per node in a directory shared by the nodes, touched on every heartbeat"""
+
+    def __init__(self, directory, ttl=10.0):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, node_id):
+        return os.path.join(self.directory, node_id + '.node')
+
+    def join(self, node_id):
+        tmp = self._path(node_id) + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('{} {}\n'.format(socket.gethostname(), os.getpid()))
+        os.replace(tmp, self._path(node_id))
+
+    def heartbeat(self, node_id):
+        try:
+            os.utime(self._path(node_id))
+        except FileNotFoundError:
+            self.join(node_id)
+
+    def leave(self, node_id):
+        try:
+            os.remove(self._path(node_id))
+        except FileNotFoundError:
+            pass
+
+    def members(self):
+        cutoff = time.time() - self.ttl
+        members = set()
+        for name in os.listdir(self.directory):
+            if not name.endswith('.node'):
+                continue
+            try:
+                if os.stat(os.path.join(self.directory, name)).st_mtime >= cutoff:
+                    members.add(name[:-len('.node')])
+            except FileNotFoundError:
+                pass
+        return members
+
+
+class ClusterNode(object):
+    def __init__(self, node_id, membership, subscriptions, replicas=100, interval=2.0, pinned=('me',)):
+        """subscriptions is the node's SubscriptionManager"""
+        self.node_id = node_id
+        self.membership = membership
+        self.subscriptions = subscriptions
+        self.replicas = replicas
+        self.interval = interval
+        self.pinned = frozenset(pinned)
+
+        self._lock = threading.Lock()
+        self.ring = HashRing([node_id], replicas)
+        # topics some peer presence asked for or restored by seed(), owned or not, until presence OFF
+        self.wanted = set()
+        self._stopped = threading.Event()
+
+        self.rebalances = 0
+        self.moved_in = 0
+        self.moved_out = 0
+
+    def owns(self, topic):
+        return topic in self.pinned or self.ring.node_for(topic) == self.node_id
+
+    def want(self, topic, remember=True):
+        """presence ON/MSG: remember the topic, subscribe if it is ours.
+
+        remember=False only subscribes, for topics no presence OFF may ever
+        release (a new account that never comes online): they are not taken
+        over again by a rebalance.
+        """
+        if remember:
+            with self._lock:
+                self.wanted.add(topic)
+        if self.owns(topic):
+            return self.subscriptions.want(topic)
+        return None
+
+    def seed(self, topics):
+        """topics wanted before any presence said so, e.g. restored from the previous run"""
+        with self._lock:
+            self.wanted.update(topic for topic in topics if topic not in self.pinned)
+
+    def release(self, topic):
+        """presence OFF"""
+        with self._lock:
+            self.wanted.discard(topic)
+        self.subscriptions.release(topic)
+
+    def rebalance(self, members):
+        """adopt the ring of `members`, moving only the topics whose owner changed"""
+        members = set(members)
+        members.add(self.node_id)
+        if members == self.ring.nodes:
+            return False
+        ring = HashRing(members, self.replicas)
+        with self._lock:
+            self.ring = ring
+            wanted = list(self.wanted)
+        lost = [topic for topic in self.subscriptions if not self.owns(topic)]
+        gained = [topic for topic in wanted if self.owns(topic) and topic not in self.subscriptions]
+        for topic in lost:
+            self.subscriptions.drop(topic)
+        for topic in gained:
+            self.subscriptions.want(topic)
+        self.rebalances += 1
+        self.moved_out += len(lost)
+        self.moved_in += len(gained)
+        logger.info("Cluster of %d nodes %s: %d topics handed over, %d taken", len(members), sorted(members),
+                    len(lost), len(gained))
+        return True
+
+    def tick(self):
+        self.membership.heartbeat(self.node_id)
+        self.rebalance(self.membership.members())
+
+    def start(self):
+        # subscribed before joining, they are taken over again if lost and regained
+        self.seed(self.subscriptions)
+        self.membership.join(self.node_id)
+        self.rebalance(self.membership.members())
+
+        def run():
+            while not self._stopped.wait(self.interval):
+                try:
+                    self.tick()
+                except Exception:
+                    logger.exception("Cluster heartbeat failed")
+
+        t = threading.Thread(target=run, name='cluster', daemon=True)
+        t.start()
+        return t
+
+    def stop(self):
+        self._stopped.set()
+        self.membership.leave(self.node_id)
+
+    def stats(self):
+        return {
+            'node': self.node_id,
+            'members': sorted(self.ring.nodes),
+            'wanted': len(self.wanted),
+            'rebalances': self.rebalances,
+            'moved_in': self.moved_in,
+            'moved_out': self.moved_out,
+        }
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# file: corpus.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+read-only list of strings in shared memory, e.g. the quotes corpus.
+
+the supervisor loads the file once, the worker processes attach to the
+segment by name and decode a line only when it is used, so N workers
+share one copy instead of holding N lists of str:
+
+    corpus = SharedCorpus.from_file('quotes.txt')    # supervisor
+    worker = SharedCorpus.attach(corpus.name)        # in each worker
+    worker.random()
+    corpus.unlink()                                  # supervisor, at exit
+
+the layout is the line count, count + 1 offsets, then the utf-8 lines.
+"""
+import random
+import struct
+from multiprocessing import shared_memory
+
+_COUNT = struct.Struct('<I')
+
+
+class SharedCorpus(object):
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.owner = owner
+        buf = shm.buf
+        self.count = _COUNT.unpack_from(buf, 0)[0]
+        self._offsets = buf[_COUNT.size:_COUNT.size + 4 * (self.count + 1)].cast('I')
+        self._data = _COUNT.size + 4 * (self.count + 1)
+
+    @classmethod
+    def create(cls, lines):
+        encoded = [line.encode('utf-8') for line in lines]
+        offsets = [0]
+        for line in encoded:
+            offsets.append(offsets[-1] + len(line))
+        header = _COUNT.pack(len(encoded)) + struct.pack('<{}I'.format(len(offsets)), *offsets)
+        blob = b''.join(encoded)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(header) + len(blob)))
+        shm.buf[:len(header)] = header
+        shm.buf[len(header):len(header) + len(blob)] = blob
+        return cls(shm, owner=True)
+
+    @classmethod
+    def from_file(cls, file_name):
+        with open(file_name, encoding='utf-8') as f:
+            return cls.create([line.strip() for line in f])
+
+    @classmethod
+    def attach(cls, name):
+        # processes started by multiprocessing share the creator's resource tracker, which keeps
+        # one registration per name: the segment lives until the creator unlinks it
+        return cls(shared_memory.SharedMemory(name=name))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError('corpus index out of range')
+        start = self._data + self._offsets[idx]
+        return bytes(self.shm.buf[start:self._data + self._offsets[idx + 1]]).decode('utf-8')
+
+    def random(self):
+        return self[random.randrange(self.count)] if self.count else ''
+
+    def close(self):
+        self._offsets.release()
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        if self.owner:
+            self.shm.unlink()
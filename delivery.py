@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# file: delivery.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+at-least-once delivery of {pub}.
+
+every tracked publish is stamped with an idempotency key in
+ClientPub.head[IDEMPOTENCY_KEY] and kept in a bounded window until the
+server acknowledges it. whatever is still in the window when the stream
+dies is sent again, with the same key, on the next session. receivers drop
+replays they already handled with Deduplicator.
+
+track() never blocks: it is called from the stream reading thread, the very
+thread that reads the acks. a publish finding the window full waits in a
+queue of `max_waiting` and is sent by ack() once a slot is free; past that
+it is shed with WindowFull. both are counted in `registry`.
+"""
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from log import get_logger
+from metrics import Registry
+
+logger = get_logger('delivery')
+
+AT_MOST_ONCE = 'at-most-once'
+AT_LEAST_ONCE = 'at-least-once'
+
+IDEMPOTENCY_KEY = 'idem'
+
+
+class WindowFull(Exception):
+    pass
+
+
+class LatencyStats(object):
+    """latency samples of the last `size` requests"""
+
+    def __init__(self, size=1024):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': max(self.samples) if self.samples else 0.0,
+        }
+
+
+class AckWindow(object):
+    def __init__(self, max_unacked=256, max_waiting=None, registry=None, prefix='tinode_bot'):
+        """max_waiting publishes may wait for a slot, 16 * max_unacked when None"""
+        self.max_unacked = max_unacked
+        self.max_waiting = 16 * max_unacked if max_waiting is None else max_waiting
+
+        self._lock = threading.Lock()
+        # idempotency key -> (msg, time first sent), oldest first
+        self._unacked = OrderedDict()
+        # (key, msg, send) of the publishes waiting for a slot
+        self._waiting = deque()
+        # per thread: publishes admitted while that thread is already sending, see _send()
+        self._local = threading.local()
+
+        self.latency = LatencyStats()
+        self.acked = 0
+        self.rejected = 0
+        self.replayed = 0
+
+        r = self.registry = registry if registry is not None else Registry()
+        r.gauge(prefix + '_publishes_unacked', 'publishes sent and waiting for their ack').set_function(self.__len__)
+        r.gauge(prefix + '_publishes_waiting', 'publishes waiting for a slot in the ack window') \
+            .set_function(lambda: len(self._waiting))
+        self.deferred = r.counter(prefix + '_publishes_deferred_total', 'publishes which found the ack window full')
+        self.shed = r.counter(prefix + '_publishes_shed_total', 'publishes dropped, ack window and its queue full')
+
+    def __len__(self):
+        return len(self._unacked)
+
+    def track(self, msg, send):
+        """stamp msg with an idempotency key and keep it until ack().
+
+        send(msg, key) posts it: at once when the window has room, returning
+        what send returns, otherwise from ack() once a slot is free, and
+        track() returns None. raises WindowFull when the queue of publishes
+        waiting for a slot is full too.
+        """
+        head = msg.pub.head
+        key = head.get(IDEMPOTENCY_KEY)
+        if key is None:
+            key = json.dumps(uuid.uuid4().hex)
+            head[IDEMPOTENCY_KEY] = key
+        with self._lock:
+            if key not in self._unacked:
+                if len(self._unacked) >= self.max_unacked or self._waiting:
+                    if len(self._waiting) >= self.max_waiting:
+                        self.shed.inc()
+                        raise WindowFull('{} publishes waiting for ack, {} for a slot'.format(
+                            len(self._unacked), len(self._waiting)))
+                    self._waiting.append((key, msg, send))
+                    self.deferred.inc()
+                    return None
+                self._unacked[key] = (msg, time.monotonic())
+        return send(msg, key)
+
+    def ack(self, key, ok=True):
+        """the server answered the publish, ok=False when it refused it for good"""
+        admitted = []
+        with self._lock:
+            entry = self._unacked.pop(key, None)
+            if entry is None:
+                return
+            now = time.monotonic()
+            while self._waiting and len(self._unacked) < self.max_unacked:
+                waiting = self._waiting.popleft()
+                self._unacked[waiting[0]] = (waiting[1], now)
+                admitted.append(waiting)
+        if ok:
+            self.acked += 1
+            self.latency.add(now - entry[1])
+        else:
+            self.rejected += 1
+        if admitted:
+            self._send(admitted)
+
+    def _send(self, admitted):
+        # a send failing at once acks with ok=False, which admits and sends the next one: queue those
+        # up for the outermost call instead of recursing once per waiting publish
+        queued = getattr(self._local, 'queued', None)
+        if queued is not None:
+            queued.extend(admitted)
+            return
+        queued = self._local.queued = deque(admitted)
+        try:
+            while queued:
+                key, msg, send = queued.popleft()
+                try:
+                    send(msg, key)
+                except Exception as err:
+                    logger.warning("Failed to send publish %s: %s", key, err)
+                    self.ack(key, ok=False)
+        finally:
+            self._local.queued = None
+
+    def unacked(self):
+        """publishes to send again after a reconnect, in their original order.
+
+        those waiting for a slot are not included, ack() sends them as usual.
+        """
+        with self._lock:
+            messages = [msg for msg, _ in self._unacked.values()]
+        self.replayed += len(messages)
+        return messages
+
+    def stats(self):
+        result = {
+            'unacked': len(self._unacked),
+            'acked': self.acked,
+            'rejected': self.rejected,
+            'replayed': self.replayed,
+            'waiting': len(self._waiting),
+            'deferred': self.deferred.value,
+            'shed': self.shed.value,
+        }
+        result.update(('ack_' + k, v) for k, v in self.latency.stats().items())
+        return result
+
+
+class Deduplicator(object):
+    """remembers the idempotency keys of the last `size` inbound messages"""
+
+    def __init__(self, size=4096):
+        self.size = size
+        self._seen = OrderedDict()
+        self.duplicates = 0
+
+    def is_duplicate(self, data):
+        key = data.head.get(IDEMPOTENCY_KEY)
+        if key is None:
+            return False
+        key = (data.topic, key)
+        if key in self._seen:
+            self.duplicates += 1
+            return True
+        self._seen[key] = True
+        if len(self._seen) > self.size:
+            self._seen.popitem(last=False)
+        return False
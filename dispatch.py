@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# file: dispatch.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+handler registry for inbound ServerMsg.
+
+handlers are registered per oneof (ctrl, data, pres, meta, info) and
+optionally per exact topic name ('me', 'fnd', 'usrXXXX') or topic prefix
+('usr', 'grp'). every matching handler is called with the oneof body, the
+exact topic ones first, then longest prefix to shortest, then the ones
+registered for any topic.
+
+    dispatcher = Dispatcher()
+
+    @dispatcher.on('data', prefix='grp')
+    def on_group_message(data):
+        ...
+
+registration compiles a lookup table, so dispatching costs one WhichOneof
+call and a couple of dict lookups per message.
+
+with `metrics` set to a metrics.BotMetrics every message is counted by
+type (and ctrl code) and its handlers are timed.
+"""
+import time
+
+ONEOFS = ('ctrl', 'data', 'pres', 'meta', 'info')
+
+
+class Dispatcher(object):
+    def __init__(self):
+        # (what, topic, prefix, func) in registration order
+        self._handlers = []
+        # what -> (exact topic -> handlers, prefix -> handlers, prefix lengths longest first, any topic handlers)
+        self._table = {}
+        self.unhandled = 0
+        self.metrics = None
+
+    def register(self, what, func, topic=None, prefix=None):
+        if what not in ONEOFS:
+            raise ValueError('unknown ServerMsg type: {}'.format(what))
+        if topic is not None and prefix is not None:
+            raise ValueError('register by topic or by prefix, not both')
+        self._handlers.append((what, topic, prefix, func))
+        self._compile()
+        return func
+
+    def unregister(self, func):
+        self._handlers = [h for h in self._handlers if h[3] is not func]
+        self._compile()
+
+    def on(self, what, topic=None, prefix=None):
+        """decorator form of register()"""
+        return lambda func: self.register(what, func, topic=topic, prefix=prefix)
+
+    def has_handlers(self, what):
+        return what in self._table
+
+    def _compile(self):
+        table = {}
+        for what in ONEOFS:
+            handlers = [h for h in self._handlers if h[0] == what]
+            if not handlers:
+                continue
+            catch_all = tuple(h[3] for h in handlers if h[1] is None and h[2] is None)
+            prefix_names = set(h[2] for h in handlers if h[2] is not None)
+            # a prefix route also carries the handlers of every shorter prefix it starts with
+            prefixes = {}
+            for name in prefix_names:
+                matched = sorted((p for p in prefix_names if name.startswith(p)), key=len, reverse=True)
+                prefixes[name] = tuple(h[3] for p in matched for h in handlers if h[2] == p) + catch_all
+            exact = {}
+            for name in set(h[1] for h in handlers if h[1] is not None):
+                route = tuple(h[3] for h in handlers if h[1] == name)
+                for p in sorted(prefix_names, key=len, reverse=True):
+                    if name.startswith(p):
+                        route += prefixes[p]
+                        break
+                else:
+                    route += catch_all
+                exact[name] = route
+            lens = tuple(sorted(set(len(p) for p in prefix_names), reverse=True))
+            table[what] = (exact, prefixes, lens, catch_all)
+        self._table = table
+
+    def lookup(self, msg):
+        """returns (what, body, handlers) for msg, handlers is empty when nothing matches"""
+        what = msg.WhichOneof('Message')
+        route = self._table.get(what)
+        if route is None:
+            return what, None, ()
+        body = getattr(msg, what)
+        exact, prefixes, lens, catch_all = route
+        topic = body.topic
+        handlers = exact.get(topic)
+        if handlers is None:
+            handlers = catch_all
+            for n in lens:
+                found = prefixes.get(topic[:n])
+                if found is not None:
+                    handlers = found
+                    break
+        return what, body, handlers
+
+    def dispatch(self, msg):
+        """call the handlers registered for msg, returns False when there were none"""
+        what, body, handlers = self.lookup(msg)
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.received(what, body)
+        if not handlers:
+            self.unhandled += 1
+            if metrics is not None:
+                metrics.unhandled.inc()
+            return False
+        if metrics is None:
+            for func in handlers:
+                func(body)
+            return True
+        started = time.perf_counter()
+        try:
+            for func in handlers:
+                func(body)
+        finally:
+            metrics.handled(what, time.perf_counter() - started)
+        return True
@@ -10,13 +10,13 @@ import sys
 
 from google.protobuf import json_format
 from gen_messages import *
+from dispatch import Dispatcher
+from pending import PendingRequests, message_id, on_success
+import log
 
 APP_NAME = "tn-cli"
 VERSION = "0.14"
 
-# Dictionary wich contains lambdas to be executed when server response is received
-onCompletion = {}
-
 # Saved topic: default topic name to make keyboard input easier
 SavedTopic = None
 
@@ -157,17 +157,19 @@ def serialize_cmd(string, mid):
         return None
 
 
-def gen_message(schema, secret):
+def gen_message(schema, secret, pending):
     """Client message generator: reads user input as string,
     converts to pb.ClientMsg, and yields"""
 
     random.seed()
     rid = random.randint(10000, 60000)
 
+    on_success(pending.add(str(rid)), print_server_params)
     yield msg_hi(rid)
 
     if schema is not None:
         rid += 1
+        on_success(pending.add(str(rid)), save_cookie)
         yield msg_login(rid, schema, secret)
 
     while True:
@@ -179,35 +181,43 @@ def gen_message(schema, secret):
             return
         cmd = serialize_cmd(inp, rid)
         if cmd is not None:
+            mid = message_id(cmd)
+            if mid is not None:
+                pending.add(mid)
             yield cmd
 
 
 def run(addr, schema, secret):
     channel = grpc.insecure_channel(addr)
     stub = pbx.NodeStub(channel)
+    pending = PendingRequests()
+    dispatcher = Dispatcher()
+
+    @dispatcher.on('ctrl')
+    def on_ctrl(ctrl):
+        # Run code on command completion
+        pending.resolve(ctrl)
+        print(str(ctrl.code) + " " + ctrl.text)
+
+    @dispatcher.on('data')
+    def on_data(data):
+        print("\n收到消息: " + data.from_user_id + ":\n")
+        print(json.loads(data.content) + "\n")
+
+    dispatcher.register('pres', lambda pres: None)
+
     # Call the server
-    stream = stub.MessageLoop(gen_message(schema, secret))
+    stream = stub.MessageLoop(gen_message(schema, secret, pending))
     try:
         # Read server responses
         for msg in stream:
-            if msg.HasField("ctrl"):
-                # Run code on command completion
-                func = onCompletion.get(msg.ctrl.id)
-                if func is not None:
-                    del onCompletion[msg.ctrl.id]
-                    if 200 <= msg.ctrl.code < 400:
-                        func(msg.ctrl.params)
-                print(str(msg.ctrl.code) + " " + msg.ctrl.text)
-            elif msg.HasField("data"):
-                print("\n收到消息: " + msg.data.from_user_id + ":\n")
-                print(json.loads(msg.data.content) + "\n")
-            elif msg.HasField("pres"):
-                pass
-            else:
+            if not dispatcher.dispatch(msg):
                 print("Message type not handled", msg)
 
     except grpc._channel._Rendezvous as err:
         print(err)
+    finally:
+        pending.fail_all()
 
 
 if __name__ == '__main__':
@@ -221,6 +231,7 @@ if __name__ == '__main__':
     parser.add_argument('--login-cookie', action='store_true',
                         help='read token from cookie file and use it for authentication')
     args = parser.parse_args()
+    log.setup(level='INFO', fmt='%(message)s')
 
     print("Server '" + args.host + "'")
 
@@ -20,40 +20,92 @@
 this file provide method for login register and on message listening methods
 """
 from gen_messages import *
-import queue
-from concurrent import futures
-
-
-class Plugin(pbx.PluginServicer):
-    def Account(self, acc_event, context):
-        action = None
-        if acc_event.action == pb.CREATE:
-            action = "created"
-        elif acc_event.action == pb.UPDATE:
-            action = "updated"
-        elif acc_event.action == pb.DELETE:
-            action = "deleted"
-        else:
-            action = "unknown"
-
-        print("Account", action, ":", acc_event.user_id, acc_event.public)
+from pending import PendingRequests, RequestError, RequestTimeout, message_id, on_success
+from outbox import Outbox, OutboxFull, DROP_NOTES
+from executor import TopicExecutor
+from dispatch import Dispatcher
+from bootstrap import Bootstrap, load_topics, save_topics
+from reconnect import Backoff, retained, reissue, token_from_params
+from delivery import AckWindow, Deduplicator, WindowFull, AT_MOST_ONCE, AT_LEAST_ONCE, IDEMPOTENCY_KEY
+from log import get_logger, OneLine, IN, OUT
+from plugin import Plugin, log_account, serve as serve_plugin
+from autosub import AutoSubscriber
+import logging
+import threading
+import time
 
-        # TODO: subscribe to the new user.
-
-        return pb.Unused()
+logger = get_logger('elves')
+log_in = get_logger(IN)
+log_out = get_logger(OUT)
 
 
 class ElvesChatter(object):
-    def __init__(self, server_address):
+    def __init__(self, server_address, max_batch=64, max_linger=0.0, queue_size=10000, overflow=DROP_NOTES,
+                 workers=0, processes=False, max_inflight=1024, subscriptions_file=None, sub_window=64,
+                 delivery=AT_MOST_ONCE, max_unacked=256, metrics=None, plugin_limits=None, plugin_workers=16,
+                 plugin_max_rpcs=None):
         self.server_address = server_address
+        self.channel = None
         self.stub = None
         self.stream = None
 
         self.server = None
+        # Plugin API handlers, register more with bot.plugin.on('FireHose') etc. before connect()
+        # plugin_limits caps the calls of a method running at once, the server options apply in connect()
+        self.plugin = Plugin(limits=plugin_limits)
+        self.plugin.register('Account', log_account)
+        self.plugin_workers = plugin_workers
+        self.plugin_max_rpcs = plugin_max_rpcs
+
+        # credentials for reconnects, the token from the last successful login is preferred
+        self.user_name = None
+        self.password = None
+        self.token = None
+        self.stopped = False
+        self.reconnects = 0
 
-        self.queue_out = queue.Queue()
+        # outbound writer, hands queued messages to gRPC up to max_batch per wakeup
+        self.queue_out = Outbox(max_batch=max_batch, max_linger=max_linger, capacity=queue_size, policy=overflow,
+                                registry=metrics.registry if metrics is not None else None)
+        # ClientMsg id -> future of the ServerCtrl answering it, one table per connection
+        self.pending = PendingRequests()
         self.mid = random.randint(10000, 60000)
 
+        # inbound ServerMsg handlers, see on()
+        self.dispatcher = Dispatcher()
+        self.dispatcher.register('ctrl', self.pending.resolve)
+
+        # topics subscribed to, restored after login by a pipelined bootstrap
+        self.subscriptions_file = subscriptions_file
+        self.subscriptions = set(load_topics(subscriptions_file))
+        self.sub_window = sub_window
+        # set once login succeeded and the subscriptions are restored
+        self.ready = threading.Event()
+        # Bootstrap of the current session, None once its stream is gone
+        self._boot = None
+        self._boot_lock = threading.Lock()
+
+        # with at-least-once delivery publishes stay in the window until acked and are replayed after reconnect
+        self.acks = AckWindow(max_unacked=max_unacked, registry=metrics.registry if metrics is not None else None) \
+            if delivery == AT_LEAST_ONCE else None
+        # drops replays of messages already handled
+        self.dedup = Deduplicator()
+
+        # replies are generated on a pool when workers > 0, ordered per topic
+        self.workers = None
+        if workers:
+            self.workers = TopicExecutor(max_workers=workers, max_inflight=max_inflight, processes=processes)
+
+        # a metrics.BotMetrics counting and timing messages, None to skip the bookkeeping
+        self.metrics = metrics
+        if self.metrics is not None:
+            self.dispatcher.metrics = self.metrics
+            self.watch_metrics()
+
+    def watch_metrics(self):
+        # read at scrape time, self.queue_out is replaced on every reconnect
+        self.metrics.watch(queue_depth=lambda: len(self.queue_out), pending=lambda: len(self.pending))
+
     def next_id(self):
         self.mid += 1
         return str(self.mid)
@@ -61,22 +113,22 @@ class ElvesChatter(object):
     # ---------------- initial work -------------------
     def connect(self, listen):
         self.init_server(listen)
-        print('=> server initialized.')
+        logger.info('=> server initialized.')
         self.init_client()
-        print('=> client initialized.')
+        logger.info('=> client initialized.')
 
-    def init_server(self, listen):
-        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=16))
-        pbx.add_PluginServicer_to_server(Plugin(), self.server)
-        # I don't know what this listen doing?
-        self.server.add_insecure_port(listen)
-        self.server.start()
+    def init_server(self, listen, workers=None, maximum_concurrent_rpcs=None):
+        # the Tinode server connects here to call self.plugin, by default with the options of the constructor
+        self.server, _ = serve_plugin(self.plugin, listen, workers=workers or self.plugin_workers,
+                                      maximum_concurrent_rpcs=maximum_concurrent_rpcs or self.plugin_max_rpcs)
 
     def init_client(self):
-        channel = grpc.insecure_channel(self.server_address)
-        self.stub = pbx.NodeStub(channel)
+        # the channel reconnects by itself, it is kept for every new stream
+        if self.channel is None:
+            self.channel = grpc.insecure_channel(self.server_address)
+            self.stub = pbx.NodeStub(self.channel)
         # Call the server
-        print('=> init client will send an iterator to MessageLoop')
+        logger.debug('=> init client will send an iterator to MessageLoop')
         self.stream = self.stub.MessageLoop(self.msg_iter())
         self.client_post(self.hello())
         # self.client_post(subscribe('me'))
@@ -84,12 +136,8 @@ class ElvesChatter(object):
     # ---------------- initial work -------------------
 
     def msg_iter(self):
-        while True:
-            msg = self.queue_out.get()
-            # print('-- get one msg out from queue: ', msg)
-            if msg is None:
-                return
-            yield msg
+        # bound to the current outbox now, a reconnect gives the new stream a fresh one
+        return iter(self.queue_out)
 
     def register(self):
         pass
@@ -100,48 +148,252 @@ class ElvesChatter(object):
                                            ver=VERSION, lang="EN"))
 
     def login(self, user_name, password):
-        self.client_post(msg_login(mid=self.next_id(), scheme='basic', secret='', uname=user_name, password=password))
+        self.user_name = user_name
+        self.password = password
+        fut = self.client_post(msg_login(mid=self.next_id(), scheme='basic', secret='', uname=user_name,
+                                         password=password))
+        on_success(fut, save_cookie)
+        on_success(fut, self.save_token)
+        self.start_bootstrap(fut)
+        return fut
+
+    def save_token(self, params):
+        token = token_from_params(params)
+        if token is not None:
+            self.token = token
+
+    def resume(self):
+        """log in on a new stream with the saved token, falling back to user name and password"""
+        if self.token is None:
+            return self.login(self.user_name, self.password)
+
+        fut = self.client_post(pb.ClientMsg(login=pb.ClientLogin(id=self.next_id(), scheme='token',
+                                                                 secret=self.token)))
+        on_success(fut, self.save_token)
+
+        def fallback(f):
+            if f.cancelled() or f.exception() is None:
+                return
+            logger.warning('=> token login failed, using basic auth: %s', f.exception())
+            self.token = None
+            self.login(self.user_name, self.password)
+
+        fut.add_done_callback(fallback)
+        self.start_bootstrap(fut)
+        return fut
+
+    def start_bootstrap(self, login_future):
+        """re-subscribe to the saved topics in parallel once login_future succeeds, then set self.ready"""
+        # the bootstrap has an Event of its own: one finishing after its session ended must not set ready
+        boot = Bootstrap(self.subscribe, sorted(self.subscriptions), window=self.sub_window,
+                         on_ready=lambda subscribed: self._restored(boot))
+        with self._boot_lock:
+            self.ready.clear()
+            self._boot = boot
+        boot.start(login_future)
+        return boot
+
+    def _restored(self, boot):
+        with self._boot_lock:
+            if boot is self._boot:
+                self.ready.set()
+
+    def enable_autosub(self, rate=20.0, burst=50, window=64):
+        """subscribe to every user created from now on, fed by the Account plugin events"""
+        autosub = AutoSubscriber(self.subscribe, is_subscribed=self.subscriptions.__contains__, ready=self.ready,
+                                 rate=rate, burst=burst, window=window)
+        autosub.install(self.plugin)
+        autosub.start()
+        return autosub
+
+    def save_subscriptions(self):
+        save_topics(self.subscriptions_file, self.subscriptions)
+
+    def subscribe(self, topic):
+        fut = self.client_post(pb.ClientMsg(sub=pb.ClientSub(id=self.next_id(), topic=topic)))
+        on_success(fut, lambda params: self.subscriptions.add(topic))
+        return fut
+
+    def leave(self, topic):
+        fut = self.client_post(pb.ClientMsg(leave=pb.ClientLeave(id=self.next_id(), topic=topic)))
+        on_success(fut, lambda params: self.subscriptions.discard(topic))
+        return fut
 
     def publish(self, topic, text):
+        """returns the future of the ack, None when the publish waits for a slot in the ack window.
+
+        raises WindowFull when the ack window cannot take it either.
+        """
         mid = self.next_id()
-        self.client_post(pb.ClientMsg(pub=pb.ClientPub(id=mid, topic=topic, no_echo=True,
-                                                       content=json.dumps(text, ensure_ascii=False).encode('utf-8'))))
+        msg = pb.ClientMsg(pub=pb.ClientPub(id=mid, topic=topic, no_echo=True,
+                                            content=json.dumps(text, ensure_ascii=False).encode('utf-8')))
+        if self.acks is None:
+            return self.client_post(msg)
+        return self.acks.track(msg, self.send_tracked)
+
+    def send_tracked(self, msg, key):
+        """send a publish kept in the ack window, it leaves the window once the server answers"""
+        try:
+            fut = self.client_post(msg)
+        except OutboxFull:
+            self.acks.ack(key, ok=False)
+            raise
+
+        def done(f):
+            err = f.exception()
+            if err is None:
+                self.acks.ack(key)
+            elif isinstance(err, RequestError):
+                # the server refused it, sending it again would not help
+                self.acks.ack(key, ok=False)
+            elif isinstance(err, RequestTimeout) and not self.stopped:
+                self.send_tracked(reissue(msg, self.next_id()), key)
+            # lost with the connection: stays in the window until reconnect() replays it
+
+        fut.add_done_callback(done)
+        return fut
 
     def client_post(self, msg):
-        self.queue_out.put(msg)
+        """queue msg for sending, returns a future of the server reply or None for notes.
+
+        raises OutboxFull when the outbox overflow policy rejects the message.
+        """
+        mid = message_id(msg)
+        fut = self.pending.add(mid) if mid is not None else None
+        if log_out.isEnabledFor(logging.DEBUG):
+            log_out.debug('out: %s', OneLine(msg))
+        try:
+            self.queue_out.put(msg)
+        except OutboxFull as err:
+            if mid is not None:
+                self.pending.fail(mid, err)
+            raise
+        if self.metrics is not None:
+            self.metrics.sent(msg)
+        return fut
 
     @staticmethod
     def note_read(topic, seq):
         return pb.ClientMsg(note=pb.ClientNote(topic=topic, what=pb.READ, seq_id=seq))
 
+    @staticmethod
+    def reply(in_msg):
+        """generate the answer to in_msg, runs on the worker pool when there is one"""
+        # here is the inference
+        return '我知道你再说： ' + in_msg
+
+    # ---------------- reconnect -------------------
+    def run_forever(self, user_name, password, backoff=None, stable_after=60.0):
+        """log in and read messages until stop(), reconnecting with jittered exponential backoff"""
+        backoff = backoff or Backoff()
+        self.stopped = False
+        if self.stream is None:
+            self.init_client()
+        self.login(user_name, password)
+        while True:
+            started = time.monotonic()
+            self.on_message()
+            if self.stopped:
+                return
+            if time.monotonic() - started > stable_after:
+                backoff.reset()
+            delay = backoff.next()
+            logger.warning('=> disconnected, reconnecting in %.1fs', delay)
+            time.sleep(delay)
+            if self.stopped:
+                return
+            self.reconnect()
+
+    def reconnect(self):
+        """open a new stream on the same channel, log in again and replay unsent publishes"""
+        self.queue_out, leftovers = self.queue_out.renew()
+        # the ack window holds everything unacknowledged, sent or not
+        replay = self.acks.unacked() if self.acks is not None else retained(leftovers)
+        self.reconnects += 1
+        if self.metrics is not None:
+            self.metrics.reconnects.inc()
+        self.stream = self.stub.MessageLoop(self.msg_iter())
+        self.client_post(self.hello())
+        self.resume()
+        if replay:
+            # publishing needs the topics attached again, wait for the bootstrap
+            threading.Thread(target=self.replay_when_ready, args=(replay,), daemon=True).start()
+
+    def replay_when_ready(self, messages, timeout=60.0):
+        if not self.ready.wait(timeout):
+            logger.error('=> session not ready, dropping %d unsent messages', len(messages))
+            return
+        for msg in messages:
+            reissue(msg, self.next_id())
+            if self.acks is not None:
+                self.send_tracked(msg, msg.pub.head[IDEMPOTENCY_KEY])
+            else:
+                self.client_post(msg)
+
+    def stop(self):
+        self.stopped = True
+        self.queue_out.close()
+        if self.stream is not None:
+            self.stream.cancel()
+
+    # ---------------- reconnect -------------------
+
+    def on(self, what, topic=None, prefix=None):
+        """decorator registering a handler for inbound `what` (ctrl, data, pres, meta, info) messages,
+        optionally only for one topic or topic prefix:
+
+            @elves.on('data', prefix='grp')
+            def on_group_message(data):
+                ...
+
+        on_data() and on_pres() are used when no data/pres handler is registered.
+        """
+        return self.dispatcher.on(what, topic=topic, prefix=prefix)
+
+    def install_default_handlers(self):
+        if not self.dispatcher.has_handlers('data'):
+            self.dispatcher.register('data', self.on_data)
+        if not self.dispatcher.has_handlers('pres'):
+            self.dispatcher.register('pres', self.on_pres)
+
+    def on_pres(self, pres):
+        pass
+
+    def on_data(self, data):
+        if self.dedup.is_duplicate(data):
+            return
+        in_msg = data.content.decode('utf-8')
+        log_in.debug("收到消息: %s", in_msg)
+        topic = data.topic
+        if self.workers is None:
+            try:
+                self.publish(topic, self.reply(in_msg))
+            except WindowFull as err:
+                logger.warning('=> dropped reply to %s: %s', topic, err)
+        else:
+            self.workers.submit(topic, self.reply, in_msg, callback=lambda text: self.publish(topic, text))
+
     def on_message(self):
         try:
             # Read server responses
             if self.stream:
-                print('raw message: ', self.stream)
+                logger.debug('raw message: %s', self.stream)
+                self.install_default_handlers()
 
                 for msg in self.stream:
-                    print('in: ', msg)
-                    if msg.HasField("ctrl"):
-                        # Run code on command completion
-                        func = onCompletion.get(msg.ctrl.id)
-                        if func is not None:
-                            del onCompletion[msg.ctrl.id]
-                            if 200 <= msg.ctrl.code < 400:
-                                func(msg.ctrl.params)
-                        # print('got situation: ' + str(msg.ctrl.code) + " " + msg.ctrl.text)
-                    elif msg.HasField("data"):
-                        in_msg = msg.data.content.decode('utf-8')
-                        print("收到消息: " + in_msg)
-                        # here is the inference
-                        self.publish(msg.data.topic, '我知道你再说： ' + in_msg)
-                    elif msg.HasField("pres"):
-                        pass
-                    else:
-                        print("Message type not handled", msg)
+                    if log_in.isEnabledFor(logging.DEBUG):
+                        log_in.debug('in: %s', OneLine(msg))
+                    if not self.dispatcher.dispatch(msg):
+                        logger.info("Message type not handled: %s", OneLine(msg))
             else:
-                print('还没有登录， call login() first.')
+                logger.error('还没有登录， call login() first.')
                 exit()
 
         except Exception as err:
-            print('some error: ', err)
+            logger.error('some error: %s', err)
+        finally:
+            with self._boot_lock:
+                self._boot = None
+                self.ready.clear()
+            self.pending.fail_all()
+            self.save_subscriptions()
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+# file: elves_aio.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+asyncio version of ElvesChatter, built on grpc.aio.
+
+the outbound stream is fed from an asyncio.Queue and inbound ServerMsg are
+read with `async for`, so a bot costs no extra OS threads and many bots can
+share one event loop with the rest of the application's I/O. requests past
+their deadline are failed by a task of the reader, not by the sweeper
+thread of the pending table.
+
+it is a class of its own sharing the message builders and the handler
+registry with ElvesChatter, not a subclass: every request method is a
+coroutine. the threaded extras (worker pools, ack window, autosub,
+subscription bootstrap) are not available here.
+
+login/subscribe/publish return the request future from the pending table,
+await it with `await asyncio.wrap_future(fut)` once on_message is running.
+
+the queue holds at most `queue_size` messages and `overflow` picks what a
+post does when it is full, as for the Outbox: with DROP_NOTES or REJECT an
+incoming note is dropped, REJECT fails other messages with OutboxFull, and
+otherwise the post waits for room.
+"""
+import asyncio
+import inspect
+import logging
+import random
+import threading
+import time
+
+import grpc.aio
+
+from dispatch import Dispatcher
+from elves import ElvesChatter
+from gen_messages import *
+from outbox import BLOCK, DROP_NOTES, REJECT, OutboxFull
+from pending import PendingRequests, RequestError, SWEEP_INTERVAL, message_id, on_success
+from plugin import Plugin, log_account, serve as serve_plugin
+from reconnect import Backoff, retained, reissue, token_from_params
+from elves import logger, log_in, log_out
+from log import OneLine
+
+
+class AsyncElvesChatter(object):
+    def __init__(self, server_address, metrics=None, channel=None, queue_size=10000, overflow=DROP_NOTES):
+        self.server_address = server_address
+        self.stub = None
+        self.stream = None
+        self.server = None
+        # Plugin API handlers, register more with bot.plugin.on('FireHose') etc. before connect()
+        self.plugin = Plugin()
+        self.plugin.register('Account', log_account)
+
+        # credentials for reconnects, the token from the last successful login is preferred
+        self.user_name = None
+        self.password = None
+        self.token = None
+        self.stopped = False
+        self.reconnects = 0
+
+        # asyncio.Queue binds to the running loop, it is created in init_client()
+        self.queue_out = None
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.dropped_notes = 0
+        self.rejected = 0
+        # a grpc.aio channel shared with other bots (see bothost), it stays open on close()
+        self.channel = channel
+        self.own_channel = channel is None
+
+        # expired from on_message(), callbacks of the futures run on the event loop
+        self.pending = PendingRequests(sweep=False)
+        self.mid = random.randint(10000, 60000)
+        self.dispatcher = Dispatcher()
+        self.dispatcher.register('ctrl', self.pending.resolve)
+        # topics subscribed to
+        self.subscriptions = set()
+        # set once logged in
+        self.ready = threading.Event()
+
+        self.metrics = metrics
+        if self.metrics is not None:
+            self.dispatcher.metrics = self.metrics
+            self.watch_metrics()
+
+    # shared with the threaded bot
+    note_read = staticmethod(ElvesChatter.note_read)
+    reply = staticmethod(ElvesChatter.reply)
+
+    def next_id(self):
+        self.mid += 1
+        return str(self.mid)
+
+    def hello(self):
+        return msg_hi(self.next_id())
+
+    def on(self, what, topic=None, prefix=None):
+        """decorator registering a handler for inbound `what` messages, see ElvesChatter.on"""
+        return self.dispatcher.on(what, topic=topic, prefix=prefix)
+
+    def install_default_handlers(self):
+        if not self.dispatcher.has_handlers('data'):
+            self.dispatcher.register('data', self.on_data)
+
+    def init_server(self, listen, workers=16, maximum_concurrent_rpcs=None):
+        # the Tinode server connects here to call self.plugin
+        self.server, _ = serve_plugin(self.plugin, listen, workers=workers,
+                                      maximum_concurrent_rpcs=maximum_concurrent_rpcs)
+
+    # ---------------- initial work -------------------
+    async def connect(self, listen=None):
+        if listen:
+            self.init_server(listen)
+            logger.info('=> server initialized.')
+        await self.init_client()
+        logger.info('=> client initialized.')
+
+    def watch_metrics(self):
+        self.metrics.watch(queue_depth=lambda: self.queue_out.qsize() if self.queue_out is not None else 0,
+                           pending=lambda: len(self.pending))
+
+    async def init_client(self):
+        self.queue_out = asyncio.Queue(maxsize=self.queue_size)
+        if self.channel is None:
+            self.channel = grpc.aio.insecure_channel(self.server_address)
+        self.stub = pbx.NodeStub(self.channel)
+        self.stream = self.stub.MessageLoop(self.msg_iter())
+        await self.client_post(self.hello())
+
+    async def close(self):
+        if self.queue_out is not None:
+            try:
+                self.queue_out.put_nowait(None)
+            except asyncio.QueueFull:
+                # the stream is cancelled below anyway
+                pass
+        if self.stream is not None:
+            self.stream.cancel()
+        if self.channel is not None and self.own_channel:
+            await self.channel.close()
+        if self.server is not None:
+            self.server.stop(None)
+
+    # ---------------- reconnect -------------------
+    async def run_forever(self, user_name, password, backoff=None, stable_after=60.0):
+        """log in and read messages until stop(), reconnecting with jittered exponential backoff.
+
+        the threaded ElvesChatter.run_forever() blocks, this one runs on the event loop.
+        every new stream logs in with the saved token (user name and password
+        when refused), subscribes again to bot.subscriptions, and only then
+        sends the publishes left unsent by the dead one.
+        """
+        backoff = backoff or Backoff()
+        self.stopped = False
+        self.user_name = user_name
+        self.password = password
+        loop = asyncio.get_event_loop()
+        replay = []
+        while True:
+            started = loop.time()
+            reader = None
+            try:
+                await self.init_client()
+                # ctrl answers are resolved by the reader, it runs while the session is set up
+                reader = asyncio.ensure_future(self.on_message())
+                await self.resume()
+                await self.restore()
+                while replay:
+                    await self.client_post(reissue(replay.pop(0), self.next_id()))
+                await reader
+            except asyncio.CancelledError:
+                if not self.stopped:
+                    if reader is not None:
+                        reader.cancel()
+                    raise
+            except Exception:
+                logger.exception('=> session failed')
+            if reader is not None:
+                reader.cancel()
+            if self.stream is not None:
+                self.stream.cancel()
+            self.pending.fail_all()
+            if self.stopped:
+                return
+            replay = retained(self.unsent()) + replay
+            self.reconnects += 1
+            if self.metrics is not None:
+                self.metrics.reconnects.inc()
+            if loop.time() - started > stable_after:
+                backoff.reset()
+            delay = backoff.next()
+            logger.warning('=> disconnected, reconnecting in %.1fs', delay)
+            await asyncio.sleep(delay)
+            if self.stopped:
+                return
+
+    def unsent(self):
+        """take what the queue of a dead stream still holds"""
+        left = []
+        while self.queue_out is not None and not self.queue_out.empty():
+            left.append(self.queue_out.get_nowait())
+        return left
+
+    def stop(self):
+        self.stopped = True
+        if self.queue_out is not None:
+            try:
+                self.queue_out.put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+        if self.stream is not None:
+            self.stream.cancel()
+
+    # ---------------- reconnect -------------------
+
+    async def msg_iter(self):
+        while True:
+            msg = await self.queue_out.get()
+            if msg is None:
+                return
+            yield msg
+
+    async def client_post(self, msg):
+        """queue msg, raises OutboxFull when the REJECT policy refuses it"""
+        if self.queue_out.full() and self.overflow != BLOCK:
+            if msg.HasField('note'):
+                self.dropped_notes += 1
+                return None
+            if self.overflow == REJECT:
+                self.rejected += 1
+                raise OutboxFull('outbox full ({} queued)'.format(self.queue_out.qsize()))
+        mid = message_id(msg)
+        fut = self.pending.add(mid) if mid is not None else None
+        if log_out.isEnabledFor(logging.DEBUG):
+            log_out.debug('out: %s', OneLine(msg))
+        await self.queue_out.put(msg)
+        if self.metrics is not None:
+            self.metrics.sent(msg)
+        return fut
+
+    async def request(self, msg, timeout=None):
+        """send msg and wait for the ServerCtrl answering it"""
+        fut = await self.client_post(msg)
+        return await asyncio.wait_for(asyncio.wrap_future(fut), timeout)
+
+    async def login(self, user_name, password):
+        self.user_name = user_name
+        self.password = password
+        fut = await self.client_post(msg_login(mid=self.next_id(), scheme='basic', secret='',
+                                               uname=user_name, password=password))
+        on_success(fut, save_cookie)
+        on_success(fut, self._logged_in)
+        return fut
+
+    def _logged_in(self, params):
+        token = token_from_params(params)
+        if token is not None:
+            self.token = token
+        self.ready.set()
+
+    async def resume(self):
+        """log in with the saved token, or user name and password when it is refused; returns the ctrl.
+
+        raises RequestError when the login is refused, needs on_message() running.
+        """
+        if self.token is not None:
+            fut = await self.client_post(pb.ClientMsg(login=pb.ClientLogin(id=self.next_id(), scheme='token',
+                                                                           secret=self.token)))
+            on_success(fut, self._logged_in)
+            try:
+                return await asyncio.wrap_future(fut)
+            except RequestError as err:
+                logger.warning('=> token login failed, using basic auth: %s', err)
+                self.token = None
+        return await asyncio.wrap_future(await self.login(self.user_name, self.password))
+
+    async def restore(self):
+        """subscribe again to bot.subscriptions, a topic refused by the server is dropped from it"""
+        topics = sorted(self.subscriptions)
+        futures = [await self.subscribe(topic) for topic in topics]
+        results = await asyncio.gather(*(asyncio.wrap_future(fut) for fut in futures), return_exceptions=True)
+        for topic, result in zip(topics, results):
+            if isinstance(result, RequestError):
+                logger.warning('=> not subscribed to %s again: %s', topic, result)
+                self.subscriptions.discard(topic)
+            elif isinstance(result, BaseException):
+                # the stream is gone, the next one tries again
+                raise result
+
+    async def subscribe(self, topic):
+        fut = await self.client_post(pb.ClientMsg(sub=pb.ClientSub(id=self.next_id(), topic=topic)))
+        on_success(fut, lambda params: self.subscriptions.add(topic))
+        return fut
+
+    async def leave(self, topic):
+        fut = await self.client_post(pb.ClientMsg(leave=pb.ClientLeave(id=self.next_id(), topic=topic)))
+        on_success(fut, lambda params: self.subscriptions.discard(topic))
+        return fut
+
+    async def publish(self, topic, text):
+        mid = self.next_id()
+        msg = pb.ClientMsg(pub=pb.ClientPub(id=mid, topic=topic, no_echo=True,
+                                            content=json.dumps(text, ensure_ascii=False).encode('utf-8')))
+        return await self.client_post(msg)
+
+    def __aiter__(self):
+        return self.messages()
+
+    async def messages(self):
+        """async iterator over inbound ServerMsg"""
+        if self.stream is None:
+            raise RuntimeError('not connected, call connect() first.')
+        async for msg in self.stream:
+            yield msg
+
+    async def on_data(self, data):
+        in_msg = data.content.decode('utf-8')
+        log_in.debug("收到消息: %s", in_msg)
+        await self.publish(data.topic, self.reply(in_msg))
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            self.pending.expire()
+
+    async def on_message(self):
+        """read and dispatch inbound messages, handlers may be plain functions or coroutines"""
+        self.install_default_handlers()
+        sweeper = asyncio.ensure_future(self._sweep())
+        try:
+            async for msg in self:
+                if log_in.isEnabledFor(logging.DEBUG):
+                    log_in.debug('in: %s', OneLine(msg))
+                what, body, handlers = self.dispatcher.lookup(msg)
+                if self.metrics is not None:
+                    self.metrics.received(what, body)
+                if not handlers:
+                    if self.metrics is not None:
+                        self.metrics.unhandled.inc()
+                    logger.info("Message type not handled: %s", OneLine(msg))
+                    continue
+                started = time.perf_counter()
+                for func in handlers:
+                    res = func(body)
+                    if inspect.isawaitable(res):
+                        await res
+                if self.metrics is not None:
+                    self.metrics.handled(what, time.perf_counter() - started)
+
+        except grpc.aio.AioRpcError as err:
+            logger.error('some error: %s', err)
+        finally:
+            sweeper.cancel()
+            self.ready.clear()
+            self.pending.fail_all()
@@ -19,10 +19,12 @@
 """
 example to show how to using elves-py build chatbot server
 """
+import log
 from elves import ElvesChatter
 
 
 def main():
+    log.setup(level='INFO')
     elves = ElvesChatter(server_address='localhost:6061')
     elves.connect(listen='0.0.0.0:40051')
     elves.login(user_name='jintian', password='123456')
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# file: executor.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+worker pool for inbound message handlers.
+
+tasks submitted under the same key (the topic) run one after another in
+submission order, tasks under different keys run in parallel. at most
+`max_inflight` tasks are queued or running; submit() blocks beyond that,
+which stops the stream reader and lets gRPC flow control push back on the
+server instead of buffering without limit.
+
+with processes=True the handler and its arguments must be picklable, e.g.
+a module level function taking the decoded text, and the workers start
+with a fresh copy of the module: state it needs (a corpus of replies...)
+goes through `initializer(*initargs)`. callbacks always run in this
+process on a thread of their own, never on the threads of the pool, and
+before the next task of the same key is started.
+"""
+import threading
+from collections import deque
+from concurrent import futures
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from log import get_logger
+
+logger = get_logger('executor')
+
+
+class TopicExecutor(object):
+    def __init__(self, max_workers=8, max_inflight=1024, processes=False, executor=None, initializer=None,
+                 initargs=()):
+        if executor is None:
+            if processes:
+                executor = futures.ProcessPoolExecutor(max_workers=max_workers, initializer=initializer,
+                                                       initargs=initargs)
+            else:
+                executor = futures.ThreadPoolExecutor(max_workers=max_workers, initializer=initializer,
+                                                      initargs=initargs)
+        self.executor = executor
+        self.max_inflight = max_inflight
+
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        # key -> tasks waiting behind the one currently running for that key
+        self._queues = {}
+        self._inflight = 0
+        # finished tasks, settled one by one on the callback thread
+        self._finished = queue.Queue()
+        self._callbacks = threading.Thread(target=self._run_callbacks, name='executor-callbacks', daemon=True)
+        self._callbacks.start()
+
+        self.completed = 0
+        self.failed = 0
+
+    @property
+    def inflight(self):
+        return self._inflight
+
+    def submit(self, key, fn, *args, **kwargs):
+        """run fn(*args) in the pool after earlier tasks of `key`, then callback(result)"""
+        callback = kwargs.pop('callback', None)
+        self._slots.acquire()
+        task = (fn, args, callback)
+        with self._lock:
+            self._inflight += 1
+            waiting = self._queues.get(key)
+            if waiting is not None:
+                waiting.append(task)
+                return
+            self._queues[key] = deque()
+        self._start(key, task)
+
+    def _start(self, key, task):
+        fn, args, callback = task
+        try:
+            fut = self.executor.submit(fn, *args)
+        except Exception as err:
+            # executor shut down or broken, settle the task so the key is not stuck
+            fut = futures.Future()
+            fut.set_exception(err)
+        # done callbacks run on the pool's own threads, hand over at once
+        fut.add_done_callback(lambda f: self._finished.put((key, callback, f)))
+
+    def _run_callbacks(self):
+        while True:
+            item = self._finished.get()
+            if item is None:
+                return
+            self._done(*item)
+
+    def _done(self, key, callback, fut):
+        try:
+            err = fut.exception()
+            if err is not None:
+                self.failed += 1
+                logger.warning("Handler for %s failed: %s", key, err)
+            else:
+                self.completed += 1
+                if callback is not None:
+                    callback(fut.result())
+        except Exception:
+            # logged with its traceback
+            logger.exception("Callback for %s failed", key)
+        finally:
+            with self._lock:
+                self._inflight -= 1
+                if not self._inflight:
+                    self._idle.notify_all()
+                waiting = self._queues[key]
+                task = waiting.popleft() if waiting else None
+                if task is None:
+                    del self._queues[key]
+            self._slots.release()
+            # a broken executor fails the task at once, its result is queued rather than settled here
+            if task is not None:
+                self._start(key, task)
+
+    def shutdown(self, wait=True):
+        """with wait=True, tasks still queued behind their key are run first"""
+        if wait:
+            with self._idle:
+                while self._inflight:
+                    self._idle.wait()
+        self.executor.shutdown(wait=wait)
+        self._finished.put(None)
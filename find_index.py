@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# file: find_index.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+in-memory tag index answering the Find plugin call ('fnd' searches).
+
+users are indexed by the tags of their Account events, topics (which carry
+no tags in their events) by the words of the 'fn' in their public data;
+both are also found by the words of their 'fn'. queries follow the server:
+the terms of one SearchQuery element are alternatives separated by commas,
+separate elements must all match:
+
+    index = FindIndex(snapshot_file='find.json')
+    index.install(plugin)              # feeds on Account/Topic, answers Find
+    index.start_snapshots(60)
+
+    index.search(['alice,bob', 'travel'])  # (alice OR bob) AND travel
+
+results are ranked by the number of matching terms, tags weighing more
+than name words, and cut to `limit`. an empty index answers CONTINUE so
+the server runs its own search until the index has warmed up.
+"""
+import base64
+import json
+import os
+import threading
+
+import pbx.model_pb2 as pb
+from log import get_logger
+
+logger = get_logger('find')
+
+USER = 'user'
+TOPIC = 'topic'
+
+# score of a query term matching a tag, and matching a word of the name
+TAG_WEIGHT = 2
+WORD_WEIGHT = 1
+
+
+def normalize(term):
+    return term.strip().lower()
+
+
+def name_words(public):
+    """lower case words of the 'fn' in a public JSON blob"""
+    if not public:
+        return ()
+    try:
+        fn = json.loads(public).get('fn')
+    except (ValueError, AttributeError, UnicodeDecodeError):
+        return ()
+    if not isinstance(fn, str):
+        return ()
+    return tuple(set(w for w in (normalize(w) for w in fn.split()) if w))
+
+
+def parse_query(terms):
+    """SearchQuery.terms -> list of OR groups, every group must match"""
+    groups = []
+    for element in terms:
+        group = set(t for t in (normalize(t) for t in element.split(',')) if t)
+        if group:
+            groups.append(group)
+    return groups
+
+
+class Entry(object):
+    __slots__ = ('id', 'kind', 'tags', 'words', 'public')
+
+    def __init__(self, id, kind, tags, words, public):
+        self.id = id
+        self.kind = kind
+        self.tags = tags
+        self.words = words
+        self.public = public
+
+
+class FindIndex(object):
+    def __init__(self, limit=20, snapshot_file=None):
+        self.limit = limit
+        self.snapshot_file = snapshot_file
+
+        self._lock = threading.Lock()
+        # id -> Entry
+        self._entries = {}
+        # term -> {id: weight}
+        self._postings = {}
+        self._dirty = False
+        # bumped by every update, tells save() whether the index changed while it was writing
+        self._changes = 0
+        self._stopped = threading.Event()
+
+        self.queries = 0
+        self.answered = 0
+        if snapshot_file:
+            self.load(snapshot_file)
+
+    def __len__(self):
+        return len(self._entries)
+
+    # ---------------- updates -------------------
+    def put(self, id, kind, tags=(), public=b'', keep=False):
+        """add or replace an entry, keep=True keeps the indexed tags and public data which are left empty,
+        like mirror.Mirror.apply_account()"""
+        with self._lock:
+            old = self._entries.get(id)
+            tags = tuple(set(normalize(t) for t in tags if normalize(t)))
+            if keep and old is not None:
+                if not tags:
+                    tags = old.tags
+                if not public:
+                    public = old.public
+            if old is not None:
+                self._unindex(old)
+            entry = Entry(id, kind, tags, name_words(public), public)
+            self._entries[id] = entry
+            for term in entry.words:
+                self._postings.setdefault(term, {})[id] = WORD_WEIGHT
+            for term in entry.tags:
+                self._postings.setdefault(term, {})[id] = TAG_WEIGHT
+            self._changed()
+
+    def remove(self, id):
+        with self._lock:
+            old = self._entries.pop(id, None)
+            if old is not None:
+                self._unindex(old)
+                self._changed()
+
+    def _changed(self):
+        self._changes += 1
+        self._dirty = True
+
+    def _unindex(self, entry):
+        for term in entry.tags + entry.words:
+            posting = self._postings.get(term)
+            if posting is not None:
+                posting.pop(entry.id, None)
+                if not posting:
+                    del self._postings[term]
+
+    def on_account(self, event):
+        if event.action == pb.DELETE:
+            self.remove(event.user_id)
+        else:
+            self.put(event.user_id, USER, event.tags, event.public, keep=event.action == pb.UPDATE)
+
+    def on_topic(self, event):
+        if event.action == pb.DELETE:
+            self.remove(event.name)
+        else:
+            self.put(event.name, TOPIC, (), event.desc.public)
+
+    # ---------------- queries -------------------
+    def search(self, terms, exclude=None, limit=None):
+        """ids matching every OR group of `terms`, best first"""
+        groups = parse_query(terms)
+        if not groups:
+            return []
+        with self._lock:
+            # id -> score, one OR group at a time, smallest first to keep the candidate set small
+            sized = sorted(groups, key=lambda g: sum(len(self._postings.get(t, ())) for t in g))
+            scores = None
+            for group in sized:
+                matched = {}
+                for term in group:
+                    for id, weight in self._postings.get(term, {}).items():
+                        if scores is None or id in scores:
+                            matched[id] = matched.get(id, 0) + weight
+                if scores is None:
+                    scores = matched
+                else:
+                    scores = dict((id, scores[id] + s) for id, s in matched.items())
+                if not scores:
+                    return []
+            scores.pop(exclude, None)
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+            return [self._entries[id] for id, _ in ranked[:limit or self.limit]]
+
+    def find(self, query):
+        """Find plugin handler"""
+        self.queries += 1
+        if not self._entries:
+            return None
+        found = pb.SearchFound(status=pb.RESPOND)
+        for entry in self.search(query.terms, exclude=query.user_id):
+            sub = found.result.add(topic=entry.id, public=entry.public)
+            if entry.kind == USER:
+                sub.user_id = entry.id
+        self.answered += 1
+        return found
+
+    def install(self, plugin):
+        plugin.register('Account', self.on_account)
+        plugin.register('Topic', self.on_topic)
+        plugin.register('Find', self.find)
+
+    # ---------------- snapshots -------------------
+    def save(self, file_name=None):
+        file_name = file_name or self.snapshot_file
+        if not file_name:
+            return
+        with self._lock:
+            rows = [[e.id, e.kind, list(e.tags), base64.b64encode(e.public).decode('ascii')]
+                    for e in self._entries.values()]
+            changes = self._changes
+        tmp = file_name + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(rows, f)
+            os.replace(tmp, file_name)
+        except Exception as err:
+            # still dirty, the next snapshot tries again
+            logger.error("Failed to save find index: %s", err)
+            return
+        with self._lock:
+            if self._changes == changes:
+                self._dirty = False
+
+    def load(self, file_name):
+        if not os.path.exists(file_name):
+            return 0
+        try:
+            with open(file_name, 'r') as f:
+                rows = json.load(f)
+        except Exception as err:
+            logger.error("Failed to read find index: %s", err)
+            return 0
+        for id, kind, tags, public in rows:
+            self.put(id, kind, tags, base64.b64decode(public))
+        self._dirty = False
+        logger.info("Loaded %d find index entries", len(rows))
+        return len(rows)
+
+    def start_snapshots(self, interval=60.0):
+        """save the index every `interval` seconds when it changed, until stop()"""
+        def run():
+            while not self._stopped.wait(interval):
+                if self._dirty:
+                    self.save()
+
+        t = threading.Thread(target=run, name='find-snapshots', daemon=True)
+        t.start()
+        return t
+
+    def stop(self):
+        self._stopped.set()
+        if self._dirty:
+            self.save()
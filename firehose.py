@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+# file: firehose.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+rule engine for the FireHose plugin call, for spam and abuse filtering.
+
+a rule matches on the ClientMsg type, the topic (exact name or 'prefix*'),
+the session user, the session auth level and substrings of the {pub}
+content, and answers with a ServerResp built when the rule is added:
+
+    engine = RuleEngine([
+        Rule(what='pub', content=['buy now', 'free money'], action='drop'),
+        Rule(what='sub', topic='grpStaff*', auth_level='ANON', action='respond', code=403, text='forbidden'),
+        Rule(user_id='usrTrusted', action='continue'),
+    ])
+    engine.install(plugin)
+
+rules are tried in the order they were added and the first match wins; a
+'continue' rule whitelists. without a match the next FireHose handler runs.
+
+compile() indexes the rules by message type, then by user and exact topic,
+and turns every content substring into a single regex, so the cost of a
+call depends on the rules that could match the message, not on how many
+there are.
+"""
+import json
+import re
+
+import pbx.model_pb2 as pb
+
+ACTIONS = ('continue', 'drop', 'respond')
+WHATS = tuple(f.name for f in pb.ClientMsg.DESCRIPTOR.fields)
+# ClientMsg types with a topic field
+TOPIC_WHATS = frozenset(f.name for f in pb.ClientMsg.DESCRIPTOR.fields if 'topic' in f.message_type.fields_by_name)
+AUTH_LEVELS = dict(pb.Session.AuthLevel.items())
+
+
+def _as_tuple(value):
+    if value is None:
+        return ()
+    if isinstance(value, (str, bytes, int)):
+        return (value,)
+    return tuple(value)
+
+
+class Rule(object):
+    __slots__ = ('name', 'what', 'topic', 'prefix', 'user_ids', 'auth_levels', 'content', 'action', 'resp',
+                 'order', 'hits')
+
+    def __init__(self, what=None, topic=None, user_id=None, auth_level=None, content=None, action='drop',
+                 code=403, text='rejected', name=None):
+        """every given condition must hold; what, user_id, auth_level and content take one value or a list
+        of alternatives, topic is a name or a 'prefix*'"""
+        if action not in ACTIONS:
+            raise ValueError('unknown rule action: {}'.format(action))
+        self.name = name
+        self.what = _as_tuple(what)
+        for w in self.what:
+            if w not in WHATS:
+                raise ValueError('unknown ClientMsg type: {}'.format(w))
+        self.topic = None
+        self.prefix = None
+        if topic is not None and topic.endswith('*'):
+            self.prefix = topic[:-1]
+        else:
+            self.topic = topic
+        self.user_ids = frozenset(_as_tuple(user_id))
+        self.auth_levels = frozenset(AUTH_LEVELS[a] if isinstance(a, str) else a for a in _as_tuple(auth_level))
+        self.content = tuple(c.encode('utf-8') if isinstance(c, str) else c for c in _as_tuple(content))
+        self.action = action
+        if action == 'drop':
+            self.resp = pb.ServerResp(status=pb.DROP)
+        elif action == 'respond':
+            self.resp = pb.ServerResp(status=pb.RESPOND,
+                                      srvmsg=pb.ServerMsg(ctrl=pb.ServerCtrl(code=code, text=text)))
+        else:
+            self.resp = pb.ServerResp(status=pb.CONTINUE)
+        self.order = 0
+        self.hits = 0
+
+    @classmethod
+    def from_dict(cls, spec):
+        return cls(**spec)
+
+    def __repr__(self):
+        return 'Rule({})'.format(self.name or self.order)
+
+
+def load_rules(file_name):
+    """rules from a JSON list of Rule keyword arguments"""
+    with open(file_name, 'r') as f:
+        return [Rule.from_dict(spec) for spec in json.load(f)]
+
+
+def trie_regex(words):
+    """regex source matching any of `words`, longest first at a given position"""
+    trie = {}
+    for word in words:
+        node = trie
+        for b in bytearray(word):
+            node = node.setdefault(b, {})
+        node[None] = True
+
+    def emit(node):
+        alts = [re.escape(bytes(bytearray([b]))) + emit(child) for b, child in sorted(
+            (k, v) for k, v in node.items() if k is not None)]
+        if not alts:
+            return b''
+        group = alts[0] if len(alts) == 1 else b'(?:' + b'|'.join(alts) + b')'
+        if None in node:
+            # a word ends here, longer ones are preferred
+            return b'(?:' + group + b')?'
+        return group
+
+    return emit(trie)
+
+
+class _Table(object):
+    """the rules of one ClientMsg type, indexed by what they are keyed on"""
+    __slots__ = ('by_user', 'by_topic', 'by_content', 'rest')
+
+    def __init__(self):
+        self.by_user = {}
+        self.by_topic = {}
+        # rule order -> rule
+        self.by_content = {}
+        self.rest = ()
+
+
+class RuleEngine(object):
+    def __init__(self, rules=(), ignore_case=False):
+        self.ignore_case = ignore_case
+        self.rules = []
+        self._tables = {}
+        self._content_re = None
+        # matched substring -> orders of the rules it satisfies, including rules of its prefixes
+        self._content_rules = {}
+        self.calls = 0
+        self.matched = 0
+        for rule in rules:
+            self.add(rule, compile=False)
+        self.compile()
+
+    def add(self, rule, compile=True):
+        rule.order = len(self.rules)
+        self.rules.append(rule)
+        if compile:
+            self.compile()
+        return rule
+
+    def clear(self):
+        self.rules = []
+        self.compile()
+
+    def compile(self):
+        tables = {}
+        for what in WHATS:
+            table = _Table()
+            by_user, by_topic, by_content, rest = {}, {}, [], []
+            for rule in self.rules:
+                if rule.what and what not in rule.what:
+                    continue
+                # keyed on the most selective condition, the others are checked per call
+                if rule.user_ids:
+                    for uid in rule.user_ids:
+                        by_user.setdefault(uid, []).append(rule)
+                elif rule.topic is not None:
+                    by_topic.setdefault(rule.topic, []).append(rule)
+                elif rule.content:
+                    by_content.append(rule)
+                else:
+                    rest.append(rule)
+            if not (by_user or by_topic or by_content or rest):
+                continue
+            table.by_user = dict((k, tuple(v)) for k, v in by_user.items())
+            table.by_topic = dict((k, tuple(v)) for k, v in by_topic.items())
+            table.by_content = dict((rule.order, rule) for rule in by_content)
+            table.rest = tuple(rest)
+            tables[what] = table
+
+        words = {}
+        for rule in self.rules:
+            for word in rule.content:
+                word = word.lower() if self.ignore_case else word
+                words.setdefault(word, set()).add(rule.order)
+        content_rules = {}
+        for word in words:
+            orders = set()
+            for i in range(1, len(word) + 1):
+                orders |= words.get(word[:i], set())
+            content_rules[word] = frozenset(orders)
+        flags = re.IGNORECASE if self.ignore_case else 0
+        self._content_re = re.compile(b'(?=(' + trie_regex(words) + b'))', flags) if words else None
+        self._content_rules = content_rules
+        self._tables = tables
+
+    def _content_matches(self, content):
+        """orders of the rules whose content condition holds"""
+        if self._content_re is None or not content:
+            return frozenset()
+        found = set()
+        lower = self.ignore_case
+        for m in self._content_re.finditer(content):
+            word = m.group(1)
+            found |= self._content_rules[word.lower() if lower else word]
+        return found
+
+    def match(self, req):
+        """the first rule matching ClientReq `req`, None when there is none"""
+        self.calls += 1
+        msg = req.msg
+        what = msg.WhichOneof('Message')
+        table = self._tables.get(what)
+        if table is None:
+            return None
+        body = getattr(msg, what)
+        sess = req.sess
+        topic = body.topic if what in TOPIC_WHATS else ''
+
+        candidates = table.rest
+        user_rules = table.by_user.get(sess.user_id)
+        topic_rules = table.by_topic.get(topic)
+        content = body.content if what == 'pub' else b''
+        found = None
+        if table.by_content and content:
+            found = self._content_matches(content)
+            by_content = table.by_content
+            content_rules = tuple(by_content[order] for order in found if order in by_content)
+        else:
+            content_rules = ()
+        if user_rules or topic_rules or content_rules:
+            candidates = sorted(candidates + (user_rules or ()) + (topic_rules or ()) + content_rules,
+                                key=lambda r: r.order)
+        for rule in candidates:
+            if rule.topic is not None and rule.topic != topic:
+                continue
+            if rule.prefix is not None and not topic.startswith(rule.prefix):
+                continue
+            if rule.user_ids and sess.user_id not in rule.user_ids:
+                continue
+            if rule.auth_levels and sess.auth_level not in rule.auth_levels:
+                continue
+            if rule.content:
+                if found is None:
+                    found = self._content_matches(content)
+                if rule.order not in found:
+                    continue
+            rule.hits += 1
+            self.matched += 1
+            return rule
+        return None
+
+    def firehose(self, req):
+        """FireHose handler: the response of the matching rule, None to let the next handler decide"""
+        rule = self.match(req)
+        if rule is None:
+            return None
+        if rule.action != 'respond':
+            return rule.resp
+        # answer the request it replaces
+        resp = pb.ServerResp()
+        resp.CopyFrom(rule.resp)
+        what = req.msg.WhichOneof('Message')
+        body = getattr(req.msg, what)
+        if what != 'note':
+            resp.srvmsg.ctrl.id = body.id
+        if what in TOPIC_WHATS:
+            resp.srvmsg.ctrl.topic = body.topic
+        return resp
+
+    def install(self, plugin):
+        """run before the FireHose handlers already registered on `plugin`"""
+        plugin.register('FireHose', self.firehose, first=True)
+
+    def stats(self):
+        return {
+            'rules': len(self.rules),
+            'calls': self.calls,
+            'matched': self.matched,
+            'hits': dict((repr(r), r.hits) for r in self.rules if r.hits),
+        }
@@ -27,13 +27,13 @@ import os
 
 import pbx.model_pb2 as pb
 import pbx.model_pb2_grpc as pbx
+from log import get_logger
+
+logger = get_logger('messages')
 
 APP_NAME = "elves-py"
 VERSION = "0.14"
 
-# Dictionary wich contains lambdas to be executed when server response is received
-onCompletion = {}
-
 # Saved topic: default topic name to make keyboard input easier
 SavedTopic = None
 
@@ -54,7 +54,7 @@ def read_cookie():
         return params
 
     except Exception as err:
-        print("'elves-cookies'并不存在", err)
+        logger.warning("'elves-cookies'并不存在: %s", err)
         return None
 
 
@@ -67,14 +67,14 @@ def save_cookie(params_):
     for p in params_:
         nice[p] = json.loads(params_[p])
 
-    print("Authenticated as", nice.get('user'))
+    logger.info("Authenticated as %s", nice.get('user'))
 
     try:
         cookie = open('elves-cookie', 'w')
         json.dump(nice, cookie)
         cookie.close()
     except Exception as err:
-        print("Failed to save authentication cookie", err)
+        logger.error("Failed to save authentication cookie: %s", err)
 
 
 # Pack user's name and avatar into a vcard represented as json.
@@ -96,7 +96,7 @@ def make_vcard(fn, photofile):
                 # TODO: use mimetype.guess_type(ext) instead
                 card.photo.type = os.path.splitext(photofile)[1]
             except IOError as err:
-                print("Error opening '" + photofile + "'", err)
+                logger.error("Error opening '%s': %s", photofile, err)
 
         card = json.dumps(card)
 
@@ -105,7 +105,6 @@ def make_vcard(fn, photofile):
 
 # Constructing individual messages
 def msg_hi(mid):
-    onCompletion[str(mid)] = lambda params: print_server_params(params)
     return pb.ClientMsg(hi=pb.ClientHi(id=str(mid), user_agent=APP_NAME + "/" + VERSION + " gRPC-python",
                                        ver=VERSION, lang="EN"))
 
@@ -127,11 +126,11 @@ def msg_login(mid, scheme, secret, uname=None, password=None):
         if password is None:
             password = ''
         secret = str(uname) + ":" + str(password)
-    onCompletion[str(mid)] = lambda params: save_cookie(params)
     return pb.ClientMsg(login=pb.ClientLogin(id=str(mid), scheme=scheme, secret=secret.encode('utf-8')))
 
 
-def msg_get(mid, topic, desc, sub, data):
+def msg_get(mid, topic, desc, sub, data, since_id=0, before_id=0, limit=0):
+    """since_id, before_id and limit page the data: seq_ids from since_id up to before_id excluded"""
     what = []
     if desc:
         what.append("desc")
@@ -139,8 +138,10 @@ def msg_get(mid, topic, desc, sub, data):
         what.append("sub")
     if data:
         what.append("data")
-    return pb.ClientMsg(get=pb.ClientGet(id=str(mid), topic=topic,
-                                         query=pb.GetQuery(what=" ".join(what))))
+    query = pb.GetQuery(what=" ".join(what))
+    if data and (since_id or before_id or limit):
+        query.data.CopyFrom(pb.BrowseOpts(since_id=since_id, before_id=before_id, limit=limit))
+    return pb.ClientMsg(get=pb.ClientGet(id=str(mid), topic=topic, query=query))
 
 
 def msg_set(mid, topic, user, fn, photo, private, auth, anon, mode):
@@ -156,7 +157,7 @@ def msg_delete(mid, topic, what, param, hard):
         topic = param
         param = None
 
-    print(mid, topic, what, param, hard)
+    logger.debug('del %s %s %s %s %s', mid, topic, what, param, hard)
     enum_what = None
     before = None
     seq_list = None
@@ -167,7 +168,7 @@ def msg_delete(mid, topic, what, param, hard):
             seq_list = [pb.DelQuery(range=pb.SeqRange(low=1, hi=0x8FFFFFF))]
         elif param is not None:
             seq_list = [pb.DelQuery(seq_id=int(x.strip())) for x in param.split(',')]
-        print(seq_list)
+        logger.debug('del seq %s', seq_list)
 
     elif what == 'sub':
         enum_what = pb.ClientDel.SUB
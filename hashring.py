@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# file: hashring.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+consistent hash ring, to split bot accounts or topics between workers.
+
+every node is hashed to `replicas` points on a ring, a key belongs to the
+node of the first point at or after its own hash. adding or removing a
+node only moves the keys of that node, about 1/N of them:
+
+    ring = HashRing(['w0', 'w1', 'w2'])
+    ring.node_for('usrAlice')      # 'w1'
+    ring.add('w3')                 # only keys now owned by w3 move
+
+hashes are md5 based, so every process computes the same ring from the
+same node names, whatever PYTHONHASHSEED is.
+"""
+import bisect
+import hashlib
+import struct
+
+_POINT = struct.Struct('>Q')
+
+
+def key_hash(key):
+    if not isinstance(key, bytes):
+        key = str(key).encode('utf-8')
+    return _POINT.unpack_from(hashlib.md5(key).digest())[0]
+
+
+class HashRing(object):
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.nodes = set()
+        # sorted hashes of the points and the node of each one
+        self._points = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.replicas):
+            point = key_hash('{}#{}'.format(node, i))
+            idx = bisect.bisect(self._points, point)
+            self._points.insert(idx, point)
+            self._owners.insert(idx, node)
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        keep = [(p, o) for p, o in zip(self._points, self._owners) if o != node]
+        self._points = [p for p, _ in keep]
+        self._owners = [o for _, o in keep]
+
+    def node_for(self, key):
+        """owner of key, None on an empty ring"""
+        if not self._points:
+            return None
+        idx = bisect.bisect_left(self._points, key_hash(key))
+        if idx == len(self._points):
+            idx = 0
+        return self._owners[idx]
+
+    def assign(self, keys):
+        """node -> keys it owns, every node of the ring is present"""
+        shards = dict((node, []) for node in self.nodes)
+        for key in keys:
+            node = self.node_for(key)
+            if node is not None:
+                shards[node].append(key)
+        return shards
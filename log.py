@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# file: log.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+logging for the bots, on top of the stdlib logging module.
+
+every module logs to a category under 'tinode' ('tinode.in' for inbound
+messages, 'tinode.out' for outbound ones, 'tinode.conn', ...). messages
+use %-style arguments, so a protobuf is only turned into text when the
+record is actually written, and that happens on a background thread:
+callers only pay for putting the record on a queue.
+
+    log.setup(level='DEBUG', sample={'in': 100, 'out': 100})
+
+keeps one record in a hundred of the per-message categories. the libraries
+never call setup() themselves, scripts do.
+"""
+import logging
+import logging.handlers
+import sys
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+
+ROOT = 'tinode'
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+# categories logging every message, DEBUG only
+IN = 'in'
+OUT = 'out'
+
+_listener = None
+
+
+def get_logger(category):
+    return logging.getLogger(ROOT + '.' + category)
+
+
+class OneLine(object):
+    """formats a protobuf message on one line, only when the record is written"""
+    __slots__ = ('msg',)
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        from google.protobuf import text_format
+        return text_format.MessageToString(self.msg, as_one_line=True, as_utf8=True)
+
+
+class SampleFilter(logging.Filter):
+    """lets one record in `every` through, counting per logger"""
+
+    def __init__(self, every):
+        super(SampleFilter, self).__init__()
+        self.every = max(1, int(every))
+        self.seen = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        with self._lock:
+            self.seen += 1
+            keep = (self.seen - 1) % self.every == 0
+            if not keep:
+                self.dropped += 1
+        return keep
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler formatting in the listener thread instead of the caller's.
+
+    the stdlib one renders the message before queueing it; here only
+    exception info is rendered up front, so the arguments of a record must
+    not be changed after it is logged.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # a stalled writer never blocks the message loop
+            pass
+
+
+def parse_sample(text):
+    """'in=100,out=10' -> {'in': 100, 'out': 10}"""
+    sample = {}
+    for item in (text or '').split(','):
+        if item.strip():
+            category, every = item.split('=')
+            sample[category.strip()] = int(every)
+    return sample
+
+
+def setup(level='INFO', stream=None, fmt=FORMAT, sample=None, queue_size=10000):
+    """send the 'tinode' loggers through a queue to a writer thread.
+
+    sample maps a category to N, keeping one record in N of it. calling
+    setup() again replaces the previous configuration.
+    """
+    global _listener
+    shutdown()
+
+    handler = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    handler.setFormatter(logging.Formatter(fmt))
+    records = queue.Queue(queue_size)
+    _listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger(ROOT)
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(DeferredQueueHandler(records))
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    root.propagate = False
+
+    for category, every in (sample or {}).items():
+        logger = get_logger(category)
+        for old in [f for f in logger.filters if isinstance(f, SampleFilter)]:
+            logger.removeFilter(old)
+        logger.addFilter(SampleFilter(every))
+    return _listener
+
+
+def shutdown():
+    """write out what is queued and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
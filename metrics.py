@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+# file: metrics.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+counters, gauges and histograms in the Prometheus text format.
+
+the hot path only does arithmetic: a labelled child is looked up once and
+kept, every string is built when the registry is scraped, and gauges that
+mirror a queue or table size read it through a function at scrape time.
+
+    metrics = BotMetrics()
+    serve(metrics.registry, '127.0.0.1:9464')     # GET /metrics
+    bot = ElvesChatter('localhost:6061', metrics=metrics)
+
+updates are not locked, concurrent increments from several threads rely on
+the GIL and may very rarely lose a count.
+"""
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# seconds, from 100us to 10s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+ONEOFS = ('ctrl', 'data', 'pres', 'meta', 'info')
+CLIENT_ONEOFS = ('hi', 'acc', 'login', 'sub', 'leave', 'pub', 'get', 'set', 'del', 'note')
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def label_text(names, values, extra=''):
+    pairs = ['{}="{}"'.format(n, escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class CounterChild(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class GaugeChild(object):
+    __slots__ = ('value', 'func')
+
+    def __init__(self):
+        self.value = 0
+        self.func = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, func):
+        """report func() at scrape time instead of the set value"""
+        self.func = func
+
+    def get(self):
+        return self.func() if self.func is not None else self.value
+
+
+class HistogramChild(object):
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # counts[i] observations <= bounds[i] and > bounds[i-1], the last one is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """context manager observing the seconds spent in its block"""
+        return _Timer(self)
+
+
+class _Timer(object):
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.started)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        # label values -> child
+        self._children = {}
+        if not self.label_names:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """child for these label values, keep it instead of calling labels() per message"""
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError('{} expects labels {}'.format(self.name, self.label_names))
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def __getattr__(self, attr):
+        # a metric without labels behaves like its only child
+        if attr.startswith('_') or self.__dict__.get('label_names', True):
+            raise AttributeError(attr)
+        return getattr(self._children[()], attr)
+
+    def samples(self):
+        """(suffix, label text, value) of every child"""
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation.replace('\n', ' ')),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, labels, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, labels, format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return CounterChild()
+
+    def samples(self):
+        for values, child in sorted(self._children.items()):
+            yield '', label_text(self.label_names, values), child.value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return GaugeChild()
+
+    def samples(self):
+        for values, child in sorted(self._children.items()):
+            yield '', label_text(self.label_names, values), child.get()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labels)
+
+    def _new_child(self):
+        return HistogramChild(self.bounds)
+
+    def samples(self):
+        for values, child in sorted(self._children.items()):
+            total = 0
+            for bound, count in zip(self.bounds + (float('inf'),), child.counts):
+                total += count
+                le = 'le="{}"'.format('+Inf' if bound == float('inf') else format_value(bound))
+                yield '_bucket', label_text(self.label_names, values, le), total
+            yield '_sum', label_text(self.label_names, values), child.sum
+            yield '_count', label_text(self.label_names, values), child.count
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+class Registry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _add(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError('metric {} already registered'.format(metric.name))
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._add(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self._add(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, documentation, labels, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """every metric in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        return '\n'.join(m.render() for m in metrics) + '\n'
+
+    def snapshot(self):
+        """picklable copy of every sample, to send to another process (see MergedRegistry)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return [(m.name, m.kind, m.documentation, list(m.samples())) for m in metrics]
+
+
+def _merge(merged, snapshot, kinds=None):
+    """add the samples of snapshot into merged, name -> (kind, documentation, {(suffix, labels): value})"""
+    for name, kind, documentation, samples in snapshot:
+        if kinds is not None and kind not in kinds:
+            continue
+        # dicts keep the order the samples came in, buckets stay sorted by bound
+        values = merged.setdefault(name, (kind, documentation, {}))[2]
+        for suffix, labels, value in samples:
+            values[(suffix, labels)] = values.get((suffix, labels), 0) + value
+
+
+class MergedRegistry(object):
+    """sum of the registry snapshots of several processes, rendered like a Registry.
+
+    counters and histograms of a source that is gone are kept by retire(),
+    so the sums never go backwards when a process is restarted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # source -> snapshot
+        self._snapshots = {}
+        # counters and histograms of retired sources, merged
+        self._retired = {}
+
+    def update(self, source, snapshot):
+        with self._lock:
+            self._snapshots[source] = snapshot
+
+    def forget(self, source):
+        """drop everything source sent"""
+        with self._lock:
+            self._snapshots.pop(source, None)
+
+    def retire(self, source):
+        """source is gone: keep its last counter and histogram values, drop its gauges"""
+        with self._lock:
+            snapshot = self._snapshots.pop(source, None)
+            if snapshot is not None:
+                _merge(self._retired, snapshot, kinds=('counter', 'histogram'))
+
+    def render(self):
+        with self._lock:
+            snapshots = list(self._snapshots.values())
+            merged = dict((name, (kind, documentation, dict(values)))
+                          for name, (kind, documentation, values) in self._retired.items())
+        for snapshot in snapshots:
+            _merge(merged, snapshot)
+        lines = []
+        for name in sorted(merged):
+            kind, documentation, values = merged[name]
+            lines.append('# HELP {} {}'.format(name, documentation.replace('\n', ' ')))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for (suffix, labels), value in values.items():
+                lines.append('{}{}{} {}'.format(name, suffix, labels, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class BotMetrics(object):
+    """the metrics of one bot connection, with the hot labelled children resolved up front"""
+
+    def __init__(self, registry=None, prefix='tinode_bot'):
+        self.registry = registry if registry is not None else Registry()
+        r = self.registry
+        self.inbound = r.counter(prefix + '_inbound_messages_total', 'ServerMsg received, by type', ['type'])
+        self.outbound = r.counter(prefix + '_outbound_messages_total', 'ClientMsg queued for sending, by type',
+                                  ['type'])
+        self.ctrl_codes = r.counter(prefix + '_ctrl_responses_total', 'ServerCtrl received, by code', ['code'])
+        self.handler_latency = r.histogram(prefix + '_handler_seconds', 'time spent in inbound handlers, by type',
+                                           ['type'])
+        self.unhandled = r.counter(prefix + '_unhandled_messages_total', 'ServerMsg without a handler')
+        self.reconnects = r.counter(prefix + '_reconnects_total', 'streams opened again after a disconnect')
+        self.queue_depth = r.gauge(prefix + '_outbound_queue_depth', 'ClientMsg waiting in the outbox')
+        self.pending = r.gauge(prefix + '_pending_requests', 'requests waiting for their ServerCtrl')
+
+        self._inbound = dict((what, self.inbound.labels(what)) for what in ONEOFS)
+        self._outbound = dict((what, self.outbound.labels(what)) for what in CLIENT_ONEOFS)
+        self._latency = dict((what, self.handler_latency.labels(what)) for what in ONEOFS)
+        self._codes = {}
+
+    def watch(self, queue_depth=None, pending=None):
+        """functions returning the outbox depth and the pending table size, read at scrape time"""
+        if queue_depth is not None:
+            self.queue_depth.set_function(queue_depth)
+        if pending is not None:
+            self.pending.set_function(pending)
+
+    def received(self, what, body):
+        """count an inbound message, body is None when it had no handler"""
+        child = self._inbound.get(what)
+        if child is None:
+            child = self._inbound[what] = self.inbound.labels(what)
+        child.value += 1
+        if what == 'ctrl' and body is not None:
+            code = self._codes.get(body.code)
+            if code is None:
+                code = self._codes[body.code] = self.ctrl_codes.labels(body.code)
+            code.value += 1
+
+    def sent(self, msg):
+        what = msg.WhichOneof('Message')
+        child = self._outbound.get(what)
+        if child is None:
+            child = self._outbound[what] = self.outbound.labels(what)
+        child.value += 1
+
+    def handled(self, what, seconds):
+        child = self._latency.get(what)
+        if child is None:
+            child = self._latency[what] = self.handler_latency.labels(what)
+        child.observe(seconds)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(registry=None, listen='127.0.0.1:9464'):
+    """serve registry on http://listen/metrics from a daemon thread, returns the HTTPServer"""
+    host, port = listen.rsplit(':', 1)
+    handler = type('MetricsHandler', (_Handler,), {'registry': registry if registry is not None else REGISTRY})
+    server = _Server((host, int(port)), handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+# file: mirror.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+local mirror of the server's users, topics and subscriptions.
+
+it is built only from the Account, Topic and Subscription plugin events,
+so questions like "which topics is user X in" and "who is subscribed to
+topic Y" are answered from memory:
+
+    mirror = Mirror(snapshot_file='mirror.json', journal_file='mirror.log')
+    mirror.install(plugin)
+    mirror.start_snapshots(300)
+
+    mirror.topics_of('usrAlice')       # {'grpTrips', 'p2pXXXX', ...}
+    mirror.subscribers('grpTrips')     # {'usrAlice', 'usrBob', ...}
+
+with a journal file every event is appended to it as it arrives, under the
+same lock as it is applied so the journal has them in the order they were
+applied. a snapshot drops the part of the journal it covers, and load()
+replays the rest on top of it, so a restart loses nothing applied before it.
+a torn record at the end of the journal is cut off before appending again.
+"""
+import base64
+import json
+import os
+import struct
+import threading
+
+import pbx.model_pb2 as pb
+from log import get_logger
+
+logger = get_logger('mirror')
+
+# journal record kinds
+ACCOUNT = b'A'
+TOPIC = b'T'
+SUBSCRIPTION = b'S'
+EVENT_TYPES = {ACCOUNT: pb.AccountEvent, TOPIC: pb.TopicEvent, SUBSCRIPTION: pb.SubscriptionEvent}
+HEADER = struct.Struct('>cI')
+
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+class User(object):
+    __slots__ = ('id', 'public', 'tags', 'auth', 'anon')
+
+    def __init__(self, id, public=b'', tags=(), auth='', anon=''):
+        self.id = id
+        self.public = public
+        self.tags = tags
+        self.auth = auth
+        self.anon = anon
+
+    def row(self):
+        return [self.id, _b64(self.public), list(self.tags), self.auth, self.anon]
+
+
+class Topic(object):
+    __slots__ = ('name', 'public', 'seq_id', 'auth', 'anon')
+
+    def __init__(self, name, public=b'', seq_id=0, auth='', anon=''):
+        self.name = name
+        self.public = public
+        self.seq_id = seq_id
+        self.auth = auth
+        self.anon = anon
+
+    def row(self):
+        return [self.name, _b64(self.public), self.seq_id, self.auth, self.anon]
+
+
+class Subscription(object):
+    __slots__ = ('topic', 'user_id', 'read_id', 'recv_id', 'del_id', 'want', 'given')
+
+    def __init__(self, topic, user_id, read_id=0, recv_id=0, del_id=0, want='', given=''):
+        self.topic = topic
+        self.user_id = user_id
+        self.read_id = read_id
+        self.recv_id = recv_id
+        self.del_id = del_id
+        self.want = want
+        self.given = given
+
+    def row(self):
+        return [self.topic, self.user_id, self.read_id, self.recv_id, self.del_id, self.want, self.given]
+
+
+class Mirror(object):
+    def __init__(self, snapshot_file=None, journal_file=None):
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file
+
+        self._lock = threading.RLock()
+        self.users = {}
+        self.topics = {}
+        # (topic, user_id) -> Subscription
+        self.subs = {}
+        # user_id -> topics, topic -> user ids
+        self._user_topics = {}
+        self._topic_users = {}
+
+        self._journal = None
+        # one save() at a time, the snapshot is written outside self._lock
+        self._saving = threading.Lock()
+        self._dirty = False
+        self._stopped = threading.Event()
+        self.events = 0
+
+        if snapshot_file or journal_file:
+            self.load()
+        if journal_file:
+            self._journal = open(journal_file, 'ab')
+
+    # ---------------- queries -------------------
+    def topics_of(self, user_id):
+        with self._lock:
+            return set(self._user_topics.get(user_id, ()))
+
+    def subscribers(self, topic):
+        with self._lock:
+            return set(self._topic_users.get(topic, ()))
+
+    def subscription(self, topic, user_id):
+        return self.subs.get((topic, user_id))
+
+    def stats(self):
+        return {'users': len(self.users), 'topics': len(self.topics), 'subscriptions': len(self.subs),
+                'events': self.events}
+
+    # ---------------- events -------------------
+    def on_account(self, event):
+        self._handle(ACCOUNT, event, self.apply_account)
+
+    def on_topic(self, event):
+        self._handle(TOPIC, event, self.apply_topic)
+
+    def on_subscription(self, event):
+        self._handle(SUBSCRIPTION, event, self.apply_subscription)
+
+    def _handle(self, kind, event, apply):
+        data = event.SerializeToString() if self._journal is not None else None
+        with self._lock:
+            self._record(kind, data)
+            apply(event)
+
+    def install(self, plugin):
+        plugin.register('Account', self.on_account)
+        plugin.register('Topic', self.on_topic)
+        plugin.register('Subscription', self.on_subscription)
+
+    def apply_account(self, event):
+        with self._lock:
+            self.events += 1
+            self._dirty = True
+            uid = event.user_id
+            if event.action == pb.DELETE:
+                self.users.pop(uid, None)
+                for topic in list(self._user_topics.get(uid, ())):
+                    self._remove_sub(topic, uid)
+                return
+            user = self.users.get(uid)
+            if user is None:
+                user = self.users[uid] = User(uid)
+            if event.public:
+                user.public = event.public
+            if event.tags:
+                user.tags = tuple(event.tags)
+            if event.HasField('default_acs'):
+                user.auth = event.default_acs.auth
+                user.anon = event.default_acs.anon
+
+    def apply_topic(self, event):
+        with self._lock:
+            self.events += 1
+            self._dirty = True
+            name = event.name
+            if event.action == pb.DELETE:
+                self.topics.pop(name, None)
+                for uid in list(self._topic_users.get(name, ())):
+                    self._remove_sub(name, uid)
+                return
+            topic = self.topics.get(name)
+            if topic is None:
+                topic = self.topics[name] = Topic(name)
+            desc = event.desc
+            if desc.public:
+                topic.public = desc.public
+            if desc.seq_id > topic.seq_id:
+                topic.seq_id = desc.seq_id
+            if desc.HasField('defacs'):
+                topic.auth = desc.defacs.auth
+                topic.anon = desc.defacs.anon
+
+    def apply_subscription(self, event):
+        with self._lock:
+            self.events += 1
+            self._dirty = True
+            key = (event.topic, event.user_id)
+            if event.action == pb.DELETE:
+                self._remove_sub(*key)
+                return
+            sub = self.subs.get(key)
+            if sub is None:
+                sub = self.subs[key] = Subscription(*key)
+                self._user_topics.setdefault(event.user_id, set()).add(event.topic)
+                self._topic_users.setdefault(event.topic, set()).add(event.user_id)
+            # ids only move forward, events may arrive out of order
+            sub.read_id = max(sub.read_id, event.read_id)
+            sub.recv_id = max(sub.recv_id, event.recv_id)
+            sub.del_id = max(sub.del_id, event.del_id)
+            if event.HasField('mode'):
+                sub.want = event.mode.want or sub.want
+                sub.given = event.mode.given or sub.given
+
+    def _remove_sub(self, topic, user_id):
+        if self.subs.pop((topic, user_id), None) is None:
+            return
+        topics = self._user_topics.get(user_id)
+        if topics is not None:
+            topics.discard(topic)
+            if not topics:
+                del self._user_topics[user_id]
+        users = self._topic_users.get(topic)
+        if users is not None:
+            users.discard(user_id)
+            if not users:
+                del self._topic_users[topic]
+
+    # ---------------- persistence -------------------
+    def _record(self, kind, data):
+        # under self._lock
+        if self._journal is None or data is None:
+            return
+        self._journal.write(HEADER.pack(kind, len(data)) + data)
+        self._journal.flush()
+
+    def save(self):
+        """write a snapshot and drop the part of the journal it covers.
+
+        only copying the state holds the lock, events keep being applied and
+        journaled while the snapshot is serialized and written.
+        """
+        if not self.snapshot_file:
+            return
+        with self._saving:
+            with self._lock:
+                state = {
+                    'users': [u.row() for u in self.users.values()],
+                    'topics': [t.row() for t in self.topics.values()],
+                    'subs': [s.row() for s in self.subs.values()],
+                }
+                covered = self._journal.tell() if self._journal is not None else 0
+                self._dirty = False
+            tmp = self.snapshot_file + '.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(state, f)
+                os.replace(tmp, self.snapshot_file)
+            except Exception as err:
+                logger.error("Failed to save mirror snapshot: %s", err)
+                self._dirty = True
+                return
+            with self._lock:
+                if self._journal is not None:
+                    self._drop_journal_head(covered)
+
+    def _drop_journal_head(self, covered):
+        """keep only what was journaled after the first `covered` bytes, under self._lock"""
+        journal = self._journal
+        journal.flush()
+        with open(self.journal_file, 'r+b') as f:
+            f.seek(covered)
+            rest = f.read()
+            f.seek(0)
+            f.write(rest)
+            f.truncate(len(rest))
+        # reopened so that tell() reports the new end
+        journal.close()
+        self._journal = open(self.journal_file, 'ab')
+
+    def load(self):
+        """restore the last snapshot, then replay the journal written after it"""
+        with self._lock:
+            if self.snapshot_file and os.path.exists(self.snapshot_file):
+                try:
+                    with open(self.snapshot_file, 'r') as f:
+                        state = json.load(f)
+                except Exception as err:
+                    logger.error("Failed to read mirror snapshot: %s", err)
+                    state = {}
+                for uid, public, tags, auth, anon in state.get('users', ()):
+                    self.users[uid] = User(uid, base64.b64decode(public), tuple(tags), auth, anon)
+                for name, public, seq_id, auth, anon in state.get('topics', ()):
+                    self.topics[name] = Topic(name, base64.b64decode(public), seq_id, auth, anon)
+                for row in state.get('subs', ()):
+                    sub = Subscription(*row)
+                    self.subs[(sub.topic, sub.user_id)] = sub
+                    self._user_topics.setdefault(sub.user_id, set()).add(sub.topic)
+                    self._topic_users.setdefault(sub.topic, set()).add(sub.user_id)
+            replayed = 0
+            if self.journal_file and os.path.exists(self.journal_file):
+                apply = {ACCOUNT: self.apply_account, TOPIC: self.apply_topic, SUBSCRIPTION: self.apply_subscription}
+                with open(self.journal_file, 'r+b') as f:
+                    good = 0
+                    while True:
+                        header = f.read(HEADER.size)
+                        if len(header) < HEADER.size:
+                            break
+                        kind, size = HEADER.unpack(header)
+                        data = f.read(size)
+                        if len(data) < size or kind not in EVENT_TYPES:
+                            break
+                        try:
+                            event = EVENT_TYPES[kind].FromString(data)
+                        except Exception:
+                            break
+                        apply[kind](event)
+                        replayed += 1
+                        good = f.tell()
+                    size = f.seek(0, os.SEEK_END)
+                    if size > good:
+                        # torn write at the end: cut it off, or the records appended next would follow it unread
+                        logger.warning("Dropping %d bytes of torn journal records from %s", size - good,
+                                       self.journal_file)
+                        f.truncate(good)
+            self._dirty = replayed > 0
+            logger.info("Mirror loaded: %d users, %d topics, %d subscriptions, %d events replayed",
+                        len(self.users), len(self.topics), len(self.subs), replayed)
+
+    def start_snapshots(self, interval=300.0):
+        """snapshot every `interval` seconds when something changed, until stop()"""
+        def run():
+            while not self._stopped.wait(interval):
+                if self._dirty:
+                    self.save()
+
+        t = threading.Thread(target=run, name='mirror-snapshots', daemon=True)
+        t.start()
+        return t
+
+    def stop(self):
+        self._stopped.set()
+        if self._dirty:
+            self.save()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+# file: mock_server.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+fake Tinode Node server for local testing and load generation.
+
+it answers {hi} {login} {acc} {sub} {leave} {pub} {get} {set} {del} with
+the ctrl codes a real server uses, fans {pub} out to the subscribers of the
+topic as {data}, and can be scripted from python:
+
+    node = MockNode()
+    server, port = serve(node, '127.0.0.1:0')
+    node.presence('usrAlice', 'on')                   # bot subscribes to usrAlice
+    node.inject('usrAlice', 'hi there', count=10000, rate=5000)
+    node.latency = 0.05                               # delay every reply
+    node.disconnect()                                 # drop every session
+
+or run standalone: python mock_server.py --listen 127.0.0.1:6061 --rate 1000
+"""
+import argparse
+import base64
+import hashlib
+import json
+import threading
+import time
+from concurrent import futures
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import grpc
+
+import pbx.model_pb2 as pb
+import pbx.model_pb2_grpc as pbx
+
+PRES_WHAT = {
+    'on': pb.ServerPres.ON,
+    'off': pb.ServerPres.OFF,
+    'msg': pb.ServerPres.MSG,
+    'upd': pb.ServerPres.UPD,
+    'gone': pb.ServerPres.GONE,
+}
+
+
+def ctrl(mid, code, text, topic='', **params):
+    return pb.ServerMsg(ctrl=pb.ServerCtrl(id=mid, code=code, text=text, topic=topic,
+                                           params=dict((k, json.dumps(v).encode('utf-8'))
+                                                       for k, v in params.items())))
+
+
+class Session(object):
+    def __init__(self, node, sid):
+        self.node = node
+        self.sid = sid
+        self.user_id = None
+        self.topics = set()
+        self.out = queue.Queue()
+        self.received = 0
+
+    def send(self, msg):
+        # stamped with the time it is due: latency delays every message, it does not cap the rate
+        self.out.put((time.monotonic() + self.node.latency, msg))
+
+    def close(self):
+        self.send(None)
+
+    def responses(self):
+        while True:
+            due, msg = self.out.get()
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            if msg is None:
+                return
+            self.node.sent += 1
+            yield msg
+
+
+class MockNode(pbx.NodeServicer):
+    def __init__(self, on_message=None, latency=0.0, drop_after=0):
+        """on_message(session, msg) is called for every ClientMsg received.
+        drop_after > 0 disconnects a session after it sent that many messages."""
+        self.on_message = on_message
+        self.latency = latency
+        self.drop_after = drop_after
+
+        self.lock = threading.Lock()
+        self.sessions = {}
+        # topic -> sessions subscribed to it
+        self.subscribers = {}
+        # topic -> last seq_id
+        self.seq = {}
+        self.next_sid = 0
+
+        self.received = {}
+        self.sent = 0
+
+    # ---------------- grpc -------------------
+    def MessageLoop(self, request_iterator, context):
+        with self.lock:
+            self.next_sid += 1
+            sess = Session(self, 'sid{}'.format(self.next_sid))
+            self.sessions[sess.sid] = sess
+        reader = threading.Thread(target=self.read, args=(sess, request_iterator), daemon=True)
+        reader.start()
+        try:
+            for msg in sess.responses():
+                yield msg
+        finally:
+            self.forget(sess)
+
+    def read(self, sess, request_iterator):
+        try:
+            for msg in request_iterator:
+                self.handle(sess, msg)
+                sess.received += 1
+                if self.drop_after and sess.received >= self.drop_after:
+                    break
+        except grpc.RpcError:
+            pass
+        sess.close()
+
+    def forget(self, sess):
+        with self.lock:
+            self.sessions.pop(sess.sid, None)
+            for topic in sess.topics:
+                self.subscribers.get(topic, set()).discard(sess)
+
+    # ---------------- protocol -------------------
+    def handle(self, sess, msg):
+        what = msg.WhichOneof('Message')
+        self.received[what] = self.received.get(what, 0) + 1
+        if self.on_message is not None:
+            self.on_message(sess, msg)
+        if what is None:
+            # an empty ClientMsg, counted under None and otherwise ignored
+            return
+        body = getattr(msg, what)
+
+        if what == 'hi':
+            sess.send(ctrl(body.id, 201, 'created', ver='0.14', build='mock', sid=sess.sid))
+        elif what == 'login':
+            if body.scheme == 'basic':
+                uname = body.secret.decode('utf-8').split(':')[0]
+            elif body.scheme == 'token':
+                uname = body.secret.decode('utf-8')
+            else:
+                sess.send(ctrl(body.id, 401, 'authentication failed'))
+                return
+            sess.user_id = user_id(uname)
+            sess.send(ctrl(body.id, 200, 'ok', user=sess.user_id,
+                           token=base64.b64encode(uname.encode('utf-8')).decode('ascii'),
+                           expires='2099-01-01T00:00:00Z'))
+        elif what == 'acc':
+            sess.send(ctrl(body.id, 201, 'created', user=user_id(body.user_id or body.id)))
+        elif sess.user_id is None and what != 'note':
+            sess.send(ctrl(body.id, 401, 'authentication required'))
+        elif what == 'sub':
+            with self.lock:
+                fresh = body.topic not in sess.topics
+                sess.topics.add(body.topic)
+                self.subscribers.setdefault(body.topic, set()).add(sess)
+            if fresh:
+                sess.send(ctrl(body.id, 200, 'ok', topic=body.topic))
+            else:
+                sess.send(ctrl(body.id, 304, 'already subscribed', topic=body.topic))
+        elif what == 'leave':
+            with self.lock:
+                sess.topics.discard(body.topic)
+                self.subscribers.get(body.topic, set()).discard(sess)
+            sess.send(ctrl(body.id, 200, 'ok', topic=body.topic))
+        elif what == 'pub':
+            if body.topic not in sess.topics:
+                sess.send(ctrl(body.id, 403, 'must attach first', topic=body.topic))
+                return
+            seq = self.publish(body.topic, body.content, sess.user_id, dict(body.head),
+                               skip=sess if body.no_echo else None)
+            sess.send(ctrl(body.id, 202, 'accepted', topic=body.topic, seq=seq))
+        elif what in ('get', 'set', 'del'):
+            sess.send(ctrl(body.id, 200, 'ok', topic=body.topic))
+        # {note} is never answered
+
+    def publish(self, topic, content, from_user, head=None, skip=None, anyone=False):
+        """store-and-forward a message, returns its seq_id"""
+        with self.lock:
+            seq = self.seq.get(topic, 0) + 1
+            self.seq[topic] = seq
+            if anyone:
+                targets = [s for s in self.sessions.values() if s.user_id is not None]
+            else:
+                targets = list(self.subscribers.get(topic, ()))
+        msg = pb.ServerMsg(data=pb.ServerData(topic=topic, from_user_id=from_user or '', seq_id=seq,
+                                              head=head or {}, content=content))
+        for target in targets:
+            if target is not skip:
+                target.send(msg)
+        return seq
+
+    # ---------------- scripting -------------------
+    def inject(self, topic, text, count=1, rate=0, from_user=None, anyone=False):
+        """publish `count` messages to `topic` at `rate` messages per second (0 = as fast as possible).
+
+        with anyone=True they are sent to every logged in session, subscribed
+        or not. returns the thread doing it when rate > 0.
+        """
+        content = json.dumps(text, ensure_ascii=False).encode('utf-8')
+        from_user = from_user or topic
+
+        def run():
+            started = time.monotonic()
+            for i in range(count):
+                if rate:
+                    delay = started + float(i) / rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.publish(topic, content, from_user, anyone=anyone)
+
+        if not rate:
+            run()
+            return None
+        t = threading.Thread(target=run, daemon=True)
+        t.start()
+        return t
+
+    def presence(self, src, what='on'):
+        """report user `src` going on/off line to everybody subscribed to 'me'"""
+        msg = pb.ServerMsg(pres=pb.ServerPres(topic='me', src=src, what=PRES_WHAT[what]))
+        with self.lock:
+            targets = list(self.subscribers.get('me', ()))
+        for target in targets:
+            target.send(msg)
+
+    def disconnect(self, sid=None):
+        """end one session, or all of them"""
+        with self.lock:
+            targets = [self.sessions[sid]] if sid else list(self.sessions.values())
+        for sess in targets:
+            sess.close()
+
+
+def user_id(name):
+    return 'usr' + hashlib.md5(str(name).encode('utf-8')).hexdigest()[:11]
+
+
+def serve(node, listen='127.0.0.1:0', max_workers=64):
+    """start a loopback grpc server for `node`, returns (server, port)"""
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+    pbx.add_NodeServicer_to_server(node, server)
+    port = server.add_insecure_port(listen)
+    server.start()
+    return server, port
+
+
+if __name__ == '__main__':
+    purpose = "Mock Tinode server, for testing bots without a real one."
+    print(purpose)
+    parser = argparse.ArgumentParser(description=purpose)
+    parser.add_argument('--listen', default='127.0.0.1:6061', help='address to serve the Node API on')
+    parser.add_argument('--topic', default='usrMockPeer', help='peer the injected messages come from')
+    parser.add_argument('--rate', type=int, default=10, help='messages per second to inject once a bot logs in')
+    parser.add_argument('--count', type=int, default=1000, help='number of messages to inject')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to delay every server message')
+    parser.add_argument('--drop-after', type=int, default=0, help='disconnect sessions after this many messages')
+    args = parser.parse_args()
+
+    node = MockNode(latency=args.latency, drop_after=args.drop_after)
+    server, port = serve(node, args.listen)
+    print("Listening on port", port)
+    try:
+        while not any(s.user_id for s in list(node.sessions.values())):
+            time.sleep(0.2)
+        node.presence(args.topic, 'on')
+        time.sleep(0.5)
+        injector = node.inject(args.topic, 'hello from the mock server', count=args.count, rate=args.rate,
+                               anyone=True)
+        if injector is not None:
+            injector.join()
+        while True:
+            time.sleep(1)
+            print("received:", node.received, "sent:", node.sent)
+    except KeyboardInterrupt:
+        server.stop(None)
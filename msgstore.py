@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+# file: msgstore.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+append-only local store of the inbound {data}, keyed by topic and seq_id.
+
+messages are appended to memory mapped segment files of `segment_size`
+bytes. every topic keeps a small index in memory: the offsets of its last
+`keep` messages and the seq_ids seen so far, as a run of consecutive
+seq_ids plus the few seen outside it. what is below the first seq_id seen
+is unknown, not seen, so history fetched later is still accepted. so
+
+    store = MessageStore('history')
+    if store.append(data):          # False: that seq_id was seen already
+        handle(data)
+    store.last('usrAlice', 10)      # the last ten, as ServerData, oldest first
+    store.since('usrAlice')         # the run of seen seq_ids ends at this one
+
+cost O(1) per message, and memory depends on the number of topics, not on
+the history. once there are more than `max_segments` segments the oldest
+ones are compacted: the messages still indexed are copied forward, the
+rest is dropped with the files.
+
+a record is a header (payload length, crc32, kind, topic length, seq_id,
+from length) and topic + from + content. a zero length ends a
+segment, a bad crc is a torn write and ends it too. watermark records
+keep the seen seq_ids of a topic across compactions: the end of the run
+as seq_id, its start and the seq_ids seen outside it as content.
+"""
+import mmap
+import os
+import threading
+import struct
+import zlib
+from collections import OrderedDict
+
+import pbx.model_pb2 as pb
+from log import get_logger
+
+logger = get_logger('store')
+
+HEADER = struct.Struct('>IIBHQH')
+SEQ = struct.Struct('>Q')
+MESSAGE = 1
+WATERMARK = 2
+SUFFIX = '.seg'
+
+
+class _Segment(object):
+    __slots__ = ('id', 'path', 'file', 'map', 'size', 'tail')
+
+    def __init__(self, id, path, size):
+        self.id = id
+        self.path = path
+        exists = os.path.exists(path)
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self.file.truncate(size)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.tail = 0
+
+    def records(self):
+        """(offset, kind, topic, seq_id, from, content) up to the end of the valid records"""
+        buf = self.map
+        offset = 0
+        while offset + HEADER.size <= self.size:
+            length, crc, kind, topic_len, seq_id, from_len = HEADER.unpack_from(buf, offset)
+            end = offset + HEADER.size + length
+            if length == 0 or end > self.size:
+                break
+            payload = buf[offset + HEADER.size:end]
+            if zlib.crc32(payload) != crc:
+                logger.warning("Torn record in %s at %d, ignoring the rest of the segment", self.path, offset)
+                break
+            topic = payload[:topic_len].decode('utf-8')
+            from_user = payload[topic_len:topic_len + from_len].decode('utf-8')
+            yield offset, kind, topic, seq_id, from_user, payload[topic_len + from_len:]
+            offset = end
+        self.tail = offset
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class _TopicIndex(object):
+    __slots__ = ('start', 'low', 'extra', 'entries')
+
+    def __init__(self):
+        # every seq_id from start to low was seen, and the ones in `extra`, below start or above low
+        self.start = None
+        self.low = None
+        self.extra = set()
+        # seq_id -> (segment id, offset) of the last messages, oldest first
+        self.entries = OrderedDict()
+
+    def seen(self, seq_id):
+        return self.low is not None and (self.start <= seq_id <= self.low or seq_id in self.extra)
+
+    def mark(self, seq_id, max_gap):
+        if self.low is None:
+            self.start = self.low = seq_id
+            return
+        if self.start <= seq_id <= self.low:
+            return
+        self.extra.add(seq_id)
+        self._grow()
+        if len(self.extra) > max_gap:
+            below = [s for s in self.extra if s < self.start]
+            if below:
+                # forget the oldest history, it is accepted again if it comes back
+                self.extra.discard(min(below))
+            else:
+                # give up on the oldest gap above the run, those messages count as seen
+                logger.warning("More than %d seq_ids after a gap at %d, skipping it", max_gap, self.low + 1)
+                self.low = min(self.extra)
+                self.extra.discard(self.low)
+                self._grow()
+
+    def fill(self, since_id, before_id):
+        """every seq_id in [since_id, before_id) is accounted for, seen or gone"""
+        if self.low is None or before_id <= since_id or before_id < self.start or since_id > self.low + 1:
+            # not touching the run: only what is seen counts
+            return
+        self.start = min(self.start, since_id)
+        self.low = max(self.low, before_id - 1)
+        self.extra = set(s for s in self.extra if not self.start <= s <= self.low)
+        self._grow()
+
+    def _grow(self):
+        extra = self.extra
+        while self.low + 1 in extra:
+            self.low += 1
+            extra.discard(self.low)
+        while self.start - 1 in extra:
+            self.start -= 1
+            extra.discard(self.start)
+
+    def high(self):
+        above = [s for s in self.extra if s > self.low]
+        return max(above) if above else self.low
+
+    def watermark(self):
+        """content of a WATERMARK record: start, then the seq_ids seen outside the run"""
+        return SEQ.pack(self.start) + b''.join(SEQ.pack(s) for s in sorted(self.extra))
+
+    def restore(self, low, content):
+        """state saved by watermark(), an empty content means everything up to low was seen"""
+        self.low = low
+        self.start = SEQ.unpack_from(content, 0)[0] if content else 0
+        self.extra = set(SEQ.unpack_from(content, offset)[0] for offset in range(SEQ.size, len(content), SEQ.size))
+
+
+class MessageStore(object):
+    def __init__(self, directory, segment_size=16 << 20, keep=200, max_segments=8, max_gap=1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.keep = keep
+        self.max_segments = max_segments
+        self.max_gap = max_gap
+
+        self._lock = threading.RLock()
+        # segment id -> _Segment, oldest first
+        self._segments = OrderedDict()
+        self._topics = {}
+        self.appended = 0
+        self.duplicates = 0
+        self.compactions = 0
+        self._compacting = False
+        # segments left by the last compaction, compacting again before as many were added would copy the
+        # same messages over and over when they do not fit in max_segments
+        self._kept = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, id):
+        return os.path.join(self.directory, '{:08d}{}'.format(id, SUFFIX))
+
+    def _load(self):
+        ids = sorted(int(name[:-len(SUFFIX)]) for name in os.listdir(self.directory) if name.endswith(SUFFIX))
+        records = 0
+        for id in ids:
+            segment = self._segments[id] = _Segment(id, self._path(id), self.segment_size)
+            for offset, kind, topic, seq_id, _, content in segment.records():
+                self._index(kind, topic, seq_id, id, offset, content)
+                records += 1
+        if not self._segments:
+            self._roll()
+        logger.info("Message store %s: %d segments, %d topics, %d records", self.directory, len(self._segments),
+                    len(self._topics), records)
+
+    def _index(self, kind, topic, seq_id, segment_id, offset, content=b''):
+        index = self._topics.get(topic)
+        if index is None:
+            index = self._topics[topic] = _TopicIndex()
+        if kind == WATERMARK:
+            # written by a compaction, it holds all that was seen until then
+            index.restore(seq_id, content)
+            return
+        index.mark(seq_id, self.max_gap)
+        index.entries[seq_id] = (segment_id, offset)
+        index.entries.move_to_end(seq_id)
+        if len(index.entries) > self.keep:
+            index.entries.popitem(last=False)
+
+    def _roll(self, size=0):
+        id = next(reversed(self._segments)) + 1 if self._segments else 1
+        segment = _Segment(id, self._path(id), max(self.segment_size, size))
+        self._segments[id] = segment
+        return segment
+
+    def _room(self, size):
+        """the last segment when `size` more bytes fit in it, otherwise None once it is flushed"""
+        segment = self._segments[next(reversed(self._segments))]
+        if segment.tail + size > segment.size:
+            segment.map.flush()
+            return None
+        return segment
+
+    def _write(self, kind, topic, seq_id, from_user, content):
+        """append one record, returns (segment id, offset)"""
+        topic_b = topic.encode('utf-8')
+        from_b = from_user.encode('utf-8')
+        payload = topic_b + from_b + content
+        record = HEADER.pack(len(payload), zlib.crc32(payload), kind, len(topic_b), seq_id, len(from_b)) + payload
+        # room for the record and the zero header ending the segment
+        segment = self._room(len(record) + HEADER.size)
+        if segment is None:
+            segment = self._roll(len(record) + HEADER.size)
+            if not self._compacting and len(self._segments) > max(self.max_segments, 2 * self._kept):
+                self._compact()
+                # the copies may have taken the room of the new segment
+                segment = self._room(len(record) + HEADER.size) or self._roll(len(record) + HEADER.size)
+        offset = segment.tail
+        segment.map[offset:offset + len(record)] = record
+        segment.tail += len(record)
+        return segment.id, offset
+
+    # ---------------- messages -------------------
+    def seen(self, topic, seq_id):
+        index = self._topics.get(topic)
+        return index is not None and index.seen(seq_id)
+
+    def append(self, data):
+        """store a ServerData, False when its seq_id was seen already"""
+        with self._lock:
+            index = self._topics.get(data.topic)
+            if index is not None and index.seen(data.seq_id):
+                self.duplicates += 1
+                return False
+            location = self._write(MESSAGE, data.topic, data.seq_id, data.from_user_id, data.content)
+            self._index(MESSAGE, data.topic, data.seq_id, *location)
+            self.appended += 1
+            return True
+
+    def _read(self, topic, seq_id, location):
+        segment = self._segments.get(location[0])
+        if segment is None:
+            return None
+        offset = location[1]
+        length, _, _, topic_len, _, from_len = HEADER.unpack_from(segment.map, offset)
+        start = offset + HEADER.size + topic_len
+        return pb.ServerData(topic=topic, seq_id=seq_id,
+                             from_user_id=segment.map[start:start + from_len].decode('utf-8'),
+                             content=segment.map[start + from_len:offset + HEADER.size + length])
+
+    def get(self, topic, seq_id):
+        with self._lock:
+            index = self._topics.get(topic)
+            location = index.entries.get(seq_id) if index is not None else None
+            return self._read(topic, seq_id, location) if location is not None else None
+
+    def last(self, topic, n=20):
+        """up to n of the latest stored messages of topic, oldest first"""
+        with self._lock:
+            index = self._topics.get(topic)
+            if index is None:
+                return []
+            found = sorted(index.entries.items())[-n:] if n else []
+            return [self._read(topic, seq_id, location) for seq_id, location in found]
+
+    def since(self, topic):
+        """end of the run of seen seq_ids of topic, 0 for an unknown topic.
+
+        the history after it is missing, what comes before the first seq_id seen is not tracked.
+        """
+        index = self._topics.get(topic)
+        return index.low or 0 if index is not None else 0
+
+    def high(self, topic):
+        """the highest seq_id seen in topic, 0 for an unknown topic"""
+        index = self._topics.get(topic)
+        return index.high() or 0 if index is not None else 0
+
+    def fill(self, topic, since_id, before_id):
+        """every seq_id of topic in [since_id, before_id) was fetched: what did not come was deleted"""
+        with self._lock:
+            index = self._topics.get(topic)
+            if index is not None:
+                index.fill(since_id, before_id)
+
+    def topics(self):
+        return list(self._topics)
+
+    # ---------------- compaction -------------------
+    def compact(self):
+        with self._lock:
+            self._compact(keep_last=False)
+
+    def _compact(self, keep_last=True):
+        """copy what is still indexed out of the old segments, then delete them"""
+        old = list(self._segments)[:-1] if keep_last else list(self._segments)
+        if not old:
+            return
+        if not keep_last:
+            self._roll()
+        old = set(old)
+        moved = 0
+        self._compacting = True
+        try:
+            for topic, index in self._topics.items():
+                if index.low is not None:
+                    self._write(WATERMARK, topic, index.low, '', index.watermark())
+                for seq_id, location in list(index.entries.items()):
+                    if location[0] not in old:
+                        continue
+                    data = self._read(topic, seq_id, location)
+                    index.entries[seq_id] = self._write(MESSAGE, topic, seq_id, data.from_user_id, data.content)
+                    moved += 1
+        finally:
+            self._compacting = False
+        for id in sorted(old):
+            segment = self._segments.pop(id, None)
+            if segment is not None:
+                segment.close()
+                os.remove(segment.path)
+        self._kept = len(self._segments)
+        self.compactions += 1
+        logger.info("Compacted %d segments, %d messages kept", len(old), moved)
+        if self._kept > self.max_segments:
+            logger.warning("Kept messages fill %d segments, more than max_segments=%d", self._kept,
+                           self.max_segments)
+
+    def flush(self):
+        with self._lock:
+            for segment in self._segments.values():
+                segment.map.flush()
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments.clear()
+
+    def stats(self):
+        return {
+            'segments': len(self._segments),
+            'topics': len(self._topics),
+            'appended': self.appended,
+            'duplicates': self.duplicates,
+            'compactions': self.compactions,
+        }
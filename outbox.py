@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+# file: outbox.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+outbound ClientMsg queue feeding the MessageLoop request iterator.
+
+unlike queue.Queue the writer side takes the lock once per batch: it wakes
+up, drains up to `max_batch` queued messages (optionally lingering up to
+`max_linger` seconds for a batch to fill) and then yields them to gRPC
+without touching the lock again. producers only notify when the writer is
+actually asleep, so a burst of posts costs a single wakeup.
+
+the queue holds at most `capacity` messages. read and keypress notes are
+kept apart from the rest, so when the outbox is full a message other than a
+note first takes the room of the oldest queued note, whatever the policy.
+what happens next depends on it:
+
+    BLOCK       a note waits for room like any other message, the rest waits
+                when no note is left to shed
+    DROP_NOTES  an incoming note never waits: it replaces the oldest queued
+                note or is dropped. the rest waits like with BLOCK
+    REJECT      notes like DROP_NOTES, the rest fails at once with OutboxFull
+                when no note is left to shed
+
+renew() forwards the messages put on the old outbox to its successor, so a
+producer still holding the old one does not post into a closed queue. the
+successor counts the drops, rejects and waits in the same counters of
+`registry`.
+"""
+import itertools
+import threading
+import time
+from collections import deque
+
+from metrics import Registry
+
+BLOCK = 'block'
+DROP_NOTES = 'drop_notes'
+REJECT = 'reject'
+POLICIES = (BLOCK, DROP_NOTES, REJECT)
+
+
+class OutboxFull(Exception):
+    pass
+
+
+class Outbox(object):
+    def __init__(self, max_batch=64, max_linger=0.0, capacity=10000, policy=DROP_NOTES, registry=None,
+                 prefix='tinode_bot'):
+        if policy not in POLICIES:
+            raise ValueError('unknown overflow policy: {}'.format(policy))
+        self.max_batch = max_batch
+        self.max_linger = max_linger
+        self.capacity = capacity
+        self.policy = policy
+
+        # (order, msg): notes apart so the oldest one is shed in O(1), order merges them back
+        self._items = deque()
+        self._notes = deque()
+        self._order = itertools.count()
+        # set by renew(), puts are forwarded to it
+        self._next = None
+        self._cond = threading.Condition(threading.Lock())
+        self._not_full = threading.Condition(self._cond)
+        # queue length at which a put wakes the writer, 0 while it is not waiting
+        self._wake_at = 0
+        self._blocked = 0
+
+        # batch size counters: batches[i] counts batches of size in [2**i, 2**(i+1))
+        self.batches = [0] * max(1, max_batch.bit_length())
+        self.sent = 0
+        self.high_water = 0
+        self.dropped_notes = 0
+        self.rejected = 0
+        self.blocked = 0
+
+        r = self.registry = registry if registry is not None else Registry()
+        self.prefix = prefix
+        self.dropped_total = r.counter(prefix + '_outbox_dropped_notes_total', 'notes dropped from a full outbox')
+        self.rejected_total = r.counter(prefix + '_outbox_rejected_total', 'messages refused by a full outbox')
+        self.blocked_total = r.counter(prefix + '_outbox_blocked_total', 'puts which waited for room in the outbox')
+
+    def __len__(self):
+        return len(self._items) + len(self._notes)
+
+    def put(self, msg, timeout=None):
+        """queue msg, applying the overflow policy when the outbox is full.
+
+        raises OutboxFull when msg is rejected, or could not be queued within
+        `timeout` seconds. dropped notes are not reported to the caller.
+        """
+        is_note = msg is not None and msg.HasField('note')
+        with self._cond:
+            if msg is not None and self._next is None and len(self) >= self.capacity:
+                if is_note and self.policy != BLOCK:
+                    self.dropped_notes += 1
+                    self.dropped_total.inc()
+                    if not self._notes:
+                        return
+                    self._notes.popleft()
+                elif not is_note and self._notes:
+                    self._notes.popleft()
+                    self.dropped_notes += 1
+                    self.dropped_total.inc()
+                elif not is_note and self.policy == REJECT:
+                    self.rejected += 1
+                    self.rejected_total.inc()
+                    raise OutboxFull('outbox full ({} queued)'.format(len(self)))
+                else:
+                    self._wait_for_room(timeout)
+            successor = self._next
+            if successor is None:
+                (self._notes if is_note else self._items).append((next(self._order), msg))
+                depth = len(self)
+                if depth > self.high_water:
+                    self.high_water = depth
+                if self._wake_at and depth >= self._wake_at:
+                    self._cond.notify()
+                return
+        # renewed, possibly while waiting for room: the producer still held this outbox
+        if msg is not None:
+            successor.put(msg, timeout)
+
+    def close(self):
+        """stop the request iterator once everything queued so far is sent"""
+        self.put(None)
+
+    def clear(self):
+        """drop everything queued, returns the dropped messages"""
+        with self._cond:
+            return self._clear()
+
+    def _clear(self):
+        dropped = [msg for _, msg in sorted(itertools.chain(self._items, self._notes), key=lambda e: e[0])]
+        self._items.clear()
+        self._notes.clear()
+        if self._blocked:
+            self._not_full.notify_all()
+        return dropped
+
+    def renew(self):
+        """hand over to a fresh outbox with the same settings for a new stream.
+
+        this one is drained and closed so the request iterator of the old
+        stream returns, and from now on forwards whatever is put on it to the
+        fresh one. the messages it still held are returned.
+        """
+        fresh = Outbox(max_batch=self.max_batch, max_linger=self.max_linger,
+                       capacity=self.capacity, policy=self.policy, registry=Registry(), prefix=self.prefix)
+        # the counters go on in the registry of this one
+        fresh.registry = self.registry
+        fresh.dropped_total, fresh.rejected_total, fresh.blocked_total = \
+            self.dropped_total, self.rejected_total, self.blocked_total
+        with self._cond:
+            leftovers = self._clear()
+            self._items.append((next(self._order), None))
+            self._next = fresh
+            if self._wake_at:
+                self._cond.notify()
+            if self._blocked:
+                self._not_full.notify_all()
+        return fresh, leftovers
+
+    def _wait_for_room(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.blocked += 1
+        self.blocked_total.inc()
+        self._blocked += 1
+        try:
+            while len(self) >= self.capacity and self._next is None:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    raise OutboxFull('outbox full, timed out after {}s'.format(timeout))
+                self._not_full.wait(left)
+        finally:
+            self._blocked -= 1
+
+    def get_batch(self):
+        """block until something is queued, then take up to max_batch messages in one go.
+
+        a batch ends with the None put by close(), what was queued after it stays.
+        """
+        with self._cond:
+            items, notes = self._items, self._notes
+            while not items and not notes:
+                self._wake_at = 1
+                self._cond.wait()
+            if self.max_linger > 0 and len(self) < self.max_batch:
+                deadline = time.monotonic() + self.max_linger
+                self._wake_at = self.max_batch
+                while len(self) < self.max_batch:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._cond.wait(left)
+            self._wake_at = 0
+            batch = []
+            for _ in range(min(len(self), self.max_batch)):
+                if notes and (not items or notes[0][0] < items[0][0]):
+                    batch.append(notes.popleft()[1])
+                else:
+                    msg = items.popleft()[1]
+                    batch.append(msg)
+                    if msg is None:
+                        break
+            if self._blocked:
+                self._not_full.notify_all()
+
+        n = len(batch)
+        self.batches[min(n.bit_length(), len(self.batches)) - 1] += 1
+        self.sent += n
+        return batch
+
+    def __iter__(self):
+        while True:
+            for msg in self.get_batch():
+                if msg is None:
+                    return
+                yield msg
+
+    def stats(self):
+        total = sum(self.batches)
+        return {
+            'depth': len(self),
+            'capacity': self.capacity,
+            'high_water': self.high_water,
+            'dropped_notes': self.dropped_notes,
+            'rejected': self.rejected,
+            'blocked': self.blocked,
+            'sent': self.sent,
+            'batches': total,
+            'avg_batch': float(self.sent) / total if total else 0.0,
+            'batch_sizes': dict(('{}+'.format(1 << i), c) for i, c in enumerate(self.batches) if c),
+        }
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+# file: pending.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+per-connection table correlating ClientMsg ids with ServerCtrl replies.
+
+every id-bearing message gets a concurrent.futures.Future which resolves
+with the ServerCtrl (2xx/3xx) or fails with RequestError (4xx/5xx),
+RequestTimeout or Disconnected. asyncio code can await it through
+asyncio.wrap_future().
+"""
+import heapq
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent import futures
+
+from log import get_logger
+
+logger = get_logger('pending')
+
+# ClientMsg oneof fields which carry an `id` answered by a ServerCtrl
+ID_FIELDS = frozenset(('hi', 'acc', 'login', 'sub', 'leave', 'pub', 'get', 'set', 'del'))
+# how often the sweeper looks for requests past their deadline, in seconds
+SWEEP_INTERVAL = 0.25
+
+
+class RequestError(Exception):
+    """server answered the request with a 4xx/5xx ctrl"""
+
+    def __init__(self, ctrl):
+        super(RequestError, self).__init__('{} {}'.format(ctrl.code, ctrl.text))
+        self.ctrl = ctrl
+        self.code = ctrl.code
+
+
+class RequestTimeout(Exception):
+    pass
+
+
+class Disconnected(Exception):
+    pass
+
+
+def message_id(msg):
+    """id of a ClientMsg, None for messages the server does not answer (note)"""
+    what = msg.WhichOneof('Message')
+    if what in ID_FIELDS:
+        return getattr(msg, what).id or None
+    return None
+
+
+def on_success(future, func):
+    """call func(ctrl.params) once the request succeeds, like the old onCompletion lambdas"""
+    if future is None:
+        return
+
+    def done(f):
+        if not f.cancelled() and f.exception() is None:
+            func(f.result().params)
+
+    future.add_done_callback(done)
+
+
+class PendingRequests(object):
+    def __init__(self, max_pending=4096, timeout=30.0, sweep=True):
+        """sweep=False leaves calling expire() to the owner, e.g. from its event loop"""
+        self.max_pending = max_pending
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        # mid -> (future, deadline), in insertion order so the oldest is evicted first
+        self._pending = OrderedDict()
+        # (deadline, mid) min-heap, entries of answered requests are skipped lazily
+        self._deadlines = []
+
+        self.expired = 0
+        self.evicted = 0
+        if sweep:
+            _sweeper.watch(self)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, mid, timeout=None):
+        fut = futures.Future()
+        fut.set_running_or_notify_cancel()
+        now = time.monotonic()
+        deadline = now + (self.timeout if timeout is None else timeout)
+        with self._lock:
+            failed = self._expire(now)
+            while len(self._pending) >= self.max_pending:
+                old_mid, (old_fut, _) = self._pending.popitem(last=False)
+                self.evicted += 1
+                failed.append((old_fut, RequestTimeout('request {} evicted, too many pending'.format(old_mid))))
+            old = self._pending.pop(mid, None)
+            if old is not None:
+                failed.append((old[0], RequestError(_Ctrl(mid, 409, 'duplicate request id'))))
+            self._pending[mid] = (fut, deadline)
+            heapq.heappush(self._deadlines, (deadline, mid))
+            if len(self._deadlines) > 2 * self.max_pending + 64:
+                self._deadlines = [(d, m) for m, (_, d) in self._pending.items()]
+                heapq.heapify(self._deadlines)
+        _fail(failed)
+        return fut
+
+    def resolve(self, ctrl):
+        """complete the request answered by `ctrl`, returns False for unknown ids"""
+        with self._lock:
+            entry = self._pending.pop(ctrl.id, None)
+            failed = self._expire(time.monotonic())
+        _fail(failed)
+        if entry is None:
+            return False
+        fut = entry[0]
+        if 200 <= ctrl.code < 400:
+            fut.set_result(ctrl)
+        else:
+            fut.set_exception(RequestError(ctrl))
+        return True
+
+    def fail(self, mid, err):
+        """fail a request which never made it to the server"""
+        with self._lock:
+            entry = self._pending.pop(mid, None)
+        if entry is not None:
+            entry[0].set_exception(err)
+
+    def expire(self):
+        """fail every request past its deadline, called by the sweeper and by add() and resolve()"""
+        with self._lock:
+            failed = self._expire(time.monotonic())
+        _fail(failed)
+        return len(failed)
+
+    def fail_all(self, err=None):
+        """connection is gone, nothing pending will ever be answered"""
+        with self._lock:
+            entries = list(self._pending.items())
+            self._pending.clear()
+            self._deadlines = []
+        _fail([(fut, err or Disconnected('request {} lost on disconnect'.format(mid)))
+               for mid, (fut, _) in entries])
+
+    def _expire(self, now):
+        failed = []
+        heap = self._deadlines
+        while heap and heap[0][0] <= now:
+            deadline, mid = heapq.heappop(heap)
+            entry = self._pending.get(mid)
+            if entry is not None and entry[1] == deadline:
+                del self._pending[mid]
+                self.expired += 1
+                failed.append((entry[0], RequestTimeout('request {} timed out'.format(mid))))
+        return failed
+
+
+class _Sweeper(object):
+    """one thread expiring the requests of every table, so deadlines fire without any traffic"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._tables = weakref.WeakSet()
+        self._thread = None
+
+    def watch(self, table):
+        with self._lock:
+            self._tables.add(table)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='pending-sweeper', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                tables = list(self._tables)
+            for table in tables:
+                try:
+                    table.expire()
+                except Exception:
+                    logger.exception("Failed to expire pending requests")
+
+
+_sweeper = _Sweeper(SWEEP_INTERVAL)
+
+
+class _Ctrl(object):
+    """stand-in ServerCtrl for errors raised locally"""
+
+    def __init__(self, mid, code, text):
+        self.id = mid
+        self.code = code
+        self.text = text
+        self.params = {}
+
+
+def _fail(failed):
+    # futures are completed outside the lock, callbacks may post new requests
+    for fut, err in failed:
+        fut.set_exception(err)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# file: plugin.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+server side of the Tinode Plugin API.
+
+the Tinode server calls the plugin for every client message (FireHose),
+for searches on 'fnd' (Find) and after account, topic, subscription and
+message changes. applications register handlers per method, each one is
+called with the request:
+
+    plugin = Plugin(limits={'FireHose': 64})   # or parse_limits('FireHose=64')
+
+    @plugin.on('FireHose')
+    def spam_filter(req):
+        if b'buy now' in req.msg.pub.content:
+            return DROP        # None lets the next handler, or the server, decide
+
+    server, port = serve(plugin, '0.0.0.0:40051', workers=32)
+
+FireHose and Find handlers are tried in registration order, the first one
+returning a response wins; without one the server carries on as usual
+(RespCode CONTINUE). every event handler is called.
+
+FireHose sits on the path of every client message, so it fails open: when
+its concurrency limit is reached or a handler raises, the message simply
+continues. Find does the same, the server then runs its default search.
+event handlers past their limit wait up to `event_wait` seconds and are
+skipped after that.
+"""
+import threading
+from concurrent import futures
+
+import grpc
+
+import pbx.model_pb2 as pb
+import pbx.model_pb2_grpc as pbx
+from log import get_logger
+
+logger = get_logger('plugin')
+
+METHODS = ('FireHose', 'Find', 'Account', 'Topic', 'Subscription', 'Message')
+EVENTS = ('Account', 'Topic', 'Subscription', 'Message')
+
+ACTIONS = {pb.CREATE: 'created', pb.UPDATE: 'updated', pb.DELETE: 'deleted'}
+
+# precomputed FireHose answers, shared by every call
+CONTINUE = pb.ServerResp(status=pb.CONTINUE)
+DROP = pb.ServerResp(status=pb.DROP)
+FIND_CONTINUE = pb.SearchFound(status=pb.CONTINUE)
+UNUSED = pb.Unused()
+
+
+def action_name(action):
+    return ACTIONS.get(action, 'unknown')
+
+
+class Plugin(pbx.PluginServicer):
+    def __init__(self, limits=None, event_wait=1.0):
+        """limits maps a method name to the max number of its calls running at once"""
+        # method -> handlers in registration order
+        self.handlers = dict((method, ()) for method in METHODS)
+        self.limits = dict(limits or {})
+        self.event_wait = event_wait
+        self._slots = {}
+        for method, limit in self.limits.items():
+            self.set_limit(method, limit)
+
+        self.calls = dict((method, 0) for method in METHODS)
+        self.errors = dict((method, 0) for method in METHODS)
+        self.rejected = dict((method, 0) for method in METHODS)
+
+    def set_limit(self, method, limit):
+        """cap the calls of `method` running at once, None or 0 lifts the cap; set it before serving"""
+        if method not in METHODS:
+            raise ValueError('unknown Plugin method: {}'.format(method))
+        if limit:
+            self.limits[method] = limit
+            self._slots[method] = threading.BoundedSemaphore(limit)
+        else:
+            self.limits.pop(method, None)
+            self._slots.pop(method, None)
+
+    def register(self, method, func, first=False):
+        """add a handler of `method`, first=True puts it before the ones already registered"""
+        if method not in METHODS:
+            raise ValueError('unknown Plugin method: {}'.format(method))
+        if first:
+            self.handlers[method] = (func,) + self.handlers[method]
+        else:
+            self.handlers[method] = self.handlers[method] + (func,)
+        return func
+
+    def unregister(self, method, func):
+        self.handlers[method] = tuple(h for h in self.handlers[method] if h is not func)
+
+    def on(self, method):
+        """decorator form of register()"""
+        return lambda func: self.register(method, func)
+
+    def stats(self):
+        return dict((method, {'calls': self.calls[method], 'errors': self.errors[method],
+                              'rejected': self.rejected[method]}) for method in METHODS)
+
+    # ---------------- calling handlers -------------------
+    def _first(self, method, request, default):
+        """the first response of the handlers of `method`, default when none answers or on overload"""
+        self.calls[method] += 1
+        handlers = self.handlers[method]
+        if not handlers:
+            return default
+        slots = self._slots.get(method)
+        if slots is not None and not slots.acquire(False):
+            self.rejected[method] += 1
+            return default
+        try:
+            for func in handlers:
+                resp = func(request)
+                if resp is not None:
+                    return resp
+            return default
+        except Exception:
+            self.errors[method] += 1
+            logger.exception('%s handler failed', method)
+            return default
+        finally:
+            if slots is not None:
+                slots.release()
+
+    def _all(self, method, request):
+        self.calls[method] += 1
+        handlers = self.handlers[method]
+        if not handlers:
+            return UNUSED
+        slots = self._slots.get(method)
+        if slots is not None and not slots.acquire(timeout=self.event_wait):
+            self.rejected[method] += 1
+            logger.warning('%s handlers busy, event skipped', method)
+            return UNUSED
+        try:
+            for func in handlers:
+                try:
+                    func(request)
+                except Exception:
+                    self.errors[method] += 1
+                    logger.exception('%s handler failed', method)
+        finally:
+            if slots is not None:
+                slots.release()
+        return UNUSED
+
+    # ---------------- grpc -------------------
+    def FireHose(self, request, context):
+        return self._first('FireHose', request, CONTINUE)
+
+    def Find(self, request, context):
+        return self._first('Find', request, FIND_CONTINUE)
+
+    def Account(self, request, context):
+        return self._all('Account', request)
+
+    def Topic(self, request, context):
+        return self._all('Topic', request)
+
+    def Subscription(self, request, context):
+        return self._all('Subscription', request)
+
+    def Message(self, request, context):
+        return self._all('Message', request)
+
+
+def parse_limits(text):
+    """'FireHose=64,Find=8' -> {'FireHose': 64, 'Find': 8}"""
+    limits = {}
+    for item in (text or '').split(','):
+        if item.strip():
+            method, limit = item.split('=')
+            if method.strip() not in METHODS:
+                raise ValueError('unknown Plugin method: {}'.format(method.strip()))
+            limits[method.strip()] = int(limit)
+    return limits
+
+
+def log_account(acc_event):
+    """default Account handler of the bots"""
+    logger.info("Account %s: %s %s", action_name(acc_event.action), acc_event.user_id, acc_event.public)
+
+
+def serve(plugin, listen='0.0.0.0:40051', workers=16, maximum_concurrent_rpcs=None):
+    """start the plugin gRPC server, returns (server, port).
+
+    maximum_concurrent_rpcs bounds the calls in progress, the server
+    answers RESOURCE_EXHAUSTED beyond it instead of queueing.
+    """
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=workers),
+                         maximum_concurrent_rpcs=maximum_concurrent_rpcs)
+    pbx.add_PluginServicer_to_server(plugin, server)
+    port = server.add_insecure_port(listen)
+    server.start()
+    return server, port
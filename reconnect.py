@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# file: reconnect.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+reconnect helpers shared by chatbot.py and ElvesChatter.run_forever().
+
+delays use "full jitter": a uniform random pick between 0 and the capped
+exponential delay, so a fleet of bots dropped by the same server restart
+spreads its reconnects out instead of arriving in waves.
+"""
+import base64
+import json
+import random
+
+
+class Backoff(object):
+    def __init__(self, base=0.5, cap=30.0, factor=2.0):
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.attempt = 0
+
+    def next(self):
+        """seconds to wait before the next attempt"""
+        ceiling = min(self.cap, self.base * self.factor ** min(self.attempt, 32))
+        self.attempt += 1
+        return random.uniform(0, ceiling)
+
+    def reset(self):
+        """call once a connection has been stable for a while"""
+        self.attempt = 0
+
+
+def retained(messages):
+    """messages left unsent by a dead stream which are worth sending again.
+
+    {pub} is kept, everything else ({hi}, {login}, {sub}, notes) belongs to
+    the old session and is rebuilt by the next one.
+    """
+    return [msg for msg in messages if msg is not None and msg.HasField('pub')]
+
+
+def reissue(msg, mid):
+    """give a {pub} sent again a fresh id.
+
+    the future of the old id failed with the connection or timed out, a late
+    {ctrl} for it would resolve nothing and the new one would never complete.
+    """
+    msg.pub.id = mid
+    return msg
+
+
+def token_from_params(params):
+    """raw token bytes from the params of a successful {login} ctrl, None without one"""
+    token = params.get('token') if params is not None else None
+    if not token:
+        return None
+    return base64.b64decode(json.loads(token))
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+# file: shard.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+run bot accounts on every core: a supervisor and N worker processes.
+
+the accounts are split between the workers by a consistent hash ring of
+the account names, each worker runs its share in a BotHost. the
+supervisor
+
+- restarts a worker that dies, with a backoff, giving it the same accounts,
+- serves the sum of the workers' metrics, sent to it every few seconds,
+  counters of a dead worker included,
+- loads the quotes once into shared memory, the workers read them there.
+
+    python shard.py --host localhost:6061 --accounts accounts.txt --workers 8 --metrics-listen 127.0.0.1:9464
+
+with --listen host:port worker i serves the Plugin API on port + i.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import time
+
+import log
+from bothost import BotHost, load_accounts
+from corpus import SharedCorpus
+from hashring import HashRing
+from log import get_logger
+from metrics import BotMetrics, MergedRegistry, serve as serve_metrics
+from reconnect import Backoff
+
+logger = get_logger('shard')
+
+
+def worker_listen(listen, index):
+    if not listen:
+        return None
+    host, port = listen.rsplit(':', 1)
+    return '{}:{}'.format(host, int(port) + index)
+
+
+def run_worker(index, accounts, options, conn):
+    """worker process: run `accounts` in a BotHost, send metric snapshots up `conn`"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log.setup(options['log_level'])
+    corpus = SharedCorpus.attach(options['corpus']) if options['corpus'] else None
+
+    def reply(in_msg):
+        return (corpus.random() if corpus is not None else '') + in_msg
+
+    async def main():
+        metrics = BotMetrics()
+        host = BotHost(options['server_address'], channels=options['channels'],
+                       listen=worker_listen(options['listen'], index), metrics=metrics)
+        await host.start()
+        for user_name, password in accounts:
+            bot = await host.add(user_name, password)
+            bot.reply = reply
+        logger.info('worker %d: %d bots', index, len(accounts))
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                await asyncio.sleep(options['metrics_interval'])
+                # a full pipe blocks the send, not the bots
+                await loop.run_in_executor(None, conn.send, metrics.registry.snapshot())
+        finally:
+            await host.close()
+
+    try:
+        asyncio.run(main())
+    except (BrokenPipeError, EOFError):
+        # the supervisor is gone
+        pass
+    finally:
+        if corpus is not None:
+            corpus.close()
+
+
+class Worker(object):
+    __slots__ = ('index', 'accounts', 'process', 'conn', 'backoff', 'started', 'restarts', 'restart_at')
+
+    def __init__(self, index, accounts):
+        self.index = index
+        self.accounts = accounts
+        self.process = None
+        self.conn = None
+        self.backoff = Backoff(base=1.0, cap=60.0)
+        self.started = 0.0
+        self.restarts = 0
+        self.restart_at = None
+
+
+class Supervisor(object):
+    def __init__(self, server_address, accounts, workers=None, channels=2, quotes_file=None, listen=None,
+                 metrics_interval=5.0, log_level='INFO', stable_after=60.0):
+        self.workers = workers or os.cpu_count() or 1
+        self.ring = HashRing(range(self.workers))
+        self.accounts = dict(accounts)
+        self.quotes_file = quotes_file
+        self.options = {
+            'server_address': server_address,
+            'channels': channels,
+            'listen': listen,
+            'metrics_interval': metrics_interval,
+            'log_level': log_level,
+            'corpus': None,
+        }
+        self.stable_after = stable_after
+        self.metrics = MergedRegistry()
+        self.corpus = None
+        self._workers = []
+        self._context = multiprocessing.get_context('spawn')
+        self._stopped = False
+
+    def shards(self):
+        """worker index -> [(user name, password)]"""
+        return dict((index, [(name, self.accounts[name]) for name in names])
+                    for index, names in self.ring.assign(sorted(self.accounts)).items())
+
+    def start(self):
+        if self.quotes_file:
+            self.corpus = SharedCorpus.from_file(self.quotes_file)
+            self.options['corpus'] = self.corpus.name
+            logger.info("Loaded %d quotes into shared memory %s", len(self.corpus), self.corpus.name)
+        for index, accounts in sorted(self.shards().items()):
+            worker = Worker(index, accounts)
+            self._workers.append(worker)
+            self._spawn(worker)
+
+    def _spawn(self, worker):
+        parent, child = self._context.Pipe(duplex=False)
+        worker.conn = parent
+        worker.process = self._context.Process(target=run_worker, name='bot-worker-{}'.format(worker.index),
+                                               args=(worker.index, worker.accounts, self.options, child),
+                                               daemon=True)
+        worker.process.start()
+        child.close()
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        logger.info("Started worker %d (pid %d) with %d accounts", worker.index, worker.process.pid,
+                    len(worker.accounts))
+
+    def run(self):
+        """supervise until stop(): collect metrics, restart dead workers"""
+        while not self._stopped:
+            waitables = {}
+            now = time.monotonic()
+            for worker in self._workers:
+                if worker.process is not None:
+                    waitables[worker.conn] = worker
+                    waitables[worker.process.sentinel] = worker
+                elif worker.restart_at is not None and worker.restart_at <= now:
+                    worker.restarts += 1
+                    self._spawn(worker)
+            for ready in multiprocessing.connection.wait(list(waitables), timeout=0.5):
+                worker = waitables[ready]
+                if ready is worker.conn:
+                    try:
+                        self.metrics.update(worker.index, worker.conn.recv())
+                    except (EOFError, OSError):
+                        pass
+                elif worker.process is not None and not worker.process.is_alive():
+                    self._died(worker)
+
+    def _died(self, worker):
+        code = worker.process.exitcode
+        worker.process.join()
+        worker.conn.close()
+        worker.process = None
+        # its counters stay in the sums, a restarted worker counts from zero on top of them
+        self.metrics.retire(worker.index)
+        if self._stopped:
+            return
+        if time.monotonic() - worker.started > self.stable_after:
+            worker.backoff.reset()
+        delay = worker.backoff.next()
+        worker.restart_at = time.monotonic() + delay
+        logger.warning("Worker %d exited with %s, restarting in %.1fs", worker.index, code, delay)
+
+    def stop(self):
+        self._stopped = True
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.terminate()
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join(5)
+        if self.corpus is not None:
+            self.corpus.unlink()
+            self.corpus = None
+
+    def stats(self):
+        return dict((worker.index, {
+            'pid': worker.process.pid if worker.process is not None else None,
+            'accounts': len(worker.accounts),
+            'restarts': worker.restarts,
+        }) for worker in self._workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run bot accounts on a pool of worker processes.")
+    parser.add_argument('--host', default='localhost:6061', help='address of Tinode server gRPC endpoint')
+    parser.add_argument('--accounts', required=True, help="file with one 'user:password' per line")
+    parser.add_argument('--workers', type=int, default=0, help='number of worker processes, 0 for one per core')
+    parser.add_argument('--channels', type=int, default=2, help='gRPC channels per worker')
+    parser.add_argument('--quotes', default='quotes.txt', help='file of quotes shared by the workers')
+    parser.add_argument('--listen', default=None, help='Plugin API address of worker 0, worker i adds i to the port')
+    parser.add_argument('--metrics-listen', default=None, help='address to serve the summed /metrics on')
+    parser.add_argument('--metrics-interval', type=float, default=5.0,
+                        help='seconds between metric snapshots of a worker')
+    parser.add_argument('--log-level', default='INFO', help='logging level')
+    args = parser.parse_args()
+    log.setup(args.log_level)
+
+    supervisor = Supervisor(args.host, load_accounts(args.accounts), workers=args.workers, quotes_file=args.quotes,
+                            channels=args.channels, listen=args.listen, metrics_interval=args.metrics_interval,
+                            log_level=args.log_level)
+    if args.metrics_listen:
+        serve_metrics(supervisor.metrics, args.metrics_listen)
+
+    def exit_gracefully(signo, stack_frame):
+        logger.info("Terminated with signal %s", signo)
+        supervisor.stop()
+
+    signal.signal(signal.SIGINT, exit_gracefully)
+    signal.signal(signal.SIGTERM, exit_gracefully)
+    supervisor.start()
+    try:
+        supervisor.run()
+    finally:
+        supervisor.stop()
+        log.shutdown()
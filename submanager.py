@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# file: submanager.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+presence driven subscriptions with a cap, idle timeouts and debouncing.
+
+the bot subscribes to a peer when it comes online (want()) and used to
+leave as soon as it went offline. here an OFF only schedules the leave
+`off_grace` seconds later, and an ON in the meantime cancels it, so a
+flapping peer costs nothing. topics are kept in least recently used order
+(touch() on every message): past `max_active` the least recently used one
+is left, and with `idle_timeout` so is every topic without traffic for
+that long. `pinned` topics ('me') are never left.
+
+    subs = SubscriptionManager(post_subscribe, post_leave, max_active=5000, idle_timeout=3600)
+    subs.start()
+    subs.want('usrAlice')      # pres ON
+    subs.touch('usrAlice')     # {data} from usrAlice
+    subs.release('usrAlice')   # pres OFF
+
+an OFF arriving while the {sub} is still waiting for its ctrl is kept and
+applied once the subscription is confirmed.
+
+it reads like the set of subscribed topics (in, len, iteration), which is
+what gets saved and restored on reconnect.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from log import get_logger
+from metrics import Registry
+
+logger = get_logger('subscriptions')
+
+EVICTED = 'evicted'
+IDLE = 'idle'
+OFFLINE = 'offline'
+MOVED = 'moved'
+
+
+class SubscriptionManager(object):
+    def __init__(self, subscribe, leave, max_active=0, idle_timeout=0.0, off_grace=30.0, pinned=('me',),
+                 registry=None, prefix='tinode_bot'):
+        """subscribe(topic) and leave(topic) post the request and return its future (or None).
+
+        max_active=0 and idle_timeout=0 disable the cap and the idle timeout. occupancy and churn are
+        exported to `registry`, a private one when it is None.
+        """
+        self.subscribe = subscribe
+        self.leave = leave
+        self.max_active = max_active
+        self.idle_timeout = idle_timeout
+        self.off_grace = off_grace
+        self.pinned = frozenset(pinned)
+
+        self._lock = threading.Lock()
+        # topic -> last use, least recently used first; pinned topics are kept apart
+        self._active = OrderedDict()
+        self._pinned = set()
+        # subscriptions requested and not answered yet
+        self._subscribing = set()
+        # topic -> time to leave it, set by release(); may hold topics still in _subscribing
+        self._leaving = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+        r = self.registry = registry if registry is not None else Registry()
+        r.gauge(prefix + '_subscriptions_active', 'topics subscribed to').set_function(self.__len__)
+        r.gauge(prefix + '_subscriptions_max', 'cap on topics subscribed to, 0 without one').set(max_active)
+        r.gauge(prefix + '_subscriptions_leaving', 'topics to leave once their grace after OFF is over') \
+            .set_function(lambda: len(self._leaving))
+        self.subscribes = r.counter(prefix + '_presence_subscribes_total', 'subscriptions requested for presence')
+        self.leaves = r.counter(prefix + '_presence_leaves_total', 'topics left, by reason', ['reason'])
+        self.flaps = r.counter(prefix + '_presence_flaps_total', 'leaves cancelled by the peer coming back')
+        self._left = dict((reason, self.leaves.labels(reason)) for reason in (EVICTED, IDLE, OFFLINE, MOVED))
+
+    # ---------------- set of subscribed topics -------------------
+    def __contains__(self, topic):
+        return topic in self._active or topic in self._pinned
+
+    def __len__(self):
+        return len(self._active) + len(self._pinned)
+
+    def __iter__(self):
+        with self._lock:
+            topics = list(self._pinned) + list(self._active)
+        return iter(topics)
+
+    def get(self, topic, default=None):
+        return True if topic in self else default
+
+    def add(self, topic):
+        """the server confirmed the subscription"""
+        evict = None
+        with self._lock:
+            self._subscribing.discard(topic)
+            if topic in self.pinned:
+                self._pinned.add(topic)
+                return
+            now = time.monotonic()
+            due = self._leaving.get(topic)
+            if due is not None and due <= now:
+                # the peer went offline while we were subscribing, and its grace is over
+                del self._leaving[topic]
+                self._active.pop(topic, None)
+                self._left[OFFLINE].inc()
+                evict = topic
+            else:
+                self._active[topic] = now
+                self._active.move_to_end(topic)
+                if self.max_active and len(self._active) > self.max_active:
+                    evict = next(iter(self._active))
+                    del self._active[evict]
+                    self._leaving.pop(evict, None)
+                    self._left[EVICTED].inc()
+        if evict is not None:
+            logger.debug("Leaving %s", evict)
+            self.leave(evict)
+
+    def discard(self, topic):
+        """the subscription is gone"""
+        with self._lock:
+            self._active.pop(topic, None)
+            self._pinned.discard(topic)
+            self._leaving.pop(topic, None)
+
+    def clear(self):
+        """forget everything, e.g. before restoring the subscriptions on a new session"""
+        with self._lock:
+            self._active.clear()
+            self._pinned.clear()
+            self._subscribing.clear()
+            self._leaving.clear()
+
+    # ---------------- presence and traffic -------------------
+    def touch(self, topic):
+        """traffic on topic, it becomes the most recently used"""
+        with self._lock:
+            if topic in self._active:
+                self._active[topic] = time.monotonic()
+                self._active.move_to_end(topic)
+
+    def want(self, topic):
+        """the peer came online or has a message: subscribe unless already subscribed"""
+        with self._lock:
+            if self._leaving.pop(topic, None) is not None:
+                self.flaps.inc()
+            if topic in self._active:
+                self._active[topic] = time.monotonic()
+                self._active.move_to_end(topic)
+                return None
+            if topic in self._pinned or topic in self._subscribing:
+                return None
+            self._subscribing.add(topic)
+            self.subscribes.inc()
+        fut = self.subscribe(topic)
+        if fut is None:
+            with self._lock:
+                self._subscribing.discard(topic)
+        else:
+            fut.add_done_callback(lambda f: self._answered(topic, f))
+        return fut
+
+    def _answered(self, topic, fut):
+        if not fut.cancelled() and fut.exception() is None:
+            self.add(topic)
+        else:
+            with self._lock:
+                self._subscribing.discard(topic)
+                if topic not in self._active:
+                    self._leaving.pop(topic, None)
+
+    def drop(self, topic):
+        """leave now, e.g. the topic is handled by another node"""
+        with self._lock:
+            self._leaving.pop(topic, None)
+            if self._active.pop(topic, None) is None:
+                return None
+            self._left[MOVED].inc()
+        return self.leave(topic)
+
+    def release(self, topic):
+        """the peer went offline: leave after off_grace unless it comes back.
+
+        during an unanswered {sub} the OFF is kept for add() and tick().
+        """
+        with self._lock:
+            if (topic in self._active or topic in self._subscribing) and topic not in self._leaving:
+                self._leaving[topic] = time.monotonic() + self.off_grace
+
+    # ---------------- timers -------------------
+    def tick(self, now=None):
+        """leave the topics whose grace period or idle time is over"""
+        now = time.monotonic() if now is None else now
+        leave = []
+        with self._lock:
+            for topic, due in list(self._leaving.items()):
+                if due <= now and topic not in self._subscribing:
+                    del self._leaving[topic]
+                    if self._active.pop(topic, None) is not None:
+                        self._left[OFFLINE].inc()
+                        leave.append(topic)
+            if self.idle_timeout:
+                cutoff = now - self.idle_timeout
+                while self._active:
+                    topic, used = next(iter(self._active.items()))
+                    if used > cutoff:
+                        break
+                    del self._active[topic]
+                    self._leaving.pop(topic, None)
+                    self._left[IDLE].inc()
+                    leave.append(topic)
+        for topic in leave:
+            self.leave(topic)
+        return leave
+
+    def start(self, interval=1.0):
+        """start the timer thread, once: later calls return the running thread"""
+        def run():
+            while not self._stopped.wait(interval):
+                try:
+                    self.tick()
+                except Exception:
+                    logger.exception("Subscription timer failed")
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=run, name='subscriptions', daemon=True)
+                self._thread.start()
+            return self._thread
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        return {
+            'active': len(self),
+            'max_active': self.max_active,
+            'leaving': len(self._leaving),
+            'subscribes': self.subscribes.value,
+            'leaves': dict((reason, child.value) for reason, child in self._left.items()),
+            'flaps': self.flaps.value,
+        }
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# file: sync.py
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------
+"""
+fetch the messages missed while disconnected.
+
+for every topic the last seq_id handled is known, from the MessageStore
+when there is one (everything up to store.since(topic) was seen) or from
+the {data} observed on the previous session. once the subscriptions are
+restored each topic is asked for what came after it with
+{get what='data'}: first for its newest message only, then oldest first
+for the seq_ids in between, in windows of `page` seq_ids bounded by
+since_id and before_id. every message fetched lands right after the run
+of seen seq_ids, and with a store each window answered counts as
+complete, so the seq_ids of deleted messages do not stay gaps:
+
+    history = HistorySync(post_get, store=store, page=100, concurrency=4)
+    history.observe(data, fresh)   # in the {data} handler, fresh: not seen before
+    history.reset()                # when the connection is lost
+    history.sync(topics)           # once the topics are subscribed again
+
+the fetched messages arrive as ordinary {data} on the stream and go
+through the usual handlers, which skip what was already seen. at most
+`concurrency` topics are fetched at once, topics never seen before are
+not fetched at all.
+"""
+import threading
+from collections import deque
+
+from log import get_logger
+
+logger = get_logger('sync')
+
+
+class _Page(object):
+    __slots__ = ('since_id', 'before_id', 'top', 'count', 'fresh', 'highest')
+
+    def __init__(self, since_id, before_id=0, top=None):
+        self.since_id = since_id
+        self.before_id = before_id
+        # the newest seq_id, None while asking for it
+        self.top = top
+        self.count = 0
+        self.fresh = 0
+        self.highest = 0
+
+
+class HistorySync(object):
+    def __init__(self, get, store=None, page=100, concurrency=4, pinned=('me',)):
+        """get(topic, since_id, before_id, limit) posts a {get what='data'} and returns the future of its ctrl"""
+        self.get = get
+        self.store = store
+        self.page = page
+        self.concurrency = concurrency
+        self.pinned = frozenset(pinned)
+
+        self._lock = threading.Lock()
+        # without a store: topic -> highest seq_id observed, and its value when the connection was lost
+        self._seen = {}
+        self._since = {}
+        self._queue = deque()
+        # topic -> _Page being fetched
+        self._active = {}
+
+        self.pages = 0
+        self.fetched = 0
+        self.synced = 0
+        self.failed = 0
+
+    def cursor(self, topic):
+        """seq_id up to which topic was handled, 0 when unknown"""
+        if self.store is not None:
+            return self.store.since(topic)
+        return self._since.get(topic, 0)
+
+    def observe(self, data, fresh=True):
+        """data arrived, fresh is False when the handler dropped it as seen already"""
+        page = self._active.get(data.topic)
+        if page is not None and data.seq_id >= page.since_id and (not page.before_id or data.seq_id < page.before_id):
+            page.count += 1
+            if fresh:
+                page.fresh += 1
+            if data.seq_id > page.highest:
+                page.highest = data.seq_id
+        if self.store is None and data.seq_id > self._seen.get(data.topic, 0):
+            self._seen[data.topic] = data.seq_id
+
+    def reset(self):
+        """the connection is lost: remember where every topic stopped, drop the fetches in progress"""
+        with self._lock:
+            self._since = dict(self._seen)
+            self._queue.clear()
+            self._active.clear()
+
+    def sync(self, topics):
+        with self._lock:
+            for topic in topics:
+                if topic in self.pinned or topic in self._active or topic in self._queue:
+                    continue
+                if self.cursor(topic):
+                    self._queue.append(topic)
+        self._pump()
+
+    def _pump(self):
+        while True:
+            with self._lock:
+                if not self._queue or len(self._active) >= self.concurrency:
+                    return
+                topic = self._queue.popleft()
+            # the newest message first, it tells how far to go
+            self._fetch(topic, _Page(self.cursor(topic) + 1), 1)
+
+    def _fetch(self, topic, page, limit):
+        with self._lock:
+            self._active[topic] = page
+        try:
+            fut = self.get(topic, page.since_id, page.before_id, limit)
+        except Exception as err:
+            logger.warning("Failed to fetch history of %s: %s", topic, err)
+            fut = None
+        if fut is None:
+            self._finish(topic, page, False)
+            return
+        fut.add_done_callback(lambda f: self._page_done(topic, page, f))
+
+    def _page_done(self, topic, page, fut):
+        # {data} of the page come before its {ctrl} on the stream, observe() has counted them
+        if self._active.get(topic) is not page:
+            # reset() in the meantime
+            return
+        if fut.cancelled() or fut.exception() is not None:
+            logger.info("History of %s not fetched: %s", topic, 'cancelled' if fut.cancelled() else fut.exception())
+            self._finish(topic, page, False)
+            return
+        self.pages += 1
+        self.fetched += page.fresh
+        if page.top is None:
+            if not page.count:
+                # nothing new
+                self._finish(topic, page, True)
+                return
+            top = page.highest
+            since_id = page.since_id
+        else:
+            top = page.top
+            if self.store is not None:
+                # whatever did not come in the window was deleted
+                self.store.fill(topic, page.since_id, page.before_id)
+            since_id = page.before_id
+        if since_id < top:
+            self._fetch(topic, _Page(since_id, min(since_id + self.page, top), top), self.page)
+            return
+        self._finish(topic, page, True)
+
+    def _finish(self, topic, page, ok):
+        with self._lock:
+            if self._active.get(topic) is page:
+                del self._active[topic]
+        if ok:
+            self.synced += 1
+        else:
+            self.failed += 1
+        self._pump()
+
+    def stats(self):
+        return {
+            'queued': len(self._queue),
+            'active': len(self._active),
+            'pages': self.pages,
+            'fetched': self.fetched,
+            'synced': self.synced,
+            'failed': self.failed,
+        }
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+# file: tests/conftest.py
+# ------------------------------------------------------------------------
+"""
+the modules live at the top of the repository, make them importable from the tests.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
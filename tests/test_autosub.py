@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_autosub.py
+# ------------------------------------------------------------------------
+import threading
+import time
+from concurrent.futures import Future
+
+import pbx.model_pb2 as pb
+from autosub import AutoSubscriber
+from pending import Disconnected, RequestError, _Ctrl
+
+
+def subscriber(answer=True, **kwargs):
+    """AutoSubscriber whose subscribe() records (topic, time) and answers at once when `answer`"""
+    sent = []
+    pending = {}
+    cond = threading.Condition()
+
+    def subscribe(topic):
+        fut = Future()
+        with cond:
+            sent.append((topic, time.monotonic()))
+            pending[topic] = fut
+            cond.notify_all()
+        if answer:
+            fut.set_result(None)
+        return fut
+
+    def wait_sent(n, timeout=5):
+        with cond:
+            assert cond.wait_for(lambda: len(sent) >= n, timeout)
+
+    autosub = AutoSubscriber(subscribe, **kwargs)
+    return autosub, sent, pending, wait_sent
+
+
+def test_token_bucket_paces_a_burst():
+    autosub, sent, _, wait_sent = subscriber(rate=20.0, burst=2)
+    for i in range(6):
+        autosub.on_account(pb.AccountEvent(action=pb.CREATE, user_id='usr{}'.format(i)))
+    autosub.on_account(pb.AccountEvent(action=pb.UPDATE, user_id='usrOld'))
+    autosub.start()
+    try:
+        wait_sent(6)
+    finally:
+        autosub.stop()
+    assert [topic for topic, _ in sent] == ['usr{}'.format(i) for i in range(6)]
+    # the first `burst` go at once, the other 4 at `rate` per second
+    start = sent[0][1]
+    assert sent[1][1] - start < 0.05
+    assert sent[-1][1] - start >= 4 / 20.0 - 0.02
+    assert autosub.stats()['subscribed'] == 6
+
+
+def test_window_limits_unanswered_subs():
+    autosub, sent, pending, wait_sent = subscriber(answer=False, window=2)
+    for i in range(3):
+        autosub.add('usr{}'.format(i))
+    autosub.start()
+    try:
+        wait_sent(2)
+        time.sleep(0.1)
+        assert len(sent) == 2 and len(autosub) == 1
+        pending['usr0'].set_result(None)
+        wait_sent(3)
+    finally:
+        autosub.stop()
+
+
+def test_disconnected_sub_is_sent_again():
+    autosub, sent, pending, wait_sent = subscriber(answer=False)
+    autosub.add('usrAlice')
+    autosub.start()
+    try:
+        wait_sent(1)
+        pending['usrAlice'].set_exception(Disconnected('lost'))
+        wait_sent(2)
+        pending['usrAlice'].set_result(None)
+    finally:
+        autosub.stop()
+    assert [topic for topic, _ in sent] == ['usrAlice', 'usrAlice']
+    stats = autosub.stats()
+    assert (stats['subscribed'], stats['failed'], stats['inflight']) == (1, 0, 0)
+
+
+def test_refused_sub_is_not_retried_until_added_again():
+    autosub, sent, pending, wait_sent = subscriber(answer=False)
+    autosub.add('usrAlice')
+    autosub.start()
+    try:
+        wait_sent(1)
+        pending['usrAlice'].set_exception(RequestError(_Ctrl('1', 403, 'forbidden')))
+        time.sleep(0.1)
+        assert len(sent) == 1
+        assert autosub.stats()['failed'] == 1
+        # forgotten, so a later CREATE queues it again
+        autosub.add('usrAlice')
+        wait_sent(2)
+    finally:
+        autosub.stop()
+
+
+def test_waits_for_ready_and_skips_subscribed():
+    ready = threading.Event()
+    autosub, sent, _, wait_sent = subscriber(ready=ready, is_subscribed={'usrBob'}.__contains__)
+    autosub.add('usrBob')
+    autosub.add('usrAlice')
+    autosub.add('usrAlice')
+    autosub.start()
+    try:
+        time.sleep(0.1)
+        assert sent == []
+        ready.set()
+        wait_sent(1)
+    finally:
+        autosub.stop()
+    assert [topic for topic, _ in sent] == ['usrAlice']
+    assert autosub.stats()['skipped'] == 1
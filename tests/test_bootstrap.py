@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_bootstrap.py
+# ------------------------------------------------------------------------
+from concurrent import futures
+
+import chatbot
+from bootstrap import Bootstrap, load_topics, save_topics
+from pending import RequestError, RequestTimeout
+
+
+class Ctrl(object):
+    def __init__(self, code):
+        self.id = '1'
+        self.code = code
+        self.text = ''
+        self.params = {}
+
+
+def answered(value=None, err=None):
+    fut = futures.Future()
+    if err is not None:
+        fut.set_exception(err)
+    else:
+        fut.set_result(value)
+    return fut
+
+
+def test_bootstrap_tells_refused_from_lost():
+    outcome = {'a': answered(Ctrl(200)), 'b': answered(err=RequestError(Ctrl(404))),
+               'c': answered(err=RequestTimeout('c'))}
+    done = []
+    boot = Bootstrap(outcome.get, sorted(outcome), on_ready=done.append)
+    boot.start(answered(Ctrl(200)))
+    assert boot.ready.wait(1)
+    assert done == [['a']]
+    assert boot.refused == ['b']
+    assert sorted(boot.failed) == ['b', 'c']
+
+
+def test_topics_not_restored_yet_are_saved(tmp_path, monkeypatch):
+    monkeypatch.setattr(chatbot, 'restoring', {'usrAlice', 'usrBob'})
+    monkeypatch.setattr(chatbot, 'subscriptions', chatbot.SubscriptionManager(lambda t: None, lambda t: None))
+    chatbot.add_subscription('usrCarol')
+    subs_file = str(tmp_path / 'subs.json')
+    save_topics(subs_file, chatbot.saved_topics())
+    assert load_topics(subs_file) == ['usrAlice', 'usrBob', 'usrCarol']
+
+
+def test_late_bootstrap_of_an_old_session_is_ignored(monkeypatch):
+    monkeypatch.setattr(chatbot, 'restoring', {'usrAlice', 'usrBob'})
+    monkeypatch.setattr(chatbot, 'ready', chatbot.threading.Event())
+    boot = Bootstrap(None, [])
+    boot.subscribed = ['usrAlice']
+    old = chatbot.session
+    chatbot.end_session()
+    chatbot.session_ready(old, boot)
+    assert not chatbot.ready.is_set()
+    assert chatbot.restoring == {'usrAlice', 'usrBob'}
+
+    chatbot.session_ready(chatbot.session, boot)
+    assert chatbot.ready.is_set()
+    assert chatbot.restoring == {'usrBob'}
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_bothost.py
+# ------------------------------------------------------------------------
+import asyncio
+import time
+
+import pytest
+
+import bothost
+from bothost import BotHost
+from mock_server import MockNode, ctrl, serve
+from reconnect import Backoff
+
+
+class RefusingNode(MockNode):
+    def handle(self, sess, msg):
+        if msg.HasField('login'):
+            self.received['login'] = self.received.get('login', 0) + 1
+            sess.send(ctrl(msg.login.id, 401, 'authentication failed'))
+            return
+        MockNode.handle(self, sess, msg)
+
+
+async def until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+def test_refused_login_reconnects(monkeypatch):
+    monkeypatch.setattr(bothost, 'Backoff', lambda: Backoff(base=0.01, cap=0.05))
+    node = RefusingNode()
+    server, port = serve(node)
+
+    async def main():
+        host = BotHost('127.0.0.1:{}'.format(port), channels=1)
+        await host.start()
+        bot = await host.add('alice', 'secret')
+        await until(lambda: node.received.get('login', 0) >= 3)
+        assert not bot.ready.is_set()
+        assert not host.tasks['alice'].done()
+        await host.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        server.stop(None)
+
+
+def test_add_needs_start():
+    async def main():
+        host = BotHost('127.0.0.1:1', channels=2)
+        with pytest.raises(RuntimeError):
+            await host.add('alice', 'secret')
+
+    asyncio.run(main())
+
+
+def test_channels_round_robin_after_remove():
+    async def main():
+        host = BotHost('127.0.0.1:1', channels=2)
+        await host.start()
+        a = await host.add('alice', 'secret')
+        await host.remove('alice')
+        b = await host.add('bob', 'secret')
+        c = await host.add('carol', 'secret')
+        assert a.channel is host.channels[0]
+        assert b.channel is host.channels[1]
+        assert c.channel is host.channels[0]
+        await host.close()
+
+    asyncio.run(main())
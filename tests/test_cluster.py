@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_cluster.py
+# ------------------------------------------------------------------------
+from concurrent.futures import Future
+
+from cluster import ClusterNode, LocalMembership
+from submanager import SubscriptionManager
+
+TOPICS = ['usr{}'.format(i) for i in range(50)]
+
+
+def answered(topic):
+    fut = Future()
+    fut.set_result(None)
+    return fut
+
+
+def node(node_id='a'):
+    subs = SubscriptionManager(answered, lambda topic: None)
+    return ClusterNode(node_id, LocalMembership(), subs), subs
+
+
+def test_subscribed_before_joining_come_back():
+    cluster, subs = node()
+    for topic in TOPICS:
+        subs.want(topic)
+    cluster.start()
+    try:
+        cluster.rebalance({'a', 'b'})
+        kept = set(subs)
+        assert 0 < len(kept) < len(TOPICS)
+        cluster.rebalance({'a'})
+        assert set(subs) == set(TOPICS)
+    finally:
+        cluster.stop()
+
+
+def test_seeded_topics_are_taken_when_owned():
+    cluster, subs = node()
+    cluster.seed(TOPICS + ['me'])
+    assert 'me' not in cluster.wanted
+    cluster.rebalance({'a', 'b'})
+    assert set(subs) == set(topic for topic in TOPICS if cluster.owns(topic))
+    assert len(subs) > 0
+
+
+def test_autosub_topics_are_not_remembered():
+    cluster, subs = node()
+    cluster.want('usrNew', remember=False)
+    assert 'usrNew' in subs
+    assert not cluster.wanted
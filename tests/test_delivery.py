@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_delivery.py
+# ------------------------------------------------------------------------
+import threading
+import time
+
+import pytest
+
+import pbx.model_pb2 as pb
+from delivery import AT_LEAST_ONCE, AckWindow, Deduplicator, IDEMPOTENCY_KEY, WindowFull
+from elves import ElvesChatter
+from mock_server import MockNode, serve
+
+
+def pub(n):
+    return pb.ClientMsg(pub=pb.ClientPub(id=str(n), topic='usrAlice'))
+
+
+def test_full_window_queues_then_sheds():
+    window = AckWindow(max_unacked=2, max_waiting=1)
+    sent = []
+    send = lambda msg, key: sent.append(key) or key
+    keys = [window.track(pub(1), send), window.track(pub(2), send)]
+    assert window.track(pub(3), send) is None
+    with pytest.raises(WindowFull):
+        window.track(pub(4), send)
+    assert len(sent) == 2
+    window.ack(keys[0])
+    assert len(sent) == 3
+    assert window.stats()['deferred'] == 1 and window.stats()['shed'] == 1
+    assert [msg.pub.id for msg in window.unacked()] == ['2', '3']
+
+
+def test_failing_sends_of_waiting_publishes_do_not_recurse():
+    window = AckWindow(max_unacked=1, max_waiting=5000)
+    first = window.track(pub(0), lambda msg, key: key)
+
+    def fail(msg, key):
+        raise RuntimeError('outbox full')
+
+    for i in range(3000):
+        window.track(pub(i + 1), fail)
+    window.ack(first)
+    assert len(window) == 0
+    assert window.rejected == 3000
+
+
+def test_dedup_by_topic_and_key():
+    dedup = Deduplicator(size=2)
+    data = pb.ServerData(topic='usrAlice', seq_id=1, head={IDEMPOTENCY_KEY: b'"k"'})
+    assert not dedup.is_duplicate(data)
+    assert dedup.is_duplicate(data)
+
+
+def test_full_window_does_not_stall_the_reader(tmp_path, monkeypatch):
+    # the login saves a cookie in the working directory
+    monkeypatch.chdir(tmp_path)
+    node = MockNode()
+    server, port = serve(node)
+    bot = ElvesChatter('127.0.0.1:{}'.format(port), delivery=AT_LEAST_ONCE, max_unacked=4)
+    try:
+        bot.init_client()
+        bot.login('alice', 'secret')
+        threading.Thread(target=bot.on_message, daemon=True).start()
+        assert bot.ready.wait(5)
+        bot.subscribe('usrPeer').result(5)
+        # replies are published inline, on the thread which reads their acks
+        node.inject('usrPeer', 'hello', count=2000)
+        deadline = time.monotonic() + 30
+        while bot.acks.acked + bot.acks.shed.value < 2000 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # every reply was sent and acked, or shed once 4 + 64 were waiting: none is stuck
+        assert bot.acks.acked + bot.acks.shed.value == 2000
+        assert node.received.get('pub') == bot.acks.acked >= 4 + 64
+        assert len(bot.acks) == 0
+        # and the session still works
+        bot.subscribe('usrOther').result(5)
+    finally:
+        bot.stop()
+        server.stop(None)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_dispatch.py
+# ------------------------------------------------------------------------
+import pytest
+
+import pbx.model_pb2 as pb
+from dispatch import Dispatcher
+from metrics import BotMetrics
+
+
+def data(topic):
+    return pb.ServerMsg(data=pb.ServerData(topic=topic, seq_id=1))
+
+
+def pres(topic):
+    return pb.ServerMsg(pres=pb.ServerPres(topic=topic, src='usrAlice', what=pb.ServerPres.ON))
+
+
+def recorder(calls, name):
+    return lambda body: calls.append((name, body.topic))
+
+
+def test_routes_by_oneof_exact_topic_then_longest_prefix():
+    calls = []
+    d = Dispatcher()
+    d.register('data', recorder(calls, 'any'))
+    d.register('data', recorder(calls, 'usr'), prefix='usr')
+    d.register('data', recorder(calls, 'usrA'), prefix='usrA')
+    d.register('data', recorder(calls, 'alice'), topic='usrAlice')
+    d.register('pres', recorder(calls, 'me'), topic='me')
+
+    assert d.dispatch(data('usrAlice'))
+    assert calls == [('alice', 'usrAlice'), ('usrA', 'usrAlice'), ('usr', 'usrAlice'), ('any', 'usrAlice')]
+    del calls[:]
+    d.dispatch(data('usrBob'))
+    assert calls == [('usr', 'usrBob'), ('any', 'usrBob')]
+    del calls[:]
+    d.dispatch(data('grpX'))
+    assert calls == [('any', 'grpX')]
+    del calls[:]
+    d.dispatch(pres('me'))
+    assert calls == [('me', 'me')]
+
+
+def test_unmatched_messages_are_counted():
+    d = Dispatcher()
+    d.register('pres', lambda body: None, topic='me')
+    assert not d.dispatch(pres('usrAlice'))
+    assert not d.dispatch(data('usrAlice'))
+    assert not d.dispatch(pb.ServerMsg())
+    assert d.unhandled == 3
+    assert d.has_handlers('pres') and not d.has_handlers('data')
+
+
+def test_fallback_handler_after_unregister():
+    calls = []
+    d = Dispatcher()
+    specific = d.register('data', recorder(calls, 'grp'), prefix='grp')
+    d.register('data', recorder(calls, 'fallback'))
+    d.unregister(specific)
+    d.dispatch(data('grpX'))
+    assert calls == [('fallback', 'grpX')]
+
+
+def test_register_rejects_bad_routes():
+    d = Dispatcher()
+    with pytest.raises(ValueError):
+        d.register('nope', lambda body: None)
+    with pytest.raises(ValueError):
+        d.register('data', lambda body: None, topic='usrAlice', prefix='usr')
+
+
+def test_handler_exception_propagates_and_is_still_timed():
+    calls = []
+    d = Dispatcher()
+    d.metrics = BotMetrics()
+
+    @d.on('data')
+    def broken(body):
+        raise RuntimeError('boom')
+
+    d.register('data', recorder(calls, 'after'))
+    with pytest.raises(RuntimeError):
+        d.dispatch(data('usrAlice'))
+    # the handlers after the broken one are skipped
+    assert calls == []
+    assert d.metrics.handler_latency.labels('data').count == 1
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_elves_aio.py
+# ------------------------------------------------------------------------
+import asyncio
+import time
+
+import pytest
+
+import pending
+from elves_aio import AsyncElvesChatter
+from mock_server import MockNode, serve
+
+
+async def until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+def test_subscribe_and_leave_track_topics(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    node = MockNode()
+    server, port = serve(node)
+
+    async def main():
+        bot = AsyncElvesChatter('127.0.0.1:{}'.format(port))
+        await bot.connect()
+        reader = asyncio.ensure_future(bot.on_message())
+        await asyncio.wrap_future(await bot.login('alice', 'secret'))
+        assert bot.ready.is_set()
+        await asyncio.wrap_future(await bot.subscribe('usrPeer'))
+        assert bot.subscriptions == {'usrPeer'}
+        await asyncio.wrap_future(await bot.leave('usrPeer'))
+        assert bot.subscriptions == set()
+        reader.cancel()
+        await bot.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        server.stop(None)
+
+
+def test_requests_expire_without_the_sweeper_thread(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    node = MockNode(latency=1.0)
+    server, port = serve(node)
+
+    async def main():
+        bot = AsyncElvesChatter('127.0.0.1:{}'.format(port))
+        assert bot.pending not in pending._sweeper._tables
+        bot.pending.timeout = 0.05
+        await bot.connect()
+        reader = asyncio.ensure_future(bot.on_message())
+        fut = await bot.subscribe('usrPeer')
+        with pytest.raises(pending.RequestTimeout):
+            await asyncio.wait_for(asyncio.wrap_future(fut), 0.9)
+        reader.cancel()
+        await bot.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        server.stop(None)
+
+
+def test_threaded_only_methods_are_absent():
+    bot = AsyncElvesChatter('localhost:1')
+    for name in ('start_bootstrap', 'enable_autosub', 'send_tracked', 'replay_when_ready', 'reconnect'):
+        assert not hasattr(bot, name)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_executor.py
+# ------------------------------------------------------------------------
+import multiprocessing
+import threading
+import time
+from concurrent import futures
+
+import chatbot
+from executor import TopicExecutor
+
+
+def test_tasks_of_a_key_run_in_order():
+    pool = TopicExecutor(max_workers=4)
+    done = []
+    for i in range(50):
+        pool.submit(i % 3, time.sleep, 0.001, callback=lambda _, i=i: done.append(i))
+    pool.shutdown()
+    for key in range(3):
+        assert [i for i in done if i % 3 == key] == list(range(key, 50, 3))
+    assert pool.completed == 50
+
+
+def test_callbacks_do_not_run_on_pool_threads():
+    pool = TopicExecutor(max_workers=1)
+    threads = []
+    pool.submit('a', int, '1', callback=lambda _: threads.append(threading.current_thread().name))
+    pool.shutdown()
+    assert threads == ['executor-callbacks']
+
+
+def test_broken_executor_settles_queued_tasks_without_recursion():
+    broken = futures.ThreadPoolExecutor(max_workers=1)
+    pool = TopicExecutor(executor=broken, max_inflight=5000)
+    release = threading.Event()
+    pool.submit('a', release.wait)
+    for _ in range(3000):
+        pool.submit('a', int, '1')
+    broken.shutdown(wait=False)
+    release.set()
+    pool.shutdown()
+    assert pool.inflight == 0
+    assert pool.completed == 1
+    assert pool.failed == 3000
+
+
+def test_process_pool_gets_the_quotes():
+    spawn = futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=chatbot.set_quotes, initargs=(['one ', 'two '],))
+    pool = TopicExecutor(executor=spawn)
+    replies = []
+    for _ in range(4):
+        pool.submit('a', chatbot.make_reply, b'x', callback=replies.append)
+    pool.shutdown()
+    assert pool.failed == 0
+    assert sorted(set(replies)) <= ['one x', 'two x'] and len(replies) == 4
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_find_index.py
+# ------------------------------------------------------------------------
+import json
+import os
+
+import pbx.model_pb2 as pb
+from find_index import TOPIC, USER, FindIndex
+
+
+def public(fn):
+    return json.dumps({'fn': fn}).encode('utf-8')
+
+
+def account(action, user_id, tags=(), fn=None):
+    return pb.AccountEvent(action=action, user_id=user_id, tags=tags, public=public(fn) if fn else b'')
+
+
+def ids(entries):
+    return [e.id for e in entries]
+
+
+def make_index(**kwargs):
+    index = FindIndex(**kwargs)
+    index.on_account(account(pb.CREATE, 'usrAlice', ['travel', 'alice@example.com'], 'Alice Smith'))
+    index.on_account(account(pb.CREATE, 'usrBob', ['travel', 'music'], 'Bob Travel'))
+    index.on_account(account(pb.CREATE, 'usrCarol', ['music'], 'Carol'))
+    index.on_topic(pb.TopicEvent(action=pb.CREATE, name='grpTravel', desc=pb.TopicDesc(public=public('Travel club'))))
+    return index
+
+
+def test_search_or_within_an_element_and_across_elements():
+    index = make_index()
+    assert sorted(ids(index.search(['music']))) == ['usrBob', 'usrCarol']
+    assert sorted(ids(index.search(['alice,carol']))) == ['usrAlice', 'usrCarol']
+    assert ids(index.search(['travel', 'music'])) == ['usrBob']
+    assert ids(index.search(['travel', 'nobody'])) == []
+    assert index.search([' , ']) == []
+    # terms are normalized
+    assert ids(index.search([' SMITH '])) == ['usrAlice']
+
+
+def test_ranking_by_score_then_by_id():
+    index = make_index()
+    # a term scores once per entry, as a tag when it is both
+    assert ids(index.search(['travel'])) == ['usrAlice', 'usrBob', 'grpTravel']
+    # usrBob matches a tag and a name word, usrAlice a tag, grpTravel a name word
+    assert ids(index.search(['travel,bob'])) == ['usrBob', 'usrAlice', 'grpTravel']
+    assert ids(index.search(['travel,bob'], limit=2)) == ['usrBob', 'usrAlice']
+    assert ids(index.search(['travel,bob'], exclude='usrBob')) == ['usrAlice', 'grpTravel']
+
+
+def test_find_answers_once_warm():
+    index = FindIndex()
+    assert index.find(pb.SearchQuery(user_id='usrAlice', terms=['music'])) is None
+    index = make_index()
+    found = index.find(pb.SearchQuery(user_id='usrCarol', terms=['music']))
+    assert found.status == pb.RESPOND
+    assert [(s.topic, s.user_id) for s in found.result] == [('usrBob', 'usrBob')]
+    found = index.find(pb.SearchQuery(terms=['club']))
+    assert [(s.topic, s.user_id) for s in found.result] == [('grpTravel', '')]
+    assert (index.queries, index.answered) == (2, 2)
+
+
+def test_update_keeps_what_the_event_leaves_empty():
+    index = make_index()
+    index.on_account(account(pb.UPDATE, 'usrAlice', ['hiking']))
+    assert ids(index.search(['smith'])) == ['usrAlice']
+    assert ids(index.search(['hiking'])) == ['usrAlice']
+    assert 'usrAlice' not in ids(index.search(['travel']))
+
+    index.on_account(account(pb.UPDATE, 'usrAlice', fn='Alice Jones'))
+    assert ids(index.search(['jones', 'hiking'])) == ['usrAlice']
+    assert index.search(['smith']) == []
+
+    # CREATE replaces everything
+    index.on_account(account(pb.CREATE, 'usrAlice', ['chess']))
+    assert index.search(['jones']) == []
+    assert index.search(['hiking']) == []
+
+
+def test_delete_unindexes():
+    index = make_index()
+    index.on_account(account(pb.DELETE, 'usrBob'))
+    index.on_topic(pb.TopicEvent(action=pb.DELETE, name='grpTravel'))
+    assert ids(index.search(['travel'])) == ['usrAlice']
+    assert len(index) == 2
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'find.json')
+    index = make_index(snapshot_file=path)
+    assert index._dirty
+    index.save()
+    assert not index._dirty
+
+    loaded = FindIndex(snapshot_file=path)
+    assert len(loaded) == 4
+    assert not loaded._dirty
+    for terms in (['travel'], ['music'], ['alice@example.com'], ['club']):
+        assert ids(loaded.search(terms)) == ids(index.search(terms))
+    assert [e.kind for e in loaded.search(['travel'])] == [USER, USER, TOPIC]
+    assert loaded.search(['club'])[0].public == public('Travel club')
+
+
+def test_failed_save_stays_dirty(tmp_path):
+    path = str(tmp_path / 'missing' / 'find.json')
+    index = make_index(snapshot_file=path)
+    index.save()
+    assert not os.path.exists(path)
+    assert index._dirty
+
+    os.mkdir(str(tmp_path / 'missing'))
+    index.stop()
+    assert os.path.exists(path)
+    assert not index._dirty
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_firehose.py
+# ------------------------------------------------------------------------
+import json
+import re
+
+import pytest
+
+import pbx.model_pb2 as pb
+from firehose import Rule, RuleEngine, load_rules, trie_regex
+from plugin import Plugin
+
+
+def pub_req(content, topic='grpChat', user_id='usrAlice', auth_level=pb.Session.AUTH):
+    return pb.ClientReq(msg=pb.ClientMsg(pub=pb.ClientPub(id='1', topic=topic, content=content)),
+                        sess=pb.Session(user_id=user_id, auth_level=auth_level))
+
+
+def sub_req(topic, user_id='usrAlice', auth_level=pb.Session.AUTH):
+    return pb.ClientReq(msg=pb.ClientMsg(sub=pb.ClientSub(id='7', topic=topic)),
+                        sess=pb.Session(user_id=user_id, auth_level=auth_level))
+
+
+def test_trie_regex_prefers_the_longest_word():
+    pattern = re.compile(trie_regex([b'buy', b'buy now', b'bus', b'a.b']))
+    assert pattern.match(b'buy now!').group(0) == b'buy now'
+    assert pattern.match(b'buy later').group(0) == b'buy'
+    assert pattern.match(b'bus').group(0) == b'bus'
+    # words are escaped, not regex sources
+    assert pattern.match(b'a.b').group(0) == b'a.b'
+    assert pattern.match(b'axb') is None
+
+
+def test_content_words_sharing_a_prefix_match_both_rules():
+    short = Rule(what='pub', content='buy', action='continue', name='short')
+    long = Rule(what='pub', content='buy now', action='drop', name='long')
+    engine = RuleEngine([long, short])
+    # 'buy now' is found as the longer word, the rule for 'buy' still holds
+    assert engine.match(pub_req(b'please buy now')) is long
+    engine = RuleEngine([short, long])
+    assert engine.match(pub_req(b'please buy now')) is short
+    assert engine.match(pub_req(b'please buy it')) is short
+    assert engine.match(pub_req(b'nothing to see')) is None
+
+
+def test_content_is_case_sensitive_unless_ignore_case():
+    rules = [Rule(what='pub', content=['Free Money'], action='drop')]
+    assert RuleEngine(rules).match(pub_req(b'FREE MONEY here')) is None
+    engine = RuleEngine(rules, ignore_case=True)
+    assert engine.match(pub_req(b'FREE MONEY here')) is rules[0]
+    assert engine.match(pub_req(b'free money here')) is rules[0]
+    assert engine.match(pub_req(b'free time')) is None
+
+
+def test_topic_prefix_and_auth_level():
+    rule = Rule(what='sub', topic='grpStaff*', auth_level='ANON', action='respond', code=403, text='forbidden')
+    engine = RuleEngine([rule])
+    assert engine.match(sub_req('grpStaffRoom', auth_level=pb.Session.ANON)) is rule
+    assert engine.match(sub_req('grpStaff', auth_level=pb.Session.ANON)) is rule
+    assert engine.match(sub_req('grpStaffRoom', auth_level=pb.Session.AUTH)) is None
+    assert engine.match(sub_req('grpPublic', auth_level=pb.Session.ANON)) is None
+    # another message type
+    assert engine.match(pub_req(b'hi', topic='grpStaffRoom', auth_level=pb.Session.ANON)) is None
+
+
+def test_exact_topic_does_not_match_prefixes():
+    rule = Rule(topic='grpStaff', action='drop')
+    engine = RuleEngine([rule])
+    assert engine.match(sub_req('grpStaff')) is rule
+    assert engine.match(sub_req('grpStaffRoom')) is None
+
+
+def test_first_match_wins_across_indexes():
+    spam = Rule(what='pub', content='spam', action='drop', name='spam')
+    trusted = Rule(user_id='usrTrusted', action='continue', name='trusted')
+    anything = Rule(action='respond', name='anything')
+    engine = RuleEngine([spam, trusted, anything])
+    assert engine.match(pub_req(b'spam', user_id='usrTrusted')) is spam
+    assert engine.match(pub_req(b'hello', user_id='usrTrusted')) is trusted
+    assert engine.match(pub_req(b'hello')) is anything
+
+    engine = RuleEngine([trusted, spam, anything])
+    assert engine.match(pub_req(b'spam', user_id='usrTrusted')) is trusted
+    assert engine.match(pub_req(b'spam')) is spam
+    assert spam.hits == 2
+    assert engine.stats()['calls'] == 2
+
+
+def test_add_and_clear_recompile():
+    engine = RuleEngine()
+    assert engine.match(pub_req(b'spam')) is None
+    rule = engine.add(Rule(content='spam'))
+    assert rule.order == 0
+    assert engine.match(pub_req(b'spam')) is rule
+    engine.clear()
+    assert engine.match(pub_req(b'spam')) is None
+
+
+def test_respond_answers_the_request_it_replaces():
+    engine = RuleEngine([Rule(what='sub', action='respond', code=403, text='forbidden')])
+    resp = engine.firehose(sub_req('grpStaff'))
+    assert resp.status == pb.RESPOND
+    assert (resp.srvmsg.ctrl.id, resp.srvmsg.ctrl.topic) == ('7', 'grpStaff')
+    assert (resp.srvmsg.ctrl.code, resp.srvmsg.ctrl.text) == (403, 'forbidden')
+    # the rule's own response is left alone
+    assert engine.rules[0].resp.srvmsg.ctrl.id == ''
+    assert engine.firehose(pub_req(b'hi')) is None
+
+
+def test_install_runs_before_other_handlers():
+    plugin = Plugin()
+    plugin.register('FireHose', lambda req: pb.ServerResp(status=pb.RESPOND))
+    RuleEngine([Rule(content='spam', action='drop')]).install(plugin)
+    assert plugin.FireHose(pub_req(b'spam'), None).status == pb.DROP
+    assert plugin.FireHose(pub_req(b'hello'), None).status == pb.RESPOND
+
+
+def test_bad_rules_are_refused():
+    with pytest.raises(ValueError):
+        Rule(action='ignore')
+    with pytest.raises(ValueError):
+        Rule(what='publish')
+    with pytest.raises(KeyError):
+        Rule(auth_level='ADMIN')
+
+
+def test_load_rules(tmp_path):
+    path = tmp_path / 'rules.json'
+    path.write_text(json.dumps([
+        {'name': 'trusted', 'user_id': 'usrTrusted', 'action': 'continue'},
+        {'name': 'spam', 'what': 'pub', 'content': ['buy now'], 'action': 'drop'},
+    ]))
+    engine = RuleEngine(load_rules(str(path)))
+    assert [r.name for r in engine.rules] == ['trusted', 'spam']
+    assert engine.match(pub_req(b'buy now')).name == 'spam'
+    assert engine.match(pub_req(b'buy now', user_id='usrTrusted')).name == 'trusted'
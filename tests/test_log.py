@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_log.py
+# ------------------------------------------------------------------------
+import io
+import logging
+import queue
+import sys
+
+import pytest
+
+import log
+
+
+@pytest.fixture
+def stream():
+    out = io.StringIO()
+    yield out
+    log.shutdown()
+    root = logging.getLogger(log.ROOT)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.propagate = True
+    root.setLevel(logging.NOTSET)
+    for category in ('sampled', 'in'):
+        logger = log.get_logger(category)
+        for f in list(logger.filters):
+            logger.removeFilter(f)
+
+
+class Rendered(object):
+    def __init__(self):
+        self.count = 0
+
+    def __str__(self):
+        self.count += 1
+        return 'rendered'
+
+
+def test_sampling_keeps_one_in_n(stream):
+    log.setup('DEBUG', stream=stream, fmt='%(name)s %(message)s', sample=log.parse_sample('sampled=3'))
+    for i in range(9):
+        log.get_logger('sampled').debug('msg %d', i)
+    log.get_logger('other').info('kept')
+    log.shutdown()
+    lines = stream.getvalue().splitlines()
+    assert lines == ['tinode.sampled msg 0', 'tinode.sampled msg 3', 'tinode.sampled msg 6', 'tinode.other kept']
+    sampler = log.get_logger('sampled').filters[0]
+    assert (sampler.seen, sampler.dropped) == (9, 6)
+
+
+def test_setup_again_replaces_the_sampler(stream):
+    log.setup('DEBUG', stream=stream, sample={'in': 2})
+    log.setup('DEBUG', stream=stream, sample={'in': 5})
+    assert [f.every for f in log.get_logger('in').filters] == [5]
+
+
+def test_records_are_formatted_by_the_writer(stream):
+    log.setup('INFO', stream=stream, fmt='%(message)s')
+    arg = Rendered()
+    log.get_logger('conn').debug('below the level %s', arg)
+    log.get_logger('conn').info('%s', arg)
+    log.shutdown()
+    assert arg.count == 1
+    assert stream.getvalue() == 'rendered\n'
+
+
+def test_queue_handler_never_blocks_and_renders_exceptions():
+    handler = log.DeferredQueueHandler(queue.Queue(1))
+    record = logging.LogRecord('tinode.x', logging.INFO, __file__, 1, 'first', None, None)
+    handler.handle(record)
+    # full: dropped instead of waiting for the writer
+    handler.handle(logging.LogRecord('tinode.x', logging.INFO, __file__, 1, 'second', None, None))
+    assert handler.queue.get_nowait() is record
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        failed = logging.LogRecord('tinode.x', logging.ERROR, __file__, 1, 'failed', None, sys.exc_info())
+    handler.handle(failed)
+    queued = handler.queue.get_nowait()
+    assert queued.exc_info is None and 'ValueError: boom' in queued.exc_text
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_metrics.py
+# ------------------------------------------------------------------------
+from metrics import MergedRegistry, Registry
+
+
+def worker_registry(handled, depth, latencies):
+    r = Registry()
+    r.counter('bot_handled_total', 'handled').inc(handled)
+    r.gauge('bot_queue_depth', 'depth').set(depth)
+    h = r.histogram('bot_handler_seconds', 'latency', buckets=(0.005, 0.01, 0.1, 1.0, 10.0))
+    for value in latencies:
+        h.observe(value)
+    return r
+
+
+def samples(text, name):
+    return [line.split(' ')[0] for line in text.splitlines() if line.startswith(name)]
+
+
+def test_histogram_buckets_keep_their_order():
+    merged = MergedRegistry()
+    merged.update(0, worker_registry(1, 0, [0.007, 2.0]).snapshot())
+    text = merged.render()
+    assert samples(text, 'bot_handler_seconds') == samples(worker_registry(1, 0, []).render(),
+                                                           'bot_handler_seconds')
+    assert samples(text, 'bot_handler_seconds_bucket')[-1] == 'bot_handler_seconds_bucket{le="+Inf"}'
+
+
+def test_retired_worker_counters_stay():
+    merged = MergedRegistry()
+    merged.update(0, worker_registry(10, 5, [0.5]).snapshot())
+    merged.update(1, worker_registry(3, 2, [0.5]).snapshot())
+    merged.retire(0)
+    # worker 0 restarted, counting from zero again
+    merged.update(0, worker_registry(1, 1, []).snapshot())
+    text = merged.render()
+    assert 'bot_handled_total 14' in text
+    assert 'bot_queue_depth 3' in text
+    assert 'bot_handler_seconds_count 2' in text
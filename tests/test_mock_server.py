@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_mock_server.py
+# ------------------------------------------------------------------------
+import time
+
+import grpc
+
+import pbx.model_pb2 as pb
+import pbx.model_pb2_grpc as pbx
+from mock_server import MockNode, serve
+
+
+def exchange(node, requests):
+    server, port = serve(node)
+    channel = grpc.insecure_channel('127.0.0.1:{}'.format(port))
+    try:
+        return list(pbx.NodeStub(channel).MessageLoop(iter(requests)))
+    finally:
+        channel.close()
+        server.stop(None)
+
+
+def test_latency_delays_replies_without_capping_the_rate():
+    node = MockNode(latency=0.05)
+    started = time.monotonic()
+    replies = exchange(node, [pb.ClientMsg(hi=pb.ClientHi(id=str(i), ver='0.14')) for i in range(100)])
+    elapsed = time.monotonic() - started
+    assert [msg.ctrl.id for msg in replies] == [str(i) for i in range(100)]
+    # one latency for the lot, not one per reply (5s)
+    assert 0.05 <= elapsed < 1.0
+
+
+def test_empty_client_message_is_ignored():
+    node = MockNode()
+    replies = exchange(node, [pb.ClientMsg(), pb.ClientMsg(hi=pb.ClientHi(id='1', ver='0.14'))])
+    assert [msg.ctrl.code for msg in replies] == [201]
+    assert node.received == {None: 1, 'hi': 1}
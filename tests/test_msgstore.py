@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_msgstore.py
+# ------------------------------------------------------------------------
+import pbx.model_pb2 as pb
+from msgstore import MessageStore
+
+
+def data(seq_id, topic='usrAlice'):
+    return pb.ServerData(topic=topic, seq_id=seq_id, from_user_id='usrAlice',
+                         content='"{}"'.format(seq_id).encode('utf-8'))
+
+
+def test_history_below_first_message_is_accepted(tmp_path):
+    store = MessageStore(str(tmp_path))
+    assert store.append(data(11))
+    assert store.append(data(10))
+    assert not store.append(data(10))
+    assert not store.append(data(11))
+    assert store.append(data(12))
+    assert store.since('usrAlice') == 12
+    store.close()
+
+
+def test_gap_is_filled_later(tmp_path):
+    store = MessageStore(str(tmp_path))
+    for seq_id in (1, 2, 5, 6):
+        assert store.append(data(seq_id))
+    assert store.since('usrAlice') == 2
+    assert store.high('usrAlice') == 6
+    assert store.append(data(3)) and store.append(data(4))
+    assert store.since('usrAlice') == 6
+    store.close()
+
+
+def test_compaction_keeps_seen_outside_the_run(tmp_path):
+    store = MessageStore(str(tmp_path), keep=2)
+    for seq_id in (10, 11, 15, 7):
+        store.append(data(seq_id))
+    store.compact()
+    store.close()
+
+    store = MessageStore(str(tmp_path), keep=2)
+    for seq_id in (7, 10, 11, 15):
+        assert not store.append(data(seq_id))
+    assert store.since('usrAlice') == 11
+    assert store.high('usrAlice') == 15
+    # still unknown: the gaps and what is below the oldest seen
+    for seq_id in (12, 8, 6):
+        assert store.append(data(seq_id))
+    store.close()
+
+
+def test_compaction_copying_more_than_max_segments(tmp_path):
+    # what is kept outgrows max_segments, the record still has to fit after the copies
+    store = MessageStore(str(tmp_path), segment_size=4096, keep=50, max_segments=2)
+    topics = ['usr{}'.format(i) for i in range(4)]
+    for seq_id in range(1, 101):
+        for topic in topics:
+            msg = pb.ServerData(topic=topic, seq_id=seq_id, from_user_id='usrBob', content=b'x' * 64)
+            assert store.append(msg)
+    # copies are amortized: no compaction on every roll
+    assert store.stats()['compactions'] < store.stats()['segments']
+    for topic in topics:
+        assert [m.seq_id for m in store.last(topic, 50)] == list(range(51, 101))
+    store.close()
+
+    store = MessageStore(str(tmp_path), segment_size=4096, keep=50, max_segments=2)
+    assert store.since('usr3') == 100
+    assert store.last('usr3', 1)[0].content == b'x' * 64
+    store.close()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_outbox.py
+# ------------------------------------------------------------------------
+import asyncio
+import threading
+import time
+
+import pytest
+
+import pbx.model_pb2 as pb
+from metrics import Registry
+from outbox import BLOCK, DROP_NOTES, REJECT, Outbox, OutboxFull
+
+
+def pub(n):
+    return pb.ClientMsg(pub=pb.ClientPub(id=str(n), topic='usrAlice'))
+
+
+def note(n):
+    return pb.ClientMsg(note=pb.ClientNote(topic='usrAlice', what=pb.READ, seq_id=n))
+
+
+def test_batches_keep_order_across_notes_and_pubs():
+    outbox = Outbox(max_batch=3)
+    sent = [pub(1), note(1), pub(2), note(2), pub(3)]
+    for msg in sent:
+        outbox.put(msg)
+    assert outbox.get_batch() == sent[:3]
+    assert outbox.get_batch() == sent[3:]
+
+
+@pytest.mark.parametrize('policy', [BLOCK, DROP_NOTES, REJECT])
+def test_pub_sheds_the_oldest_note_whatever_the_policy(policy):
+    outbox = Outbox(capacity=3, policy=policy)
+    outbox.put(note(1))
+    outbox.put(pub(1))
+    outbox.put(note(2))
+    outbox.put(pub(2), timeout=0)
+    assert outbox.dropped_notes == 1
+    assert outbox.get_batch() == [pub(1), note(2), pub(2)]
+
+
+def test_incoming_note_dropped_when_full_of_pubs():
+    outbox = Outbox(capacity=2, policy=DROP_NOTES)
+    outbox.put(pub(1))
+    outbox.put(pub(2))
+    outbox.put(note(1))
+    assert outbox.dropped_notes == 1
+    assert len(outbox) == 2
+
+
+def test_block_waits_for_room():
+    outbox = Outbox(capacity=1, policy=BLOCK)
+    outbox.put(pub(1))
+    with pytest.raises(OutboxFull):
+        outbox.put(note(1), timeout=0.05)
+    t = threading.Thread(target=outbox.put, args=(pub(2),))
+    t.start()
+    assert outbox.get_batch() == [pub(1)]
+    t.join(1)
+    assert outbox.get_batch() == [pub(2)]
+
+
+def test_reject_when_no_note_left():
+    outbox = Outbox(capacity=1, policy=REJECT)
+    outbox.put(pub(1))
+    with pytest.raises(OutboxFull):
+        outbox.put(pub(2))
+    assert outbox.rejected == 1
+
+
+def test_iteration_stops_at_close_and_keeps_what_follows():
+    outbox = Outbox()
+    outbox.put(pub(1))
+    outbox.close()
+    outbox.put(pub(2))
+    assert list(outbox) == [pub(1)]
+    assert outbox.clear() == [pub(2)]
+
+
+def test_async_client_queue_is_bounded():
+    from elves_aio import AsyncElvesChatter
+
+    async def fill():
+        bot = AsyncElvesChatter('localhost:1', queue_size=1, overflow=REJECT)
+        bot.queue_out = asyncio.Queue(maxsize=bot.queue_size)
+        await bot.client_post(pub(1))
+        assert await bot.client_post(note(1)) is None
+        with pytest.raises(OutboxFull):
+            await bot.client_post(pub(2))
+        return bot
+
+    bot = asyncio.run(fill())
+    assert (bot.queue_out.qsize(), bot.dropped_notes, bot.rejected) == (1, 1, 1)
+
+
+def test_renewed_outbox_forwards_to_its_successor():
+    old = Outbox()
+    old.put(pub(1))
+    fresh, leftovers = old.renew()
+    assert leftovers == [pub(1)]
+    # a producer which still holds the old outbox
+    old.put(pub(2))
+    old.close()
+    assert list(old) == []
+    assert fresh.get_batch() == [pub(2)]
+
+
+def test_counters_are_exported_across_renew():
+    registry = Registry()
+    old = Outbox(capacity=1, policy=REJECT, registry=registry)
+    old.put(pub(1))
+    with pytest.raises(OutboxFull):
+        old.put(pub(2))
+    fresh, _ = old.renew()
+    fresh.put(pub(3))
+    fresh.put(note(1))
+    text = registry.render()
+    assert 'tinode_bot_outbox_rejected_total 1' in text
+    assert 'tinode_bot_outbox_dropped_notes_total 1' in text
+
+
+def test_producer_waiting_on_a_renewed_outbox_moves_on():
+    old = Outbox(capacity=1, policy=BLOCK)
+    old.put(pub(1))
+    t = threading.Thread(target=old.put, args=(pub(2),))
+    t.start()
+    while not old._blocked:
+        time.sleep(0.001)
+    fresh, _ = old.renew()
+    t.join(1)
+    assert fresh.get_batch() == [pub(2)]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_pending.py
+# ------------------------------------------------------------------------
+import pytest
+
+from pending import Disconnected, PendingRequests, RequestError, RequestTimeout, SWEEP_INTERVAL
+
+
+class Ctrl(object):
+    def __init__(self, mid, code, params=None):
+        self.id = mid
+        self.code = code
+        self.text = ''
+        self.params = params or {}
+
+
+def test_resolve():
+    pending = PendingRequests()
+    ok = pending.add('1')
+    bad = pending.add('2')
+    assert pending.resolve(Ctrl('1', 200))
+    assert pending.resolve(Ctrl('2', 404))
+    assert not pending.resolve(Ctrl('3', 200))
+    assert ok.result(0).code == 200
+    with pytest.raises(RequestError):
+        bad.result(0)
+    assert len(pending) == 0
+
+
+def test_deadline_fires_without_traffic():
+    pending = PendingRequests(timeout=0.1)
+    fut = pending.add('1')
+    # nothing calls add() or resolve() again, the sweeper has to fail it
+    with pytest.raises(RequestTimeout):
+        fut.result(timeout=0.1 + 4 * SWEEP_INTERVAL)
+    assert pending.expired == 1
+    assert len(pending) == 0
+
+
+def test_answered_request_does_not_expire():
+    pending = PendingRequests(timeout=0.1)
+    fut = pending.add('1')
+    pending.resolve(Ctrl('1', 200))
+    assert fut.result(0).code == 200
+    assert pending.expire() == 0
+
+
+def test_evict_oldest_and_fail_all():
+    pending = PendingRequests(max_pending=2)
+    first, second, third = pending.add('1'), pending.add('2'), pending.add('3')
+    with pytest.raises(RequestTimeout):
+        first.result(0)
+    pending.fail_all()
+    for fut in (second, third):
+        with pytest.raises(Disconnected):
+            fut.result(0)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_plugin.py
+# ------------------------------------------------------------------------
+import threading
+
+import pytest
+
+import pbx.model_pb2 as pb
+from elves import ElvesChatter
+from plugin import CONTINUE, DROP, UNUSED, Plugin, parse_limits
+
+
+def test_firehose_past_its_limit_continues():
+    plugin = Plugin(limits=parse_limits('FireHose=1'))
+    entered = threading.Event()
+    release = threading.Event()
+
+    @plugin.on('FireHose')
+    def slow(req):
+        entered.set()
+        release.wait(5)
+        return DROP
+
+    results = []
+    t = threading.Thread(target=lambda: results.append(plugin.FireHose(pb.ClientReq(), None)))
+    t.start()
+    assert entered.wait(5)
+    # the only slot is taken: fail open at once
+    assert plugin.FireHose(pb.ClientReq(), None) is CONTINUE
+    release.set()
+    t.join(5)
+    assert results == [DROP]
+    assert plugin.stats()['FireHose'] == {'calls': 2, 'errors': 0, 'rejected': 1}
+
+
+def test_event_past_its_limit_is_skipped_after_waiting():
+    plugin = Plugin(event_wait=0.05)
+    plugin.set_limit('Account', 1)
+    entered = threading.Event()
+    release = threading.Event()
+    plugin.register('Account', lambda event: entered.set() or release.wait(5))
+
+    t = threading.Thread(target=plugin.Account, args=(pb.AccountEvent(), None))
+    t.start()
+    assert entered.wait(5)
+    assert plugin.Account(pb.AccountEvent(), None) is UNUSED
+    release.set()
+    t.join(5)
+    assert plugin.rejected['Account'] == 1
+
+    plugin.set_limit('Account', 0)
+    assert 'Account' not in plugin.limits
+
+
+def test_parse_limits():
+    assert parse_limits('FireHose=64, Find=8') == {'FireHose': 64, 'Find': 8}
+    assert parse_limits(None) == {}
+    with pytest.raises(ValueError):
+        parse_limits('Nope=1')
+
+
+def test_elves_chatter_passes_plugin_options():
+    bot = ElvesChatter('localhost:1', plugin_limits={'Find': 4}, plugin_workers=2, plugin_max_rpcs=8)
+    assert bot.plugin.limits == {'Find': 4}
+    assert (bot.plugin_workers, bot.plugin_max_rpcs) == (2, 8)
+
+
+def test_connect_serves_with_the_constructor_options(monkeypatch):
+    import elves
+    served = []
+    monkeypatch.setattr(elves, 'serve_plugin', lambda plugin, listen, **kwargs: served.append(kwargs) or (None, 0))
+    bot = ElvesChatter('localhost:1', plugin_workers=2, plugin_max_rpcs=8)
+    bot.init_server('127.0.0.1:0')
+    assert served == [{'workers': 2, 'maximum_concurrent_rpcs': 8}]
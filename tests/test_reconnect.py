@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_reconnect.py
+# ------------------------------------------------------------------------
+import asyncio
+import time
+
+import chatbot
+import pbx.model_pb2 as pb
+from elves_aio import AsyncElvesChatter
+from mock_server import MockNode, serve
+from reconnect import Backoff
+
+
+def test_replayed_publishes_get_new_ids(monkeypatch):
+    sent = []
+    monkeypatch.setattr(chatbot, 'acks', None)
+    monkeypatch.setattr(chatbot, 'client_post', sent.append)
+    monkeypatch.setattr(chatbot, 'ready', chatbot.threading.Event())
+    chatbot.ready.set()
+    msg = pb.ClientMsg(pub=pb.ClientPub(id='7', topic='usrAlice'))
+    chatbot.replay_when_ready([msg])
+    assert sent == [msg]
+    assert msg.pub.id not in ('', '7')
+
+
+async def until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+def test_async_run_forever_reconnects(tmp_path, monkeypatch):
+    # the login saves a cookie in the working directory
+    monkeypatch.chdir(tmp_path)
+    node = MockNode()
+    server, port = serve(node)
+
+    async def main():
+        bot = AsyncElvesChatter('127.0.0.1:{}'.format(port))
+        task = asyncio.ensure_future(bot.run_forever('alice', 'secret', backoff=Backoff(base=0.01, cap=0.05)))
+        await until(lambda: node.received.get('login') == 1)
+        node.disconnect()
+        await until(lambda: node.received.get('login') == 2)
+        assert bot.reconnects == 1
+        bot.stop()
+        await asyncio.wait_for(task, 5)
+        await bot.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        server.stop(None)
+
+
+def test_async_reconnect_resubscribes_before_replay(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # (session, what, topic or scheme) as the server reads them
+    seen = []
+
+    def record(sess, msg):
+        what = msg.WhichOneof('Message')
+        body = getattr(msg, what)
+        seen.append((sess.sid, what, body.scheme if what == 'login' else getattr(body, 'topic', '')))
+
+    node = MockNode(on_message=record)
+    server, port = serve(node)
+
+    async def main():
+        bot = AsyncElvesChatter('127.0.0.1:{}'.format(port))
+        task = asyncio.ensure_future(bot.run_forever('alice', 'secret', backoff=Backoff(base=0.01, cap=0.05)))
+        await until(bot.ready.is_set)
+        await asyncio.wrap_future(await bot.subscribe('usrPeer'))
+        assert bot.token is not None
+        # a publish the dead stream did not get to send
+        lost = pb.ClientMsg(pub=pb.ClientPub(id='1', topic='usrPeer', no_echo=True, content=b'"hi"'))
+        bot.unsent = lambda: [lost]
+        node.disconnect()
+        await until(lambda: node.received.get('pub') == 1)
+        bot.stop()
+        await asyncio.wait_for(task, 5)
+        await bot.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        server.stop(None)
+    second = [(what, name) for sid, what, name in seen if sid == 'sid2']
+    assert second == [('hi', ''), ('login', 'token'), ('sub', 'usrPeer'), ('pub', 'usrPeer')]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_submanager.py
+# ------------------------------------------------------------------------
+import time
+from concurrent.futures import Future
+
+from submanager import SubscriptionManager
+
+
+def manager(**kwargs):
+    pending = {}
+    left = []
+
+    def subscribe(topic):
+        fut = pending[topic] = Future()
+        return fut
+
+    subs = SubscriptionManager(subscribe, left.append, **kwargs)
+    return subs, pending, left
+
+
+def test_off_during_sub_leaves_once_confirmed():
+    subs, pending, left = manager(off_grace=0.0)
+    subs.want('usrAlice')
+    subs.release('usrAlice')
+    # the grace is over before the {sub} is answered, the OFF must wait for it
+    assert subs.tick(time.monotonic() + 1) == []
+    pending['usrAlice'].set_result(None)
+    assert left == ['usrAlice']
+    assert 'usrAlice' not in subs
+    assert subs.stats()['leaving'] == 0
+
+
+def test_off_during_sub_within_grace_leaves_on_tick():
+    subs, pending, left = manager(off_grace=30.0)
+    subs.want('usrAlice')
+    subs.release('usrAlice')
+    pending['usrAlice'].set_result(None)
+    assert 'usrAlice' in subs and left == []
+    assert subs.tick(time.monotonic() + 60) == ['usrAlice']
+    assert left == ['usrAlice']
+
+
+def test_on_after_off_during_sub_keeps_topic():
+    subs, pending, left = manager(off_grace=0.0)
+    subs.want('usrAlice')
+    subs.release('usrAlice')
+    subs.want('usrAlice')
+    pending['usrAlice'].set_result(None)
+    subs.tick(time.monotonic() + 1)
+    assert 'usrAlice' in subs and left == []
+    assert subs.flaps.value == 1
+
+
+def test_failed_sub_forgets_pending_off():
+    subs, pending, left = manager(off_grace=0.0)
+    subs.want('usrAlice')
+    subs.release('usrAlice')
+    pending['usrAlice'].set_exception(RuntimeError('refused'))
+    assert subs.stats()['leaving'] == 0
+    assert subs.tick(time.monotonic() + 1) == [] and left == []
+
+
+def test_start_is_idempotent():
+    subs, _, _ = manager()
+    try:
+        assert subs.start(interval=0.05) is subs.start(interval=0.05)
+    finally:
+        subs.stop()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# file: tests/test_sync.py
+# ------------------------------------------------------------------------
+from concurrent.futures import Future
+
+import pbx.model_pb2 as pb
+from msgstore import MessageStore
+from sync import HistorySync
+
+
+class History(object):
+    """a topic on the server: answers {get what='data'} with the newest `limit` messages, newest first"""
+
+    def __init__(self, seq_ids, store):
+        self.seq_ids = sorted(seq_ids)
+        self.store = store
+        self.history = None
+        self.gets = []
+
+    def get(self, topic, since_id, before_id, limit):
+        self.gets.append((since_id, before_id, limit))
+        found = [s for s in self.seq_ids if s >= since_id and (not before_id or s < before_id)]
+        for seq_id in reversed(found[-limit:] if limit else found):
+            data = pb.ServerData(topic=topic, seq_id=seq_id, content=b'"hi"')
+            self.history.observe(data, fresh=self.store.append(data))
+        fut = Future()
+        fut.set_result(pb.ServerCtrl(code=200))
+        return fut
+
+
+def test_long_outage_is_fetched_completely(tmp_path):
+    store = MessageStore(str(tmp_path))
+    deleted = set(range(500, 510))
+    server = History([s for s in range(1, 2101) if s not in deleted], store)
+    server.history = history = HistorySync(server.get, store=store, page=100)
+    for seq_id in range(1, 101):
+        store.append(pb.ServerData(topic='usrAlice', seq_id=seq_id))
+    # seen live just before the connection was lost
+    store.append(pb.ServerData(topic='usrAlice', seq_id=150))
+
+    history.sync(['usrAlice'])
+
+    assert store.since('usrAlice') == 2100
+    assert history.fetched == 2000 - len(deleted) - 1
+    assert history.stats()['synced'] == 1 and history.stats()['active'] == 0
+    # the newest one, then oldest first
+    assert server.gets[0] == (101, 0, 1)
+    assert server.gets[1] == (101, 201, 100)
+    assert server.gets[-1] == (2001, 2100, 100)
+    store.close()
+
+
+def test_nothing_new(tmp_path):
+    store = MessageStore(str(tmp_path))
+    server = History(range(1, 11), store)
+    server.history = history = HistorySync(server.get, store=store, page=100)
+    for seq_id in range(1, 11):
+        store.append(pb.ServerData(topic='usrAlice', seq_id=seq_id))
+    history.sync(['usrAlice', 'usrBob'])
+    assert server.gets == [(11, 0, 1)]
+    assert history.fetched == 0 and history.synced == 1
+    store.close()